@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmarks for the 'gandalf' script.
+
+    Synthetic inventories of different sizes are generated, and every stage
+    of rendering is run over them: parsing CSV file, loading hosts from
+    snapshots, rendering every view, comparing DNS zones and full runs
+    of gandalf over the example templates (with and without streaming).
+    Wall clock time, CPU time and peak memory of every stage are written
+    into a JSON file, so that results of different runs can be compared:
+
+        ./benchmark.py -s 1000,10000,100000 -o before.json
+        ./benchmark.py -s 1000,10000,100000 -o after.json --compare before.json
+'''
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import itertools
+import tracemalloc
+
+import gandalf
+
+# Format version of results file
+RESULTS_VERSION = 1
+
+# Directory with example templates that the full run renders
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# Columns of generated CSV file, the same as in examples/nodes.csv
+COLUMNS = ["hostname", "domain", "ip", "mask", "vlan", "type", "resides_on",
+           "resides_on_type", "cluster", "dev", "mac"]
+
+# Hosts per /24 network and VLANs that /24 networks are spread over.
+# VLANs that the example templates query are among them.
+HOSTS_PER_NETWORK = 250
+VLANS = [1010, 2020, 3030] + list(range(100, 400))
+
+# Entity types with their relative frequency
+TYPES = ["comp"] * 12 + ["hardware"] * 4 + ["cimc"] * 2 + ["head", "fi", "alias"]
+
+
+def network_prefix(n):
+    '''
+        Return first three octets of n-th /24 network of generated inventory.
+        The first network is 192.168.0.0/24, which example templates
+        query, the others are taken from 10.0.0.0/8.
+    '''
+    if n == 0:
+        return "192.168.0"
+    return "10.{}.{}".format((n - 1) >> 8, (n - 1) & 0xFF)
+
+
+def generate_hosts(count, seed=0):
+    '''
+        Generate synthetic inventory. Every host has unique name and IP address,
+        hosts are spread over /24 networks, VLANs, entity types, domains
+        and clusters, and most of them have a MAC address.
+        Parameters:
+            count - number of hosts (at most 16 million)
+            seed - seed of random number generator
+        Yields:
+            dicts with CSV file columns
+    '''
+    rnd = random.Random(seed)
+    for i in range(count):
+        network, octet = divmod(i, HOSTS_PER_NETWORK)
+        type_ = rnd.choice(TYPES)
+        hostname = "{}{:07d}".format(type_, i)
+        parent = "hardware{:07d}".format(i - i % 16) if type_ in ("cimc", "alias") else hostname
+        yield {
+            "hostname": hostname,
+            "domain": "dc{}.example.com".format(network % 8),
+            "ip": "{}.{}".format(network_prefix(network), octet + 1),
+            "mask": 24,
+            "vlan": VLANS[network % len(VLANS)],
+            "type": type_,
+            "resides_on": parent,
+            "resides_on_type": "hardware" if parent != hostname else type_,
+            "cluster": "cluster{}".format(network // 4) if type_ in ("comp", "head") else "",
+            "dev": "eno1" if type_ in ("comp", "head") else "",
+            "mac": "" if rnd.random() < 0.1 else
+                   ":".join("{:02x}".format(b) for b in (i * 2654435761 + 0x0200000000).to_bytes(6, "big"))
+        }
+
+
+def write_csv(path, count, seed=0):
+    '''
+        Write synthetic inventory of given size into CSV file.
+        Parameters:
+            path - path to CSV file
+            count - number of hosts
+            seed - seed of random number generator
+    '''
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(generate_hosts(count, seed))
+
+
+def measure(func, repeat=1, memory=True):
+    '''
+        Measure a benchmark stage.
+        Parameters:
+            func - function that runs the stage
+            repeat - number of timed runs, the fastest one is reported
+            memory - whether to measure peak memory as well (this takes
+                     one more run, since tracing memory slows it down)
+        Returns:
+            dict with wall clock time and CPU time in seconds, and peak
+            size of memory allocated by Python in bytes (None if not measured)
+    '''
+    wall = cpu = None
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        func()
+        wall_run, cpu_run = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        if wall is None or wall_run < wall:
+            wall, cpu = wall_run, cpu_run
+
+    peak_memory = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {"wall": round(wall, 6), "cpu": round(cpu, 6), "peak_memory": peak_memory}
+
+
+def run_main(argv):
+    '''
+        Run gandalf.main() with given command line arguments.
+        Raises:
+            RuntimeError if gandalf exits with an error
+    '''
+    saved_argv = sys.argv
+    sys.argv = ["gandalf"] + argv
+    try:
+        gandalf.main()
+    except SystemExit as exc:
+        if exc.code:
+            raise RuntimeError("gandalf exited with code {}".format(exc.code))
+    finally:
+        sys.argv = saved_argv
+
+
+def benchmark_size(count, workdir, seed=0, repeat=1, memory=True):
+    '''
+        Run all benchmark stages over inventory of given size.
+        Parameters:
+            count - number of hosts
+            workdir - directory for generated and rendered files
+            seed - seed of random number generator
+            repeat - number of timed runs of every stage
+            memory - whether to measure peak memory
+        Returns:
+            list of dicts with results of every stage
+    '''
+    results = []
+
+    def stage(name, func):
+        result = measure(func, repeat, memory)
+        result.update(stage=name, hosts=count)
+        logging.info("{:>8} hosts  {:<32} {:>10.3f} s".format(count, name, result["wall"]))
+        results.append(result)
+
+    # Generate inventory
+    csvpath = os.path.join(workdir, "hosts-{}.csv".format(count))
+    write_csv(csvpath, count, seed)
+
+    # Parse it
+    stage("parse_csv", lambda: gandalf.parse_csv(csvpath))
+    hosts = gandalf.parse_csv(csvpath)
+
+    # Load it from snapshots
+    for compact in (False, True):
+        cache_dir = os.path.join(workdir, "cache-{}".format(count))
+        gandalf.load_hosts(csvpath, compact, cache_dir)
+        stage("load_hosts (snapshot{})".format(", compact" if compact else ""),
+              lambda: gandalf.load_hosts(csvpath, compact, cache_dir))
+
+    # Render every view
+    networks = [list(group) for _, group in
+                itertools.groupby(hosts, key=lambda h: h["ip"].rsplit(".", 1)[0])]
+    with_mac = [host for host in hosts if host["mac"]]
+    stage("view.hosts", lambda: gandalf.ViewSet.hosts(hosts))
+    stage("view.dns", lambda: gandalf.ViewSet.dns(hosts))
+    stage("view.rdns", lambda: [gandalf.ViewSet.rdns(group) for group in networks])
+    stage("view.dhcp", lambda: gandalf.ViewSet.dhcp(with_mac))
+
+    # Run a query and take its result from MemoCache
+    query = (gandalf.HostQuery().type == "comp") & gandalf.HostQuery().hostname.matches(".*[13579]")
+    sqlite = gandalf.load_hosts(csvpath, sqlite=os.path.join(workdir, "hosts-{}.db".format(count)))
+    for name, db in [("", gandalf.HostDB(hosts)), (", sqlite", sqlite)]:
+        new_db = lambda memo: gandalf.MemoizingDB(db, memo, gandalf.MemoCache.new_stats())
+        stage("memo.search (miss{})".format(name), lambda: new_db(gandalf.MemoCache()).search(query))
+        memoized = new_db(gandalf.MemoCache())
+        memoized.search(query)
+        stage("memo.search (hit{})".format(name), lambda: memoized.search(query))
+    sqlite._conn.close()
+
+    # Compare zone with the old one that has the same records
+    zone = "$ORIGIN example.com.\n@ IN SOA example.com. (\n\t{}{}\n\t)\n{}\n".format(
+        gandalf.DNS_HACK_ANCHOR, gandalf.DNS_HACK_COMMENT, gandalf.ViewSet.dns(hosts))
+    dnsfile = os.path.join(workdir, "zone-{}".format(count))
+    old_zone = gandalf.apply_dns_version_hack(zone, dnsfile)
+    with open(dnsfile, "w") as f:
+        f.write(old_zone)
+    stage("dns_changed", lambda: gandalf.dns_changed(old_zone, old_zone))
+    stage("apply_dns_version_hack", lambda: gandalf.apply_dns_version_hack(zone, dnsfile))
+    del hosts, networks, with_mac, zone, old_zone, sqlite, db, memoized
+
+    # Full run over example templates, with and without streaming
+    outdir = os.path.join(workdir, "rendered-{}".format(count))
+    stage("main", lambda: run_main([csvpath, os.path.join(EXAMPLES_DIR, "templates"), outdir]))
+    outdir = os.path.join(workdir, "streamed-{}".format(count))
+    stage("main (stream)", lambda: run_main([csvpath, os.path.join(EXAMPLES_DIR, "templates"),
+                                             outdir, "--stream"]))
+
+    return results
+
+
+def compare_results(old, new, threshold):
+    '''
+        Compare wall clock time and peak memory of two benchmark runs.
+        Parameters:
+            old, new - lists of stage results
+            threshold - ratio of new to old value above which
+                        the stage is considered to have regressed
+        Returns:
+            list of (stage, hosts, metric, old value, new value) tuples
+            of stages that regressed
+    '''
+    old = {(r["stage"], r["hosts"]): r for r in old}
+    regressions = []
+    for result in new:
+        previous = old.get((result["stage"], result["hosts"]))
+        if previous is None:
+            continue
+        for metric in ("wall", "peak_memory"):
+            if previous.get(metric) and result.get(metric) is not None and \
+                    result[metric] > previous[metric] * threshold:
+                regressions.append((result["stage"], result["hosts"], metric,
+                                    previous[metric], result[metric]))
+    return regressions
+
+
+def main():
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser(description="Benchmark gandalf on synthetic inventories.")
+    parser.add_argument("-s", "--sizes", metavar="N,N,...", default="1000,10000,100000",
+                        help="comma separated numbers of hosts (default: 1000,10000,100000)")
+    parser.add_argument("-r", "--repeat", metavar="N", type=int, default=1,
+                        help="number of timed runs of every stage, the fastest is reported")
+    parser.add_argument("-o", "--output", metavar="RESULTS",
+                        help="JSON file to write results into (default: standard output)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of synthetic inventory generator")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="do not measure peak memory")
+    parser.add_argument("--compare", metavar="OLDRESULTS",
+                        help="compare results with a previous run and exit "
+                             "with code 1 if some stage regressed")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="ratio of new to old value that is considered "
+                             "a regression (default: 1.25)")
+    parser.add_argument("--generate", metavar="N", type=int,
+                        help="only write synthetic inventory of N hosts into "
+                             "CSV file given by -o and exit")
+
+    # Parse arguments
+    args = parser.parse_args()
+    try:
+        sizes = [int(size) for size in args.sizes.split(",")]
+    except ValueError:
+        parser.error("sizes must be comma separated integers")
+    if args.repeat < 1:
+        parser.error("number of runs must be positive")
+    if args.generate is not None and not args.output:
+        parser.error("output file must be given with --generate")
+
+    # Configure logging (gandalf.main() then keeps this configuration)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Only generate inventory
+    if args.generate is not None:
+        write_csv(args.output, args.generate, args.seed)
+        return sys.exit(0)
+
+    # Run benchmarks
+    results = []
+    with tempfile.TemporaryDirectory(prefix="gandalf-bench-") as workdir:
+        for count in sizes:
+            results.extend(benchmark_size(count, workdir, args.seed, args.repeat, args.memory))
+
+    report = {
+        "version": RESULTS_VERSION,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results
+    }
+    text = json.dumps(report, indent=1, sort_keys=True) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    # Compare with previous run
+    if args.compare:
+        with open(args.compare, "r") as f:
+            old = json.load(f)
+        regressions = compare_results(old["results"], results, args.threshold)
+        for stage, count, metric, old_value, new_value in regressions:
+            logging.warning("regression: {} hosts, {} {}: {} -> {}".format(
+                count, stage, metric, old_value, new_value))
+        return sys.exit(1 if regressions else 0)
+
+    return sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,11 +28,12 @@ ${ view(db.search(host.vlan == 1010)) }
 ${ view(db.search((host.vlan == 2020) & (host.type == "comp")), filename="shim.efi") }
 ##
 ## The following query selects all the hosts that have an IP address
-## starting with "192.168.0.". Note how we use custom lambda function for that.
+## from 192.168.0.0/24 network. Subnet queries are answered from an index
+## of IP addresses, so they are fast even on large CSV files.
 #
 # Nodes from 192.168.0.0/24 network:
 #
-${ view(db.search(host.ip.test(lambda s: s.startswith("192.168.0.")))) }
+${ view(db.search(host.ip.in_subnet("192.168.0.0/24"))) }
 ## Try rendering this template by calling
 ##
 ##          ./gandalf.py examples/nodes.csv examples/templates/dhcp.conf.mako examples/rendered/dhcp.conf.mako
@@ -22,7 +22,7 @@ $ORIGIN 0.8.10.in-addr.arpa.
         48h             IN      NS      ns2.galaxies.com.          ; Secondary
 
 ## Render reverse DNS entries for the 192.168.0.0/24 network
-${ view(db.search(host.ip.test(lambda s: s.startswith("192.168.0.")))) }
+${ view(db.search(host.ip.in_subnet("192.168.0.0/24"))) }
 ##
 ## You can render templates using command
 ##
@@ -5,12 +5,32 @@ import sys
 import csv
 import logging
 import argparse
+import array
+import stat
+import bisect
+import heapq
+import marshal
+import pickle
 import datetime
+import hashlib
+import sqlite3
+import errno
+import re
+import time
+import json
+import inspect
+import operator
+import functools
+import contextlib
+import ipaddress
 import itertools
+import threading
+import urllib.parse
+import concurrent.futures
 
 import yaml
 import tinydb
-import mako, mako.exceptions, mako.template
+import mako, mako.exceptions, mako.runtime, mako.template
 
 # A string that is being added inside a template when get_dns_version()
 # function is called. After the initial rendering this anchor is replaced
@@ -28,6 +48,61 @@ DNS_HACK_COMMENT = "  ; Version. The following must be present on the version li
 class CsvIntegrityError(Exception): pass
 
 
+def ip_to_int(ip):
+    '''
+        Convert IP address in dotted quad notation into 32-bit integer.
+        Raises ValueError if ip is not a valid IP address.
+    '''
+    parts = ip.split(".")
+    if len(parts) != 4:
+        raise ValueError("invalid IP address: {!r}".format(ip))
+    n = 0
+    for part in parts:
+        byte = int(part)
+        if not 0 <= byte <= 255:
+            raise ValueError("invalid IP address: {!r}".format(ip))
+        n = (n << 8) | byte
+    return n
+
+
+def int_to_ip(n):
+    '''
+        Convert 32-bit integer into IP address in dotted quad notation.
+    '''
+    return "{}.{}.{}.{}".format(n >> 24, (n >> 16) & 0xFF, (n >> 8) & 0xFF, n & 0xFF)
+
+
+def mac_to_int(mac):
+    '''
+        Convert MAC address into 48-bit integer.
+        Raises ValueError if mac is not a valid MAC address.
+    '''
+    parts = mac.split(":")
+    if len(parts) != 6 or not all(len(part) == 2 for part in parts):
+        raise ValueError("invalid MAC address: {!r}".format(mac))
+    return int("".join(parts), 16)
+
+
+def int_to_mac(n, upper=False):
+    '''
+        Convert 48-bit integer into colon-separated MAC address.
+    '''
+    s = "{:012X}".format(n) if upper else "{:012x}".format(n)
+    return ":".join(s[i:i+2] for i in range(0, 12, 2))
+
+
+def _host_ip_int(host):
+    '''
+        Get IP address of a host as integer. Hosts that come from HostTable
+        or SqliteHostDB already have it computed, unless a template has
+        changed them; for others it is parsed from 'ip' column.
+    '''
+    ip_int = getattr(host, "ip_int", None)
+    if ip_int is None or getattr(host, "modified", False):
+        return ip_to_int(host["ip"])
+    return ip_int
+
+
 class ViewSet:
     '''
         A class that contains static functions to render a list of hosts
@@ -63,18 +138,24 @@ class ViewSet:
             Return value:
                 multiline string suitable for use in /etc/hosts
         '''
+        return "\n".join(ViewSet.iter_hosts(hosts))
+
+    @staticmethod
+    def iter_hosts(hosts):
+        '''
+            Generator variant of hosts view: yield lines of /etc/hosts
+            file one by one instead of joining them into one string.
+            Use it to write large files without keeping the whole text
+            in memory, e.g. "% for line in view.iter_hosts(db.all()):".
+        '''
         # Sort hosts by ip address
-        hosts = sorted(hosts, key=lambda h: [int(x) for x in h["ip"].split(".")])
+        hosts = sorted(hosts, key=_host_ip_int)
 
         # Render each group into hosts file entry
-        lines = [] # list of strings
         for ip, host_group in itertools.groupby(hosts, key=lambda h: h["ip"]):
             all_names = [name for host in host_group for name in
                 [host["hostname"], "{}.{}".format(host["hostname"], host["domain"])]]
-            lines.append("{} {}".format(ip, " ".join(all_names)))
-
-        # Render it all into one string
-        return "\n".join(lines)
+            yield "{} {}".format(ip, " ".join(all_names))
 
     @staticmethod
     def dns(hosts, type_="addr"):
@@ -89,6 +170,15 @@ class ViewSet:
             Return value:
                 multiline string suitable for use in DNS zone file
         '''
+        return "\n".join(ViewSet.iter_dns(hosts, type_))
+
+    @staticmethod
+    def iter_dns(hosts, type_="addr"):
+        '''
+            Generator variant of dns view: yield records one by one.
+            Raises (when iteration starts):
+                ValueError if record type is unknown
+        '''
         if type_ == "addr":
             lines = ["{:<24}{:<8}{:<8}{}".format(h["hostname"], "IN", "A", h["ip"])
                     for h in hosts]
@@ -97,7 +187,7 @@ class ViewSet:
                     h["resides_on"]) for h in hosts]
         else:
             raise ValueError("Unknown DNS record type: {}".format(type_))
-        return "\n".join(sorted(lines))
+        yield from _pop_sorted(lines)
 
     @staticmethod
     def rdns(hosts):
@@ -108,21 +198,42 @@ class ViewSet:
             Return value:
                 multiline string suitable for use in reverse DNS zone file
         '''
-        # Check that there are no two hosts with same IP address
+        return "\n".join(ViewSet.iter_rdns(hosts))
+
+    @staticmethod
+    def iter_rdns(hosts):
+        '''
+            Generator variant of rdns view: yield records one by one.
+            Raises (when iteration starts):
+                ValueError if several hosts have the same IP address
+        '''
+        # Hosts may be given by an iterator, so they are read only once
         hosts = sorted(hosts, key=lambda h: h["ip"])
-        for ip, host_group in itertools.groupby(hosts, key=lambda h: h["ip"]):
+
+        # Check that there are no two hosts with same IP address. Distinct
+        # unmodified records read from HostDB are known to have unique IP
+        # address unless they are marked otherwise, so if there are only
+        # such records, just the marked ones are checked; otherwise (e.g.
+        # some record is given twice or was changed) all hosts are checked.
+        doc_ids = set()
+        for h in hosts:
+            if not isinstance(h, HostRecord) or h.modified or h.doc_id in doc_ids:
+                shared = hosts
+                break
+            doc_ids.add(h.doc_id)
+        else:
+            shared = (h for h in hosts if h.ip_shared)
+        for ip, host_group in itertools.groupby(shared, key=lambda h: h["ip"]):
             host_group = tuple(host_group)
             if len(host_group) > 1:
                 raise ValueError("Multiple entities with same IP address found: '{}' ({})"
                                  .format("', '".join(h["hostname"] for h in host_group), ip))
 
-        # Form list of lines
-        lines = ["{:<24}{:<8}{:<8}{:<8}{}.{}.".format(
+        # Sort by the last byte of ip address and yield lines
+        hosts.sort(key=lambda h: _host_ip_int(h) & 0xFF)
+        for h in hosts:
+            yield "{:<24}{:<8}{:<8}{:<8}{}.{}.".format(
                     h["ip"].split(".")[-1], "1d", "IN", "PTR", h["hostname"], h["domain"])
-                for h in hosts]
-
-        # Sort and concatenate
-        return "\n".join(sorted(lines, key = lambda s: int(s.split()[0])))
 
     @staticmethod
     def dhcp(hosts, with_hostname=True, router_ip=None, filename=None):
@@ -136,339 +247,4959 @@ class ViewSet:
             Return value:
                 multiline string suitable for use in DHCP file
         '''
-        # Define a function that converts given ip address
-        # and network mask to broadcast address
-        def get_broadcast(ip, mask):
-            ip_n = sum(int(x)*256**i for i, x in enumerate(reversed(ip.split("."))))
-            ip_n_bcast = ip_n & ((2**(mask+1)-1) << (32-mask)) | (2**(32-mask)-1)
-            return ".".join(str((ip_n_bcast & (0xFF << (8*i))) >> (8*i)) for i in reversed(range(4)))
-
-        # Build lines
-        lines = []
-        for host in hosts:
-            params = 'hardware ethernet {}; fixed-address {}; ' \
-                'option broadcast-address {};'.format(host["mac"], host["ip"],
-                        get_broadcast(host["ip"], host["mask"]))
-            if with_hostname:
-                params = 'option host-name "{}"; '.format(host["hostname"]+"."+host["domain"]) + params
-            if router_ip:
-                params += ' option routers {};'.format(router_ip)
-            if filename:
-                params += ' option filename "{}";'.format(filename)
-            lines.append("host {} {{ {} }}".format(host["hostname"], params))
-
-        # Sort and return
-        return "\n".join(sorted(lines))
-
-
-def parse_csv(csvpath):
-    '''
-        Parse given CSV file and return a list of dicts,
-        where each dict represents a host on the network.
-        Make all columns names lowercase and replace spaces with underscores.
-        Check that the following columns exist: 'hostname', 'domain',
-        'ip', 'mac', 'vlan'. Check IP/MAC addresses for validity.
-        If column 'gendalf_ignore' is present, then any row
-        that has non-blank value in this column is getting ignored.
-        Parameters:
-            csvpath - path to CSV file
-        Return value:
-            list of dicts, where each dict corresponds to CSV file row
-        Raises:
-            IOError if unable to open given file
-            csv.Error if CSV file is invalid
-            CsvIntegrityError if there are missing columns or invalid values
-    '''
-
-    # Define a function that transforms column names.
-    # Make column name lowercase and replace spaces with underscores.
-    colname_transform = lambda colname: colname.lower().strip().replace(" ", "_")
+        return "\n".join(ViewSet.iter_dhcp(hosts, with_hostname, router_ip, filename))
 
-    # Define validator functions for every column.
-    # Value considered invalid if validator returns False
-    # or raises ValueError.
-    column_validators = {
-        "hostname": lambda s: bool(s),
-        "domain": lambda s: bool(s),
-        "vlan": lambda s: s.strip() == "" or 0 < int(s) < 4096,
-        "ip": lambda s: s.count(".") == 3 and all(0 <= int(x) <= 255 and (x == "0" or x[0] != "0") for x in s.split(".")),
-        "mask": lambda s: 0 <= int(s) <= 32,
-        "mac": lambda s: not s or s.count(":") == 5 and all(0 <= int(x,16) <= 255 and len(x) == 2 for x in s.split(":")),
-        "entity_type": lambda s: s in ("comp", "head", "alias", "cimc", "fi", "hardware")
-    }
+    @staticmethod
+    def iter_dhcp(hosts, with_hostname=True, router_ip=None, filename=None):
+        '''
+            Generator variant of dhcp view: yield host declarations one by one.
+        '''
+        yield from _iter_dhcp(hosts, lambda host: _dhcp_line(host, with_hostname,
+                                                             router_ip, filename))
 
-    # Define column transformer functions.
-    # Those functions are applied to corresponding columns
-    # after value has been validated with functions above.
-    # Note that by default all the values are stripped even before validating.
-    column_transformers = {
-        "vlan": lambda s: int(s) if s.strip() != "" else None,
-        "mask": int
-    }
 
-    # Go ahead and read csv file. This raises IOError on error
-    with open(csvpath, "r") as f:
-        lines = f.readlines()
+# Dhcp view is split into formatting the line of a single host
+# and putting lines together, so that lines can be taken from LineCache.
 
-    # Strip comments (lines that start with '#')
-    lines = [l for l in lines if not l.lstrip().lstrip('"').lstrip().startswith('#')]
+def _dhcp_line(host, with_hostname, router_ip, filename):
+    # Broadcast address is the ip address with all the host bits set
+    broadcast = _host_ip_int(host) | ((1 << (32 - host["mask"])) - 1)
+    params = 'hardware ethernet {}; fixed-address {}; ' \
+        'option broadcast-address {};'.format(host["mac"], host["ip"],
+                int_to_ip(broadcast))
+    if with_hostname:
+        params = 'option host-name "{}"; '.format(host["hostname"]+"."+host["domain"]) + params
+    if router_ip:
+        params += ' option routers {};'.format(router_ip)
+    if filename:
+        params += ' option filename "{}";'.format(filename)
+    return "host {} {{ {} }}".format(host["hostname"], params)
 
-    # If file is empty - quit
-    raw_rows = tuple(csv.DictReader(lines)) # raises csv.Error on error
-    if not raw_rows:
-        return []
 
-    # Build the mapping of column names
-    colname_map = {colname: colname_transform(colname) for colname in raw_rows[0].keys()}
-    ignore_column = ([old_col for old_col, new_col in colname_map.items()
-            if new_col == "gandalf_ignore"] + [None])[0] # column that says to ignore row
+def _iter_dhcp(hosts, line):
+    yield from _pop_sorted([line(host) for host in hosts])
 
-    # List of preprocessed rows
-    rows = []
 
-    # Do sanity checks and transforms
-    for n, raw_row in enumerate(raw_rows, start=2):
+def _pop_sorted(lines):
+    '''
+        Sort list of lines in place and yield them in order, removing
+        every line from the list as it is yielded, so that lines that
+        are already written out can be freed.
+    '''
+    lines.sort(reverse=True)
+    while lines:
+        yield lines.pop()
 
-        # If transformed columns contain non-blank 'gandalf_ignore' value,
-        # then skip this row
-        if raw_row.get(ignore_column, "").strip() != "":
-            continue
 
-        # Row after processing
-        row = {}
+# Special values of 'mac' column in HostTable: empty MAC address
+# and flag bit of upper case MAC address
+_MAC_EMPTY = 1 << 49
+_MAC_UPPER = 1 << 48
 
-        # For every column and value in row
-        for colname, value in raw_row.items():
 
-            # Transfrom column name and strip column value
-            new_colname = colname_map[colname]
-            value = value.strip()
+def _encode_ip(ip):
+    n = ip_to_int(ip)
+    if int_to_ip(n) != ip:
+        raise ValueError("IP address is not in canonical form: {!r}".format(ip))
+    return n
 
-            # Check if value is valid
-            try:
-                is_valid = column_validators.get(new_colname, lambda x: True)(value)
-            except ValueError:
-                is_valid = False
-            if not is_valid:
-                raise CsvIntegrityError("invalid value: {} (row {}, column '{}')"
-                                        .format(repr(value), n, colname))
 
-            # Update column name and value
-            row[new_colname] = column_transformers.get(new_colname, lambda x: x)(value)
+def _encode_mac(mac):
+    if mac == "":
+        return _MAC_EMPTY
+    n = mac_to_int(mac)
+    if mac == int_to_mac(n):
+        return n
+    if mac == int_to_mac(n, upper=True):
+        return n | _MAC_UPPER
+    raise ValueError("MAC address is in mixed case: {!r}".format(mac))
 
-        # Append this row to the resulting list of rows
-        rows.append(row)
 
-    # Yay, seems ok
-    return rows
+def _decode_mac(n):
+    if n == _MAC_EMPTY:
+        return ""
+    return int_to_mac(n & ~_MAC_UPPER, upper=bool(n & _MAC_UPPER))
 
 
-def find_templates(inpath, outpath, dnspath):
+def _encode_int(low, high, none_value=None):
     '''
-        Recursively find all template files in a given inpath
-        and yield tuples of (template_path, output_path, dns_path).
-        Parameters:
-            inpath - path to template file or directory with those files
-            outpath - base path of output files
-            dnspath - base path of existing DNS files
-        Returns:
-            For each found template file yield a tuple of
-            (template_path, output_path, dns_path), where the first value
-            is path to found template file, second value is
-            a path to the output file for this template,
-            an third value is just the same file under dnspath
+        Make encoder of integer column values in range [low, high].
+        If none_value is given, None is stored as none_value.
     '''
-    if not os.path.isdir(inpath):
-        if not os.path.isdir(outpath):
-            outfile = outpath
-        else:
-            outfile = os.path.join(outpath, os.path.basename(inpath))
-        if '\000' in dnspath or not os.path.isdir(dnspath):
-            dnsfile = dnspath
-        else:
-            dnsfile = os.path.join(dnspath, os.path.basename(inpath))
-        yield (inpath, outfile, dnsfile)
-    else:
-        for root, dirs, files in os.walk(inpath):
-            for filename in files:
-                template_path = os.path.join(root, filename)
-                output_path = os.path.join(outpath, root[len(inpath):].strip("/"), filename)
-                dns_path = os.path.join(dnspath, root[len(inpath):].strip("/"), filename)
-                yield template_path, output_path, dns_path
+    def encode(value):
+        if value is None and none_value is not None:
+            return none_value
+        if type(value) is not int or not low <= value <= high or value == none_value:
+            raise ValueError("value is out of range: {!r}".format(value))
+        return value
+    return encode
+
 
+def _decode_optional_int(n):
+    return n or None
 
-def apply_dns_version_hack(text, dnsfile):
+
+def _ip_in_range(value, low, high):
     '''
-        Replace DNS_HACK_ANCHOR with an appropriate DNS file version number.
-        Parameters:
-            text - string conraining rendered template
-            dnsfile - path to dns file that rendered template is compared against
-                (does not need to be existing file or even a valid DNS zone file)
-        Returns:
-            text where DNS_HACK_ANCHOR is replaced with DNS file version
+        Check that IP address is within range of integers [low, high].
+        This function is recognized by HostDB, which answers
+        queries that use it from IP address index.
     '''
-    # Candidate for a current version of file if changed
-    version_candidate = int(datetime.datetime.strftime(datetime.datetime.now(), "%Y%m%d") + "00")
-
     try:
-        with open(dnsfile, "r") as f:
-            old_text = f.read()
-    except (IOError, ValueError, TypeError):
-        changed = True # consider that the file has changed
-        old_version = 0 # fake last version of a file
-    else:
-        old_version = parse_dns_version(old_text)
-        changed = dns_changed(text, old_text) or not old_version
+        return low <= ip_to_int(value) <= high
+    except (ValueError, AttributeError):
+        return False
 
-    if changed:
-        if version_candidate <= old_version:
-            version = old_version + 1
-        else:
-            version = version_candidate
-        return text.replace(DNS_HACK_ANCHOR, str(version))
-    else:
-        return text.replace(DNS_HACK_ANCHOR, str(old_version))
 
-
-def dns_changed(this_dns, other_dns):
+class HostQuery(tinydb.Query):
     '''
-        Return True if there is something different between the two DNS file texts.
-        Parameters:
-            this_dns, other_dns - DNS file contents to compare
-        Returns:
-            True or False
+        TinyDB query with additional tests for IP address columns.
+        It is available in templates as 'host'.
     '''
-    # Define a function to preprocess DNS files
-    line_codephrase = DNS_HACK_COMMENT.split()[-1]
-    def signature(text):
-        lines = (" ".join(line.split(";")[0].strip().split())
-                for line in text.split('\n') if line_codephrase not in line)
-        return " ".join(line for line in lines if line)
 
-    # Compare signatures and return results
-    return signature(this_dns) != signature(other_dns)
+    def in_range(self, first, last):
+        '''
+            Test that IP address is within range, e.g.
+            host.ip.in_range("10.0.0.10", "10.0.0.99")
+            Parameters:
+                first, last - the first and the last IP address of range
+            Raises:
+                ValueError if addresses are not valid
+        '''
+        return self.test(_ip_in_range, ip_to_int(first), ip_to_int(last))
+
+    def in_subnet(self, cidr):
+        '''
+            Test that IP address belongs to a network, e.g.
+            host.ip.in_subnet("10.20.0.0/22")
+            Parameters:
+                cidr - network address and prefix length
+            Raises:
+                ValueError if network is not valid or has host bits set
+        '''
+        network = ipaddress.IPv4Network(cidr)
+        return self.test(_ip_in_range, int(network.network_address),
+                         int(network.broadcast_address))
 
 
-def parse_dns_version(text):
+class HostTable:
     '''
-        Get dns version from DNS zone file text.
-        Parameters:
-            text - DNS file contents
-        Returns:
-            DNS zone number or 0 if not found
+        Compact columnar table of hosts.
+        Values of every column are stored in a single array instead of
+        a dict per host. Columns 'ip', 'mac', 'vlan' and 'mask' (and derived
+        columns 'ip_int' and 'broadcast', see derive_columns) are stored
+        as integers (IP and MAC addresses are converted back to strings on
+        access), all the other columns are dictionary-encoded: every distinct
+        value is stored only once and rows keep integer codes of values.
+        If some value can not be stored in integer form, the whole column
+        falls back to dictionary encoding, so rows read from the table are
+        always the same as rows it was built from.
     '''
-    line_codephrase = DNS_HACK_COMMENT.split()[-1]
-    try:
-        line = next(line for line in text.split('\n') if line_codephrase in line)
-    except StopIteration:
-        return 0
-    try:
-        return int(line.split(";")[0].split()[-1])
-    except (ValueError, IndexError):
-        return 0
 
+    # Integer columns: array typecode, encoder and decoder of values
+    INTEGER_COLUMNS = {
+        "ip": ("L", _encode_ip, int_to_ip),
+        "mac": ("Q", _encode_mac, _decode_mac),
+        "vlan": ("H", _encode_int(1, 65535, none_value=0), _decode_optional_int),
+        "mask": ("B", _encode_int(0, 32), int),
+        "ip_int": ("L", _encode_int(0, 0xFFFFFFFF), int),
+        "broadcast": ("L", _encode_ip, int_to_ip)
+    }
 
-def main():
+    def __init__(self, rows):
+        '''
+            Build table from rows. Rows may have different keys (e.g. if
+            they come from files with different columns): a column is None
+            in the rows that lack it.
+            Parameters:
+                rows - iterable of dicts (e.g. as yielded by iter_csv)
+            Raises:
+                TypeError if some value is not hashable
+        '''
+        self._length = 0
+        self._columns = {} # column name -> array of values or codes
+        self._decoders = {} # column name -> function that decodes array item
+        self._values = {} # column name -> list of values of dictionary-encoded column
+        self._codes = {} # column name -> dict that maps value to its code (while building)
 
-    # Define command line arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument("csvfile", help="CSV file containing hosts")
-    parser.add_argument("templates", help="template file or directory")
-    parser.add_argument("output", help="output file or directory")
-    parser.add_argument("-d", "--dnsdir", metavar="DNSDIR", default="\000",
-                        help="directory with the old DNS files")
-    parser.add_argument("-v", "--var", metavar="VARFILE",
-                        help="yaml file with variables")
+        for row in rows:
+            for colname in row:
+                if colname not in self._columns:
+                    self._add_column(colname)
+            for colname in self._columns:
+                self._append(colname, row.get(colname))
+            self._length += 1
 
-    # Parse arguments
-    args = parser.parse_args()
+        # Mapping of values to codes is needed only while building
+        self._codes = None
 
-    # Configure logging
-    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    def _add_column(self, colname):
+        '''
+            Add column that is None in the rows that are already in the table.
+        '''
+        if colname in self.INTEGER_COLUMNS:
+            typecode, _, decoder = self.INTEGER_COLUMNS[colname]
+            self._columns[colname] = array.array(typecode)
+            self._decoders[colname] = decoder
+        else:
+            self._make_dictionary_column(colname)
+        for _ in range(self._length):
+            self._append(colname, None)
 
-    # Parse CSV file
-    try:
-        hosts = parse_csv(args.csvfile)
-    except IOError as exc:
-        logging.fatal("unable to open '{}': {}".format(args.csvfile, exc.strerror))
-        return sys.exit(1)
-    except csv.Error:
-        logging.fatal("unable to parse csv file")
-        return sys.exit(2)
-    except CsvIntegrityError as exc:
-        logging.fatal("error in csv file: {}".format(exc))
-        return sys.exit(3)
+    def _append(self, colname, value):
+        '''
+            Append value to column. Integer column that gets a value it can not
+            store is made dictionary-encoded.
+        '''
+        column = self._columns[colname]
+        if colname in self._values:
+            column.append(self._encode(colname, value))
+            return
+        try:
+            column.append(self.INTEGER_COLUMNS[colname][1](value))
+        except (ValueError, TypeError, AttributeError, OverflowError):
+            self._make_dictionary_column(colname)
+            self._columns[colname].append(self._encode(colname, value))
 
-    # Create in-memory database from the list of network entities
-    db = tinydb.TinyDB(storage=tinydb.storages.MemoryStorage)
-    db.insert_multiple(hosts)
+    def _make_dictionary_column(self, colname):
+        '''
+            Make column dictionary-encoded. Values that are
+            already in the column are re-encoded.
+        '''
+        old_values = [self.value(pos, colname) for pos in range(len(self._columns[colname]))] \
+                     if colname in self._columns else []
+        self._columns[colname] = array.array("L")
+        self._decoders[colname] = self._values[colname] = []
+        self._codes[colname] = {}
+        for value in old_values:
+            self._columns[colname].append(self._encode(colname, value))
 
-    # Parse variables file (if given)
-    if args.var:
-        try:
-            with open(args.var, "r") as f:
-                var = yaml.load(f)
-        except IOError as exc:
-            logging.fatal("unable to open '{}': {}".format(args.var, exc.strerror))
-            return sys.exit(4)
-        except yaml.error.YAMLError as exc:
-            logging.fatal("yaml error: {}".format(exc))
-            return sys.exit(5)
-    else:
-        var = {}
+    def _encode(self, colname, value):
+        '''
+            Get code of a value in dictionary-encoded column.
+        '''
+        codes = self._codes[colname]
+        key = (type(value), value) # so that 1, 1.0 and True are different
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(self._values[colname])
+            self._values[colname].append(value)
+        return code
 
-    # Iterate over each input/output path pair
-    # There is also a hack with iterating over files in DNS directory in parallel
-    for infile, outfile, dnsfile in find_templates(args.templates, args.output, args.dnsdir):
+    def __len__(self):
+        return self._length
 
-        # Strip '.mako' extension if present
-        if outfile.endswith(".mako"):
-            outfile = outfile[:-len(".mako")]
-        if dnsfile.endswith(".mako"):
-            dnsfile = dnsfile[:-len(".mako")]
+    def __iter__(self):
+        return (self.row(pos) for pos in range(self._length))
 
-        # Create template
-        try:
-            template = mako.template.Template(filename=infile)
-        except IOError as exc:
-            logging.error("unable to open '{}': {}".format(infile, exc.strerror))
-            continue
-        except mako.exceptions.MakoException as exc:
-            logging.error("template error while reading '{}': {}".format(infile, exc))
-            continue
+    @property
+    def columns(self):
+        '''
+            List of column names.
+        '''
+        return list(self._columns)
 
-        # Render template
-        try:
-            output = template.render_unicode(var=var, db=db, host=tinydb.Query(),
-                    view=ViewSet(), FILE_NAME=os.path.basename(outfile),
-                    get_dns_version=lambda: DNS_HACK_ANCHOR + DNS_HACK_COMMENT)
-        except Exception:
-            tb = mako.exceptions.text_error_template().render().strip()
-            logging.error("unhandled exception while rendering template '{}':\n{}"
-                          .format(infile, tb))
-            continue
+    def value(self, pos, colname):
+        '''
+            Get value of a column in a row.
+            Parameters:
+                pos - row number, starting from 0
+                colname - column name
+            Raises:
+                KeyError if there is no such column
+                IndexError if there is no such row
+        '''
+        decoder = self._decoders[colname]
+        code = self._columns[colname][pos]
+        return decoder[code] if isinstance(decoder, list) else decoder(code)
 
-        # Apply DNS version hack if needed
-        if DNS_HACK_ANCHOR in output:
-            output = apply_dns_version_hack(output, dnsfile)
+    def row(self, pos):
+        '''
+            Get row as a dict.
+            Parameters:
+                pos - row number, starting from 0
+        '''
+        return {colname: self.value(pos, colname) for colname in self._columns}
 
-        # Make parent directories if they do not exist
-        dirname = os.path.dirname(outfile)
-        if dirname:
-            try:
-                os.makedirs(dirname, exist_ok=True)
-            except OSError as exc:
-                logging.error("could not create directory '{}': {}".format(dirname, exc.strerror))
-                continue
+    def integers(self, colname):
+        '''
+            Get array of integer column (e.g. IP addresses as 32-bit integers).
+            Returns None if column does not exist or is not stored as integers.
+        '''
+        if colname in self._values:
+            return None
+        return self._columns.get(colname)
 
-        # Write rendered template
-        try:
-            with open(outfile, "w", encoding="utf8") as f:
-                f.write(output)
-        except IOError as exc:
-            logging.error("could not write to file '{}': {}".format(outfile, exc.strerror))
-            continue
+    def distinct(self, colname):
+        '''
+            Get list of distinct values of dictionary-encoded column along
+            with array of codes, i.e. indexes in that list, for every row.
+            Returns None if column does not exist or is not dictionary-encoded.
+        '''
+        if colname not in self._values:
+            return None
+        return self._values[colname], self._columns[colname]
+
+
+class HostRecord(tinydb.table.Document):
+    '''
+        Document that is read from HostDB. Besides column values it carries
+        IP address as integer in 'ip_int' attribute (if it is read from
+        HostTable), so that views do not have to parse it again, and
+        'ip_shared' attribute that tells whether other hosts have
+        the same IP address (see HostDB.conflicts). Record that a template
+        changes gets 'modified' attribute set, so that it is not taken for
+        the row it was read from (see MemoizingViewSet).
+    '''
+
+    # Set on the few records whose IP address is shared
+    ip_shared = False
+
+    # Set once the record is changed
+    modified = False
+
+    def __init__(self, value, doc_id, ip_int=None):
+        super().__init__(value, doc_id)
+        self.ip_int = ip_int
+
+    def _modifying(method):
+        @functools.wraps(method)
+        def modify(self, *args, **kw):
+            self.modified = True
+            return method(self, *args, **kw)
+        return modify
+
+    __setitem__ = _modifying(dict.__setitem__)
+    __delitem__ = _modifying(dict.__delitem__)
+    __ior__ = _modifying(dict.__ior__)
+    clear = _modifying(dict.clear)
+    pop = _modifying(dict.pop)
+    popitem = _modifying(dict.popitem)
+    setdefault = _modifying(dict.setdefault)
+    update = _modifying(dict.update)
+    del _modifying
+
+
+class HostDB:
+    '''
+        In-memory read-only database of hosts. It implements the querying
+        part of TinyDB interface (all, search, get, count, contains), so that
+        templates can use it along with tinydb.Query() objects. Unlike TinyDB
+        it keeps hash indexes on frequently queried columns and a sorted index
+        of IP addresses: equality and membership conditions on those columns
+        and HostQuery.in_subnet/in_range conditions (possibly combined with '&'
+        and '|') are answered from indexes instead of evaluating the query
+        against every single host.
+        Hosts are stored either as a list of dicts or in a HostTable.
+        In the latter case queries are evaluated only against the columns
+        they refer to, not against whole rows.
+    '''
+
+    # Columns that are indexed by default
+    INDEXED_COLUMNS = ("vlan", "type", "entity_type", "domain", "cluster", "hostname")
+
+    def __init__(self, hosts, indexed_columns=INDEXED_COLUMNS, sources=None):
+        '''
+            Load hosts into database and build indexes.
+            Parameters:
+                hosts - HostTable or iterable of dicts (e.g. as returned by parse_csv)
+                indexed_columns - names of columns to build indexes on
+                sources - where hosts come from (optional): tuple of list of
+                          paths to CSV files, array of indexes into that list
+                          and array of row numbers, one item per host
+                          (see merge_csv_files)
+        '''
+        if isinstance(hosts, HostTable):
+            self._table = hosts
+            self._docs = None
+            self._length = len(hosts)
+            ips = hosts.integers("ip")
+            self._ip_ints = ips if ips is not None and len(ips) == len(hosts) else None
+        else:
+            self._table = None
+            self._docs = [tinydb.table.Document(host, doc_id)
+                          for doc_id, host in enumerate(hosts, start=1)]
+            self._length = len(self._docs)
+        self._sources = sources
+
+        # Every index maps column value to ascending array of positions
+        # of documents that have this value. A value that only one document
+        # has is mapped to its position directly to save memory.
+        self._indexes = {}
+        for colname in indexed_columns:
+            if self._table is not None:
+                if colname not in self._table.columns:
+                    continue
+                items = ((pos, self._table.value(pos, colname)) for pos in range(self._length))
+            else:
+                items = ((pos, doc[colname]) for pos, doc in enumerate(self._docs) if colname in doc)
+            index = {}
+            try:
+                for pos, value in items:
+                    positions = index.get(value)
+                    if positions is None:
+                        index[value] = pos
+                    elif isinstance(positions, int):
+                        index[value] = [positions, pos]
+                    else:
+                        positions.append(pos)
+            except TypeError:
+                continue # unhashable values, column can not be indexed
+            for value, positions in index.items():
+                if not isinstance(positions, int):
+                    index[value] = array.array("L", positions)
+            self._indexes[colname] = index
+
+        # Sorted index of IP addresses: ascending array of IP addresses
+        # as integers and array of positions of their documents
+        if self._table is None:
+            items = ((pos, doc["ip"]) for pos, doc in enumerate(self._docs) if "ip" in doc)
+        elif self._table.integers("ip") is not None:
+            items = enumerate(self._table.integers("ip"))
+        elif "ip" in self._table.columns:
+            items = ((pos, self._table.value(pos, "ip")) for pos in range(self._length))
+        else:
+            items = ()
+        ip_index = []
+        for pos, ip in items:
+            if not isinstance(ip, int):
+                try:
+                    ip = ip_to_int(ip)
+                except (ValueError, AttributeError):
+                    continue # such rows never match range conditions
+            ip_index.append((ip, pos))
+        ip_index.sort()
+        self._ip_keys = array.array("L", (ip for ip, pos in ip_index))
+        self._ip_positions = array.array("L", (pos for ip, pos in ip_index))
+
+        # Partitions of hosts into groups, see _partition
+        self._partitions = {}
+
+        # Values that several hosts have, see conflicts
+        self._conflicts = self._find_conflicts()
+        self._shared_ips = frozenset(pos for kind, _, positions in self._conflicts
+                                     if kind == "IP address" for pos in positions)
+
+    def _find_conflicts(self):
+        '''
+            Find IP addresses, MAC addresses (ignoring case) and host names
+            (hostname.domain) that several hosts have, in a single pass over
+            the hosts. Equal IP addresses are next to each other in the sorted
+            index, and only hosts with equal hostnames need their host names
+            checked if hostname column is indexed.
+            Returns:
+                list of (kind, value, positions) tuples (see conflicts)
+        '''
+        def values(colname, positions):
+            if self._table is None:
+                return [self._docs[pos].get(colname) for pos in positions]
+            if colname not in self._table.columns:
+                return [None] * len(positions)
+            return [self._table.value(pos, colname) for pos in positions]
+
+        def shared(positions, values):
+            # Values are hashed once more only if some of them repeat
+            present = [value for value in values if value]
+            if len(set(present)) == len(present):
+                return ()
+            first, shared = {}, {}
+            for pos, value in zip(positions, values):
+                if value:
+                    other = first.setdefault(value, pos)
+                    if other != pos:
+                        shared.setdefault(value, [other]).append(pos)
+            return shared.items()
+
+        conflicts = []
+        keys, positions = self._ip_keys, self._ip_positions
+        if len(set(keys)) != len(keys):
+            ips = {}
+            for n in range(1, len(keys)):
+                if keys[n] == keys[n - 1]:
+                    ips.setdefault(keys[n], [positions[n - 1]]).append(positions[n])
+            conflicts.extend(("IP address", int_to_ip(ip), sorted(positions))
+                             for ip, positions in ips.items())
+
+        everyone = range(self._length)
+        macs = self._table.integers("mac") if self._table is not None else None
+        if macs is not None:
+            macs = [n & ~_MAC_UPPER if n != _MAC_EMPTY else None for n in macs]
+            conflicts.extend(("MAC address", int_to_mac(mac), positions)
+                             for mac, positions in shared(everyone, macs))
+        else:
+            macs = [str(mac).lower() if mac else None for mac in values("mac", everyone)]
+            conflicts.extend(("MAC address", mac, positions)
+                             for mac, positions in shared(everyone, macs))
+
+        if "hostname" in self._indexes:
+            candidates = sorted(pos for positions in self._indexes["hostname"].values()
+                                if type(positions) is not int for pos in positions)
+        else:
+            candidates = everyone
+        names = ["{}.{}".format(hostname, domain) if hostname else None
+                 for hostname, domain in zip(values("hostname", candidates),
+                                             values("domain", candidates))]
+        conflicts.extend(("host name", name, positions)
+                         for name, positions in shared(candidates, names))
+
+        conflicts.sort(key=lambda conflict: (conflict[2][0], conflict[0]))
+        return conflicts
+
+    def conflicts(self):
+        '''
+            Get IP addresses, MAC addresses and host names (hostname.domain)
+            that several hosts have. They are found once, when the database
+            is built, so that this is not checked over and over again.
+            Returns:
+                list of (kind, value, doc_ids) tuples, where kind is 'IP address',
+                'MAC address' or 'host name' and doc_ids is ascending list of ids
+                of the hosts that have the value, ordered by the first host
+        '''
+        return [(kind, value, [pos + 1 for pos in positions])
+                for kind, value, positions in self._conflicts]
+
+    def _positions(self, colname, value):
+        '''
+            Get positions of documents that have given value in indexed column.
+            Raises KeyError if column is not indexed and TypeError
+            if value is not hashable.
+        '''
+        positions = self._indexes[colname].get(value, ())
+        return (positions,) if isinstance(positions, int) else positions
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def source(self, doc_id):
+        '''
+            Find out where a document comes from.
+            Returns:
+                tuple of path to CSV file and row number, or None
+                if it is unknown or there is no such document
+        '''
+        if self._sources is None or not 1 <= doc_id <= self._length:
+            return None
+        files, indexes, row_numbers = self._sources
+        return files[indexes[doc_id - 1]], row_numbers[doc_id - 1]
+
+    @staticmethod
+    def parse_group_key(key):
+        '''
+            Parse key that hosts are grouped by: either a column name
+            or 'ip/N' to group hosts by IP networks with prefix length N.
+            Returns:
+                column name or (column name, prefix length) tuple
+            Raises:
+                ValueError if key is not valid
+        '''
+        colname, slash, prefix = key.strip().partition("/")
+        if not colname or colname != colname.strip() or " " in colname:
+            raise ValueError("invalid group key: '{}'".format(key))
+        if not slash:
+            return colname
+        if colname != "ip" or not prefix.isdigit() or not 0 < int(prefix) <= 32:
+            raise ValueError("invalid group key: '{}' (use 'ip/N' with N from 1 to 32)".format(key))
+        return colname, int(prefix)
+
+    def _partition(self, key):
+        '''
+            Partition hosts into groups by key (see parse_group_key) in
+            a single pass over the table, or straight from the index of
+            the column. Hosts with empty or missing value are left out.
+            Partitions are kept, so hosts are grouped only once per key.
+            Returns:
+                dict mapping group name (string value of the column or
+                network address) to ascending array of positions of hosts
+            Raises:
+                ValueError if key is not valid
+        '''
+        partition = self._partitions.get(key)
+        if partition is not None:
+            return partition
+        parsed = self.parse_group_key(key)
+
+        # Find positions of hosts with every value
+        if isinstance(parsed, tuple):
+            mask = (0xFFFFFFFF << (32 - parsed[1])) & 0xFFFFFFFF
+            groups = {}
+            for ip, pos in zip(self._ip_keys, self._ip_positions):
+                groups.setdefault(ip & mask, []).append(pos)
+            groups = ((int_to_ip(network), positions) for network, positions in groups.items())
+        elif parsed in self._indexes:
+            groups = ((value, (positions,) if isinstance(positions, int) else positions)
+                      for value, positions in self._indexes[parsed].items())
+        else:
+            if self._table is None:
+                items = ((pos, doc[parsed]) for pos, doc in enumerate(self._docs) if parsed in doc)
+            elif parsed in self._table.columns:
+                items = ((pos, self._table.value(pos, parsed)) for pos in range(self._length))
+            else:
+                items = ()
+            groups = {}
+            for pos, value in items:
+                groups.setdefault("" if value is None else str(value), []).append(pos)
+            groups = groups.items()
+
+        # Name groups after values, leaving out empty ones
+        partition = {}
+        for value, positions in groups:
+            name = str(value) if value is not None else ""
+            if name.strip():
+                partition.setdefault(name, array.array("L")).extend(positions)
+        for name, positions in partition.items():
+            partition[name] = array.array("L", sorted(positions))
+        self._partitions[key] = partition
+        return partition
+
+    def group_names(self, key):
+        '''
+            Get sorted names of groups of hosts, see _partition.
+            Raises:
+                ValueError if key is not valid
+        '''
+        return sorted(self._partition(key))
+
+    def group(self, key, name):
+        '''
+            Get hosts of a group as a read-only database (see HostGroup).
+            Raises:
+                ValueError if key is not valid
+                KeyError if there is no such group
+        '''
+        return HostGroup(self, self._partition(key)[name])
+
+    def _doc(self, pos):
+        '''
+            Make a new document from a row at given position.
+        '''
+        if self._table is None:
+            doc = HostRecord(self._docs[pos], pos + 1)
+        else:
+            ip_int = self._ip_ints[pos] if self._ip_ints is not None else None
+            doc = HostRecord(self._table.row(pos), pos + 1, ip_int)
+        if pos in self._shared_ips:
+            doc.ip_shared = True
+        return doc
+
+    def _lookup(self, query_hash):
+        '''
+            Find positions of documents that may match the query
+            using indexes only.
+            Parameters:
+                query_hash - structural description of TinyDB query
+                             (the '_hash' attribute of the query)
+            Returns:
+                set of positions that is a superset of positions of all
+                the matching documents or None if indexes can not
+                narrow the query down
+        '''
+        try:
+            op = query_hash[0]
+            if op == "==" and len(query_hash[1]) == 1:
+                return set(self._positions(query_hash[1][0], query_hash[2]))
+            if op == "one_of" and len(query_hash[1]) == 1 \
+                    and isinstance(query_hash[2], (tuple, frozenset)):
+                colname = query_hash[1][0]
+                return set(pos for value in query_hash[2] for pos in self._positions(colname, value))
+        except (TypeError, KeyError, IndexError):
+            return None # not a query, unknown column or unhashable value
+
+        if op == "test" and query_hash[1] == ("ip",) and query_hash[2] is _ip_in_range:
+            low, high = query_hash[3]
+            first = bisect.bisect_left(self._ip_keys, low)
+            last = bisect.bisect_right(self._ip_keys, high)
+            return set(self._ip_positions[first:last])
+        if op == "and":
+            subsets = [self._lookup(sub_hash) for sub_hash in query_hash[1]]
+            subsets = [subset for subset in subsets if subset is not None]
+            return set.intersection(*subsets) if subsets else None
+        if op == "or":
+            subsets = [self._lookup(sub_hash) for sub_hash in query_hash[1]]
+            if not subsets or None in subsets:
+                return None
+            return set.union(*subsets)
+        return None
+
+    @staticmethod
+    def _query_columns(query_hash):
+        '''
+            Find names of columns that the query refers to.
+            Returns set of column names or None if it is unknown.
+        '''
+        if query_hash == ():
+            return set() # noop
+        if not isinstance(query_hash, tuple):
+            return None
+        op = query_hash[0]
+        if op in ("and", "or"):
+            columns = [HostDB._query_columns(sub_hash) for sub_hash in query_hash[1]]
+            return None if None in columns else set.union(set(), *columns)
+        if op == "not":
+            return HostDB._query_columns(query_hash[1])
+        if op == "fragment":
+            return set(query_hash[1])
+        path = query_hash[1]
+        if isinstance(path, tuple) and path and isinstance(path[0], str):
+            return {path[0]}
+        return None
+
+    def _candidates(self, query_hash):
+        '''
+            Get ascending positions of documents that may match the query.
+        '''
+        positions = self._lookup(query_hash)
+        return range(self._length) if positions is None else sorted(positions)
+
+    def _matching(self, cond):
+        '''
+            Yield positions of documents that match the condition,
+            in insertion order.
+        '''
+        query_hash = getattr(cond, "_hash", None)
+        positions = self._candidates(query_hash)
+
+        if self._table is None:
+            docs = self._docs
+            return (pos for pos in positions if cond(docs[pos]))
+
+        # Evaluate query against the columns it refers to only
+        columns = self._query_columns(query_hash)
+        if columns is None:
+            return (pos for pos in positions if cond(self._table.row(pos)))
+        columns &= set(self._table.columns)
+        value = self._table.value
+        return (pos for pos in positions
+                if cond({colname: value(pos, colname) for colname in columns}))
+
+    def all(self):
+        '''
+            Get all the documents in insertion order.
+        '''
+        return [self._doc(pos) for pos in range(self._length)]
+
+    def search(self, cond):
+        '''
+            Get all the documents matching a condition, in insertion order.
+            Parameters:
+                cond - TinyDB query or any callable that accepts a document
+        '''
+        return [self._doc(pos) for pos in self._matching(cond)]
+
+    def get(self, cond=None, doc_id=None):
+        '''
+            Get the first document matching a condition or a document
+            with given id. Return None if there is no such document.
+        '''
+        if doc_id is not None:
+            if 1 <= doc_id <= self._length:
+                return self._doc(doc_id - 1)
+            return None
+        if cond is None:
+            raise RuntimeError("You have to pass either cond or doc_id")
+        for pos in self._matching(cond):
+            return self._doc(pos)
+        return None
+
+    def documents(self, doc_ids):
+        '''
+            Get documents with given ids at once (e.g. ids of a result
+            that MemoizingDB has cached), in the same order.
+            Parameters:
+                doc_ids - iterable of ids of existing documents
+        '''
+        return [self._doc(doc_id - 1) for doc_id in doc_ids]
+
+    def count(self, cond):
+        '''
+            Count the documents matching a condition.
+        '''
+        return sum(1 for pos in self._matching(cond))
+
+    def contains(self, cond=None, doc_id=None):
+        '''
+            Check whether there is a document matching a condition
+            or a document with given id.
+        '''
+        return self.get(cond, doc_id) is not None
+
+
+class HostGroup(HostDB):
+    '''
+        Read-only view of a group of hosts of HostDB (see HostDB.group).
+        It shares hosts and indexes with the database, so it is cheap
+        to make: queries are answered from the indexes of the database,
+        restricted to the hosts of the group. Documents keep their ids.
+    '''
+
+    def __init__(self, db, positions):
+        '''
+            Parameters:
+                db - HostDB instance
+                positions - ascending array of positions of hosts of the group
+        '''
+        vars(self).update(vars(db)) # hosts, indexes and the rest of the state
+        self._db = db
+        self._group = positions
+        self._members = frozenset(positions)
+        self._partitions = {}
+
+    def __len__(self):
+        return len(self._group)
+
+    def _contains_id(self, doc_id):
+        return isinstance(doc_id, int) and doc_id - 1 in self._members
+
+    def _candidates(self, query_hash):
+        positions = self._lookup(query_hash)
+        return self._group if positions is None else sorted(positions.intersection(self._members))
+
+    def _partition(self, key):
+        partition = self._partitions.get(key)
+        if partition is None:
+            partition = self._partitions[key] = {}
+            for name, positions in self._db._partition(key).items():
+                positions = array.array("L", (pos for pos in positions if pos in self._members))
+                if positions:
+                    partition[name] = positions
+        return partition
+
+    def source(self, doc_id):
+        return super().source(doc_id) if self._contains_id(doc_id) else None
+
+    def all(self):
+        return [self._doc(pos) for pos in self._group]
+
+    def get(self, cond=None, doc_id=None):
+        if doc_id is not None and not self._contains_id(doc_id):
+            return None
+        return super().get(cond, doc_id)
+
+
+# Query operators that SqliteHostDB translates into SQL
+_SQL_EQUALITY_OPS = {"==": ("=", "IS NULL"), "!=": ("IS NOT", "IS NOT NULL")}
+_SQL_ORDER_OPS = ("<", "<=", ">", ">=")
+
+# Query operators that test a value at a path, so that they
+# are false for rows that do not have the column
+_PATH_OPS = ("==", "!=", "<", "<=", ">", ">=", "exists", "one_of", "test",
+             "matches", "search", "any", "all")
+
+
+class SqliteHostDB:
+    '''
+        Read-only database of hosts kept in SQLite database file instead of
+        memory, for inventories that do not fit in memory. It implements
+        the same interface as HostDB, including groups and conflicts.
+        Rows are inserted in bulk when the database is built (see create),
+        and frequently queried columns and IP addresses are indexed.
+        Conditions that compare a column with a value ('==', '!=', '<' etc,
+        one_of, exists and HostQuery.in_subnet/in_range, possibly combined
+        with '&', '|' and '~') are translated into SQL. Other conditions
+        (e.g. test, matches or any callable) are evaluated in Python against
+        rows read one by one, after translatable parts of '&' have narrowed
+        them down. Documents are read in insertion order.
+    '''
+
+    # Format version of database file
+    VERSION = 1
+
+    def __init__(self, path):
+        '''
+            Open database file built by create.
+            Raises:
+                sqlite3.Error if file can not be opened or is not a database
+                ValueError if file was not built by this version of Gandalf
+        '''
+        self.path = path
+        self._connect()
+        try:
+            meta = {key: json.loads(value) for key, value in
+                    self._conn.execute("SELECT key, value FROM meta")}
+        except sqlite3.Error:
+            self._conn.close()
+            raise
+        if meta.get("version") != self.VERSION:
+            self._conn.close()
+            raise ValueError("not a hosts database of this version: '{}'".format(path))
+        self.digest = meta["digest"]
+        self._columns = meta["columns"] # column names, stored as c0, c1 etc
+        self._files = meta["files"] # paths of CSV files (None if unknown)
+        self._conflicts = [tuple(conflict) for conflict in meta["conflicts"]]
+        self._fields = ", ".join(["id", "ip_int", "ip_shared"] +
+                                 ["c{}".format(n) for n in range(len(self._columns))])
+        self._restriction = ("1", ()) # SQL condition of hosts of a group
+        self._length = None
+        self._partitions = {}
+
+    def _connect(self):
+        uri = "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(self.path)))
+        self._conn = sqlite3.connect(uri, uri=True)
+
+    def __getstate__(self):
+        # Connection is opened again in every process (e.g. render_parallel workers)
+        state = dict(vars(self))
+        del state["_conn"]
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self._connect()
+
+    @classmethod
+    def create(cls, path, hosts, sources=None, digest=None, indexed_columns=HostDB.INDEXED_COLUMNS):
+        '''
+            Build database file from hosts and open it. Rows are inserted
+            in a single pass, so they are never kept in memory all at once.
+            The file is built under a temporary name, which then replaces
+            the file atomically.
+            Parameters:
+                path - path to database file
+                hosts - iterable of dicts (e.g. as yielded by merge_csv_files);
+                        columns that some of them lack are None in those rows
+                sources - where hosts come from (optional, see HostDB); it may be
+                          filled in while hosts are iterated
+                digest - JSON serializable description of what the database
+                         is built from, available as 'digest' attribute
+                indexed_columns - names of columns to build indexes on
+            Returns:
+                SqliteHostDB instance
+            Raises:
+                IOError if unable to write database file
+        '''
+        tmp_path = _atomic_tmp_path(path)
+        _unlink_quietly(tmp_path)
+        try:
+            conn = sqlite3.connect(tmp_path)
+            try:
+                cls._build(conn, hosts, sources, digest, indexed_columns)
+            finally:
+                conn.close()
+            _replace_atomic(tmp_path, path)
+        except sqlite3.Error as exc:
+            _unlink_quietly(tmp_path)
+            raise IOError(errno.EIO, "unable to write database: {}".format(exc), path) from exc
+        except BaseException:
+            _unlink_quietly(tmp_path)
+            raise
+        return cls(path)
+
+    @staticmethod
+    def _build(conn, hosts, sources, digest, indexed_columns):
+        '''
+            Fill empty database, see create.
+        '''
+        # Nobody sees the file before it is complete, so there is nothing to journal
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        columns = [] # column names in the order they are first seen
+        numbers = {} # column name -> its number
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE hosts (id INTEGER PRIMARY KEY, file INTEGER, row INTEGER, "
+                     "ip_int INTEGER, ip_shared INTEGER NOT NULL DEFAULT 0)")
+        hosts = iter(hosts)
+        doc_ids = itertools.count(1)
+
+        def records(host, stopped):
+            # Rows are inserted up to the one that has columns the table
+            # does not have yet, which is put into stopped
+            while host is not None:
+                if not all(colname in numbers for colname in host):
+                    stopped.append(host)
+                    return
+                doc_id = next(doc_ids)
+                try:
+                    ip_int = ip_to_int(host["ip"]) if "ip" in host else None
+                except (ValueError, AttributeError):
+                    ip_int = None # such rows never match range conditions
+                if sources is not None:
+                    source = (sources[1][doc_id - 1], sources[2][doc_id - 1])
+                else:
+                    source = (None, None)
+                yield (doc_id,) + source + (ip_int,) + tuple(host.get(colname) for colname in columns)
+                host = next(hosts, None)
+
+        with conn:
+            # Columns that some rows lack are NULL in those rows
+            host = next(hosts, None)
+            while host is not None:
+                for colname in host:
+                    if colname not in numbers:
+                        conn.execute("ALTER TABLE hosts ADD COLUMN c{}".format(len(columns)))
+                        numbers[colname] = len(columns)
+                        columns.append(colname)
+                stopped = []
+                conn.executemany("INSERT INTO hosts (id, file, row, ip_int{}) VALUES (?, ?, ?, ?{})"
+                                 .format("".join(", c{}".format(n) for n in range(len(columns))),
+                                         ", ?" * len(columns)), records(host, stopped))
+                host = stopped[0] if stopped else None
+            for colname in indexed_columns:
+                if colname in numbers:
+                    conn.execute("CREATE INDEX hosts_c{0} ON hosts (c{0})".format(numbers[colname]))
+            conn.execute("CREATE INDEX hosts_ip_int ON hosts (ip_int)")
+
+            conflicts = SqliteHostDB._find_conflicts(conn, numbers)
+            conn.executemany("UPDATE hosts SET ip_shared = 1 WHERE id = ?",
+                             ((doc_id,) for kind, _, doc_ids in conflicts
+                              if kind == "IP address" for doc_id in doc_ids))
+            conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", (
+                (key, json.dumps(value)) for key, value in [
+                    ("version", SqliteHostDB.VERSION), ("digest", digest), ("columns", columns),
+                    ("files", sources[0] if sources is not None else None),
+                    ("conflicts", conflicts)]))
+
+    @staticmethod
+    def _find_conflicts(conn, numbers):
+        '''
+            Find IP addresses, MAC addresses (ignoring case) and host names
+            that several hosts have, just like HostDB does it.
+            Parameters:
+                conn - connection to database being built
+                numbers - dict mapping column names to their numbers
+            Returns:
+                list of (kind, value, doc_ids) tuples (see HostDB.conflicts)
+        '''
+        def shared(expression, condition):
+            groups = {}
+            for value, doc_id in conn.execute("SELECT {0}, id FROM hosts WHERE {0} IN "
+                    "(SELECT {0} FROM hosts WHERE {1} GROUP BY {0} HAVING count(*) > 1) "
+                    "ORDER BY id".format(expression, condition)):
+                groups.setdefault(value, []).append(doc_id)
+            return groups.items()
+
+        conflicts = [("IP address", int_to_ip(ip), doc_ids)
+                     for ip, doc_ids in shared("ip_int", "ip_int IS NOT NULL")]
+        if "mac" in numbers:
+            mac = "c{}".format(numbers["mac"])
+            conflicts.extend(("MAC address", mac, doc_ids) for mac, doc_ids in
+                             shared("lower({})".format(mac), "{0} IS NOT NULL AND {0} != ''".format(mac)))
+        if "hostname" in numbers:
+            hostname = "c{}".format(numbers["hostname"])
+            domain = "c{}".format(numbers["domain"]) if "domain" in numbers else "NULL"
+            conflicts.extend(("host name", name, doc_ids) for name, doc_ids in shared(
+                "({} || '.' || IFNULL({}, 'None'))".format(hostname, domain),
+                "{0} IS NOT NULL AND {0} != ''".format(hostname)))
+        conflicts.sort(key=lambda conflict: (conflict[2][0], conflict[0]))
+        return conflicts
+
+    def conflicts(self):
+        '''
+            Get values that several hosts have, see HostDB.conflicts.
+        '''
+        return [(kind, value, list(doc_ids)) for kind, value, doc_ids in self._conflicts]
+
+    def _translate(self, query_hash):
+        '''
+            Translate condition into SQL.
+            Parameters:
+                query_hash - structural description of TinyDB query
+                             (the '_hash' attribute of the query)
+            Returns:
+                tuple of SQL expression and its parameters, or None if the
+                condition can not be translated
+        '''
+        if query_hash == ():
+            return "1", () # noop
+        if not isinstance(query_hash, tuple) or not query_hash:
+            return None
+        op = query_hash[0]
+        if op in ("and", "or"):
+            parts = [self._translate(sub_hash) for sub_hash in query_hash[1]]
+            if not parts or None in parts:
+                return None
+            return ("({})".format(" {} ".format(op.upper()).join(sql for sql, _ in parts)),
+                    tuple(param for _, params in parts for param in params))
+        if op == "not":
+            part = self._translate(query_hash[1])
+            if part is None:
+                return None
+            return "(NOT IFNULL({}, 0))".format(part[0]), part[1] # NULL is false, not unknown
+
+        # Conditions on a column
+        path = query_hash[1] if len(query_hash) > 1 else None
+        if op not in _PATH_OPS or not isinstance(path, tuple) or len(path) != 1 \
+                or not isinstance(path[0], str):
+            return None
+        if path[0] not in self._columns:
+            return "0", () # rows do not have the column
+        column = "c{}".format(self._columns.index(path[0]))
+        simple = (str, int, float, bool)
+        if op == "exists":
+            return "1", ()
+        if op in _SQL_EQUALITY_OPS:
+            value = query_hash[2]
+            if value is None:
+                return "({} {})".format(column, _SQL_EQUALITY_OPS[op][1]), ()
+            if isinstance(value, simple):
+                return "({} {} ?)".format(column, _SQL_EQUALITY_OPS[op][0]), (value,)
+        if op in _SQL_ORDER_OPS:
+            # Python does not compare strings with numbers
+            value = query_hash[2]
+            if isinstance(value, str):
+                return "(typeof({0}) = 'text' AND {0} {1} ?)".format(column, op), (value,)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return "(typeof({0}) IN ('integer', 'real') AND {0} {1} ?)".format(column, op), (value,)
+        if op == "one_of" and isinstance(query_hash[2], tuple) \
+                and all(value is None or isinstance(value, simple) for value in query_hash[2]):
+            values = tuple(value for value in query_hash[2] if value is not None)
+            sql = "{} IN ({})".format(column, ", ".join("?" * len(values)))
+            if None in query_hash[2]:
+                sql += " OR {} IS NULL".format(column)
+            return "({})".format(sql), values
+        if op == "test" and path == ("ip",) and query_hash[2] is _ip_in_range:
+            return "(ip_int BETWEEN ? AND ?)", tuple(query_hash[3])
+        return None
+
+    def _where(self, query_hash):
+        '''
+            Translate as much of condition into SQL as possible.
+            Returns:
+                tuple of SQL expression, its parameters and whether it
+                is the whole condition (otherwise rows that match it
+                still have to be checked against the condition)
+        '''
+        translated = self._translate(query_hash)
+        if translated is not None:
+            return translated + (True,)
+        if isinstance(query_hash, tuple) and query_hash and query_hash[0] == "and":
+            parts = [self._translate(sub_hash) for sub_hash in query_hash[1]]
+            parts = [part for part in parts if part is not None]
+            if parts:
+                return (" AND ".join(sql for sql, _ in parts),
+                        tuple(param for _, params in parts for param in params), False)
+        return "1", (), False
+
+    def _execute(self, columns, where="1", params=(), suffix=""):
+        sql = "SELECT {} FROM hosts WHERE ({}) AND ({}){}".format(
+            columns, self._restriction[0], where, suffix)
+        return self._conn.execute(sql, self._restriction[1] + tuple(params))
+
+    def _doc(self, row):
+        '''
+            Make a new document from a row of 'hosts' table.
+        '''
+        doc = HostRecord(dict(zip(self._columns, row[3:])), row[0], row[1])
+        if row[2]:
+            doc.ip_shared = True
+        return doc
+
+    def _matching(self, cond):
+        '''
+            Yield documents that match the condition, in insertion order.
+            Rows are read from the database one by one.
+        '''
+        if cond is None:
+            where, params, exact = "1", (), True # all the documents
+        else:
+            where, params, exact = self._where(getattr(cond, "_hash", None))
+        for row in self._execute(self._fields, where, params, " ORDER BY id"):
+            doc = self._doc(row)
+            if exact or cond(doc):
+                yield doc
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self._execute("count(*)").fetchone()[0]
+        return self._length
+
+    def __iter__(self):
+        return self._matching(None)
+
+    def source(self, doc_id):
+        '''
+            Find out where a document comes from, see HostDB.source.
+        '''
+        if self._files is None:
+            return None
+        row = self._execute("file, row", "id = ?", (doc_id,)).fetchone()
+        return (self._files[row[0]], row[1]) if row is not None else None
+
+    def _partition(self, key):
+        '''
+            Find groups of hosts by key (see HostDB.parse_group_key).
+            Returns:
+                dict mapping group name to SQL condition of its hosts
+                along with its parameters
+            Raises:
+                ValueError if key is not valid
+        '''
+        partition = self._partitions.get(key)
+        if partition is not None:
+            return partition
+        parsed = HostDB.parse_group_key(key)
+        partition = {}
+        if isinstance(parsed, tuple):
+            mask = (0xFFFFFFFF << (32 - parsed[1])) & 0xFFFFFFFF
+            for network, in self._execute("DISTINCT ip_int & ?", "ip_int IS NOT NULL", (mask,)):
+                partition[int_to_ip(network)] = ("ip_int BETWEEN ? AND ?",
+                                                 (network, network | (~mask & 0xFFFFFFFF)))
+        elif parsed in self._columns:
+            column = "c{}".format(self._columns.index(parsed))
+            values = {}
+            for value, in self._execute("DISTINCT " + column, column + " IS NOT NULL"):
+                if str(value).strip():
+                    values.setdefault(str(value), []).append(value)
+            for name, values in values.items():
+                partition[name] = ("{} IN ({})".format(column, ", ".join("?" * len(values))),
+                                   tuple(values))
+        self._partitions[key] = partition
+        return partition
+
+    def group_names(self, key):
+        '''
+            Get sorted names of groups of hosts, see HostDB.group_names.
+        '''
+        return sorted(self._partition(key))
+
+    def group(self, key, name):
+        '''
+            Get hosts of a group as a read-only database that shares
+            connection with this one.
+            Raises:
+                ValueError if key is not valid
+                KeyError if there is no such group
+        '''
+        where, params = self._partition(key)[name]
+        group = object.__new__(SqliteHostDB)
+        vars(group).update(vars(self))
+        group._restriction = ("({}) AND ({})".format(self._restriction[0], where),
+                              self._restriction[1] + params)
+        group._length = None
+        group._partitions = {}
+        return group
+
+    def all(self):
+        '''
+            Get all the documents in insertion order.
+        '''
+        return list(self._matching(None))
+
+    def search(self, cond):
+        '''
+            Get all the documents matching a condition, in insertion order.
+        '''
+        return list(self._matching(cond))
+
+    def get(self, cond=None, doc_id=None):
+        '''
+            Get the first document matching a condition or a document
+            with given id. Return None if there is no such document.
+        '''
+        if doc_id is not None:
+            row = self._execute(self._fields, "id = ?", (doc_id,)).fetchone()
+            return self._doc(row) if row is not None else None
+        if cond is None:
+            raise RuntimeError("You have to pass either cond or doc_id")
+        return next(self._matching(cond), None)
+
+    def answers_in_sql(self, cond):
+        '''
+            Check whether condition is answered by SQLite alone, so that
+            reading documents of its cached result would cost as much as
+            running it again (see MemoizingDB).
+        '''
+        return self._where(getattr(cond, "_hash", None))[2]
+
+    # Number of ids that documents looks up with a single statement,
+    # within the limit of SQLite on the number of parameters
+    DOCUMENTS_BATCH = 500
+
+    def documents(self, doc_ids):
+        '''
+            Get documents with given ids at once, see HostDB.documents.
+            They are read with a few 'id IN (...)' statements instead
+            of a statement per document.
+        '''
+        doc_ids = list(doc_ids)
+        docs = {}
+        for start in range(0, len(doc_ids), self.DOCUMENTS_BATCH):
+            batch = doc_ids[start:start + self.DOCUMENTS_BATCH]
+            for row in self._execute(self._fields, "id IN ({})".format(", ".join("?" * len(batch))),
+                                     batch):
+                docs[row[0]] = self._doc(row)
+        return [docs[doc_id] for doc_id in doc_ids]
+
+    def count(self, cond):
+        '''
+            Count the documents matching a condition.
+        '''
+        where, params, exact = self._where(getattr(cond, "_hash", None))
+        if exact:
+            return self._execute("count(*)", where, params).fetchone()[0]
+        return sum(1 for doc in self._matching(cond))
+
+    def contains(self, cond=None, doc_id=None):
+        '''
+            Check whether there is a document matching a condition
+            or a document with given id.
+        '''
+        return self.get(cond, doc_id) is not None
+
+
+# Query operators that compare column value against a scalar
+_COMPARISON_OPS = {
+    "==": lambda q, v: q == v,
+    "!=": lambda q, v: q != v,
+    "<": lambda q, v: q < v,
+    "<=": lambda q, v: q <= v,
+    ">": lambda q, v: q > v,
+    ">=": lambda q, v: q >= v
+}
+
+
+def _encode_value(value):
+    '''
+        Convert a value used in a query into JSON-compatible form.
+        Raises ValueError if value can not be converted.
+    '''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (tuple, list, frozenset)):
+        return {"items": [_encode_value(x) for x in value]}
+    raise ValueError("can not encode value: {!r}".format(value))
+
+
+def _decode_value(value):
+    '''
+        Convert a value encoded with _encode_value back.
+        Sequences are decoded into tuples.
+    '''
+    if isinstance(value, dict):
+        return tuple(_decode_value(x) for x in value["items"])
+    return value
+
+
+def _function_digest(func):
+    '''
+        Compute digest of a function passed to Query.test(): of its code,
+        closure and defaults. Only the digest is kept in manifests, never
+        the code itself, so queries that use such functions can not be
+        rebuilt from a manifest (see decode_query).
+        Raises ValueError if function has no code or its closure or
+        defaults can not be encoded.
+    '''
+    code = getattr(func, "__code__", None)
+    if code is None or getattr(func, "__kwdefaults__", None):
+        raise ValueError("can not encode function: {!r}".format(func))
+    try:
+        closure = [_encode_value(cell.cell_contents) for cell in func.__closure__ or ()]
+    except ValueError as exc:
+        raise ValueError("can not encode function closure: {}".format(exc))
+    digest = hashlib.sha256(marshal.dumps(code))
+    digest.update(json.dumps([closure, [_encode_value(x) for x in func.__defaults__ or ()]],
+                             sort_keys=True).encode("utf8"))
+    return digest.hexdigest()
+
+
+def encode_query(cond):
+    '''
+        Convert a TinyDB query into JSON-compatible structure
+        that decode_query can build the same query from.
+        Parameters:
+            cond - TinyDB query
+        Returns:
+            nested list describing the query
+        Raises:
+            ValueError if query can not be described (e.g. it uses
+            regular expressions, Query.map() or arbitrary callables)
+    '''
+    def encode(query_hash):
+        if query_hash == ():
+            return ["noop"]
+        op = query_hash[0]
+        if op in ("and", "or"):
+            return [op] + [encode(sub_hash) for sub_hash in query_hash[1]]
+        if op == "not":
+            return [op, encode(query_hash[1])]
+        path = list(query_hash[1])
+        if not all(isinstance(part, str) for part in path):
+            raise ValueError("can not encode query path: {!r}".format(query_hash[1]))
+        if op == "exists":
+            return [op, path]
+        if op in _COMPARISON_OPS and not isinstance(query_hash[2], (tuple, list, frozenset)):
+            return [op, path, _encode_value(query_hash[2])]
+        if op == "one_of":
+            return [op, path, _encode_value(query_hash[2])]
+        if op == "test" and query_hash[2] is _ip_in_range:
+            return ["in_range", path] + list(query_hash[3])
+        if op == "test":
+            return [op, path, {"digest": _function_digest(query_hash[2])},
+                    _encode_value(query_hash[3])]
+        raise ValueError("can not encode query: {!r}".format(query_hash))
+
+    query_hash = getattr(cond, "_hash", None)
+    if query_hash is None or not isinstance(cond, tinydb.queries.QueryInstance):
+        raise ValueError("can not encode query: {!r}".format(cond))
+    return encode(query_hash)
+
+
+def decode_query(data):
+    '''
+        Build a TinyDB query from structure returned by encode_query.
+        Parameters:
+            data - nested list describing the query
+        Returns:
+            TinyDB query
+        Raises:
+            ValueError if query uses Query.test() with a function other
+            than that of in_subnet/in_range, which is known only by its
+            digest (see _function_digest)
+    '''
+    op = data[0]
+    if op == "noop":
+        return tinydb.Query().noop()
+    if op == "and":
+        return functools.reduce(operator.and_, map(decode_query, data[1:]))
+    if op == "or":
+        return functools.reduce(operator.or_, map(decode_query, data[1:]))
+    if op == "not":
+        return ~decode_query(data[1])
+    query = functools.reduce(lambda q, part: q[part], data[1], tinydb.Query())
+    if op == "exists":
+        return query.exists()
+    if op == "one_of":
+        return query.one_of(_decode_value(data[2]))
+    if op == "in_range":
+        return query.test(_ip_in_range, data[2], data[3])
+    if op == "test":
+        raise ValueError("can not rebuild query with test function {}".format(data[2]["digest"]))
+    return _COMPARISON_OPS[op](query, _decode_value(data[2]))
+
+
+def query_fingerprint(result):
+    '''
+        Compute a short digest of a query result (list of documents,
+        single document, number or boolean).
+    '''
+    data = json.dumps(result, sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode("utf8")).hexdigest()[:32]
+
+
+class RecordingDB:
+    '''
+        Wrapper around HostDB that records every query made through it
+        along with a fingerprint of its result. The recorded queries
+        can be replayed later on with replay() to find out whether
+        their results have changed.
+    '''
+
+    def __init__(self, db):
+        '''
+            Parameters:
+                db - HostDB instance to forward queries to
+        '''
+        self._db = db
+        self.queries = [] # list of [method, arguments, fingerprint]
+        self.replayable = True # False if some query could not be encoded
+
+    def _record(self, method, args, result):
+        self.queries.append([method, args, query_fingerprint(result)])
+        return result
+
+    def _encode(self, cond):
+        try:
+            return encode_query(cond)
+        except ValueError:
+            self.replayable = False
+            return None
+
+    def __len__(self):
+        return self._record("len", None, len(self._db))
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        return self._record("all", None, self._db.all())
+
+    def search(self, cond):
+        return self._record("search", self._encode(cond), self._db.search(cond))
+
+    def get(self, cond=None, doc_id=None):
+        if doc_id is not None:
+            return self._record("get_id", doc_id, self._db.get(doc_id=doc_id))
+        return self._record("get", self._encode(cond), self._db.get(cond))
+
+    def count(self, cond):
+        return self._record("count", self._encode(cond), self._db.count(cond))
+
+    def contains(self, cond=None, doc_id=None):
+        return self.get(cond, doc_id) is not None
+
+    def source(self, doc_id):
+        return self._record("source", doc_id, self._db.source(doc_id))
+
+    @staticmethod
+    def replay(db, queries):
+        '''
+            Run recorded queries against a database.
+            Parameters:
+                db - HostDB instance
+                queries - list of queries as recorded by RecordingDB
+            Returns:
+                True if all the queries yield the same results as recorded,
+                False otherwise
+        '''
+        for method, args, fingerprint in queries:
+            try:
+                if method == "len":
+                    result = len(db)
+                elif method == "all":
+                    result = db.all()
+                elif method == "get_id":
+                    result = db.get(doc_id=args)
+                elif method == "source":
+                    result = db.source(args)
+                else:
+                    result = getattr(db, method)(decode_query(args))
+            except Exception:
+                return False # e.g. query uses a test function
+            if query_fingerprint(result) != fingerprint:
+                return False
+        return True
+
+
+@contextlib.contextmanager
+def _timed(timings, name, calls=1):
+    '''
+        Add wall clock and CPU time spent in the block to timings[name],
+        which is a dict with 'calls', 'wall' and 'cpu' keys, and add
+        given number of calls.
+    '''
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        times = timings.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+        times["calls"] += calls
+        times["wall"] += time.perf_counter() - wall
+        times["cpu"] += time.process_time() - cpu
+
+
+def _stage(profile, name):
+    '''
+        Measure a stage of work if profiling is on (profile is not None).
+    '''
+    return profile.stage(name) if profile is not None else contextlib.nullcontext()
+
+
+def _rounded(timings):
+    '''
+        Round times in a dict of timings to microseconds.
+    '''
+    return {name: dict(times, wall=round(times["wall"], 6), cpu=round(times["cpu"], 6))
+            for name, times in timings.items()}
+
+
+class Profile:
+    '''
+        Profile of a run or of a single template: wall clock and CPU time
+        of its stages, statistics of database queries and time spent in
+        every view. Only the code that is given a Profile is measured,
+        so nothing is slowed down when profiling is off.
+    '''
+
+    def __init__(self):
+        self.stages = {} # stage name -> timings
+        self.views = {} # view name -> timings
+        self.queries = {} # (method, query) -> statistics
+        self.templates = [] # reports of templates of the run
+        self.memo = None # hit/miss statistics of MemoCache of the run
+
+    def stage(self, name):
+        '''
+            Context manager that measures a stage.
+        '''
+        return _timed(self.stages, name)
+
+    def add_query(self, method, query, wall, cpu, scanned, returned):
+        '''
+            Add statistics of a database query. Queries with the same
+            method and description are summed up.
+            Parameters:
+                method - database method ('search', 'get' etc)
+                query - description of the query
+                wall, cpu - wall clock and CPU time spent on the query
+                scanned - number of rows the query was evaluated against
+                returned - number of rows returned
+        '''
+        stats = self.queries.setdefault((method, query), {"method": method, "query": query,
+            "calls": 0, "wall": 0.0, "cpu": 0.0, "scanned": 0, "returned": 0})
+        stats["calls"] += 1
+        stats["wall"] += wall
+        stats["cpu"] += cpu
+        stats["scanned"] += scanned
+        stats["returned"] += returned
+
+    def report(self):
+        '''
+            Make JSON serializable report of a template.
+            Queries are sorted by time spent.
+        '''
+        queries = sorted(self.queries.values(), key=lambda stats: -stats["wall"])
+        return {
+            "wall": round(sum(times["wall"] for times in self.stages.values()), 6),
+            "cpu": round(sum(times["cpu"] for times in self.stages.values()), 6),
+            "stages": _rounded(self.stages),
+            "views": _rounded(self.views),
+            "queries": [dict(stats, wall=round(stats["wall"], 6), cpu=round(stats["cpu"], 6))
+                        for stats in queries]
+        }
+
+    def save(self, path):
+        '''
+            Save report of a run: its stages and reports of its templates,
+            slowest templates first.
+            Raises:
+                IOError if unable to write report
+        '''
+        report = {
+            "version": 1,
+            "stages": _rounded(self.stages),
+            "templates": sorted(self.templates, key=lambda template: -template["wall"])
+        }
+        if self.memo is not None:
+            report["memo"] = self.memo
+        write_file_atomic(path, json.dumps(report, indent=1, sort_keys=True).encode("utf8"))
+
+
+class _CountingQuery:
+    '''
+        Query wrapper that counts documents it is evaluated against.
+        It keeps structural description of the wrapped query,
+        so HostDB still answers it from indexes.
+    '''
+
+    def __init__(self, cond):
+        self._cond = cond
+        self._hash = getattr(cond, "_hash", None)
+        self.calls = 0
+
+    def __call__(self, doc):
+        self.calls += 1
+        return self._cond(doc)
+
+
+class ProfilingDB:
+    '''
+        Wrapper around HostDB that measures every query made through it
+        and counts rows that the query was evaluated against (rows that
+        indexes ruled out are not counted) and rows it returned.
+    '''
+
+    def __init__(self, db, profile):
+        '''
+            Parameters:
+                db - HostDB instance to forward queries to
+                profile - Profile instance to add statistics to
+        '''
+        self._db = db
+        self._profile = profile
+
+    def _query(self, method, cond, run):
+        counting = _CountingQuery(cond)
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = run(counting)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if isinstance(result, list):
+            returned = len(result)
+        elif method == "count":
+            returned = result
+        else:
+            returned = int(result is not None)
+        self._profile.add_query(method, None if cond is None else repr(cond), wall, cpu,
+                                counting.calls, returned)
+        return result
+
+    def __len__(self):
+        return len(self._db)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        return self._query("all", None, lambda cond: self._db.all())
+
+    def search(self, cond):
+        return self._query("search", cond, self._db.search)
+
+    def get(self, cond=None, doc_id=None):
+        if doc_id is not None:
+            return self._query("get_id", doc_id, lambda cond: self._db.get(doc_id=doc_id))
+        return self._query("get", cond, self._db.get)
+
+    def count(self, cond):
+        return self._query("count", cond, self._db.count)
+
+    def contains(self, cond=None, doc_id=None):
+        return self.get(cond, doc_id) is not None
+
+    def source(self, doc_id):
+        return self._db.source(doc_id)
+
+
+class ProfilingViewSet(ViewSet):
+    '''
+        ViewSet that measures time spent in every view.
+    '''
+
+    def __init__(self, profile, view=None):
+        '''
+            Parameters:
+                profile - Profile instance to add view timings to
+                view - ViewSet to compute outputs with (e.g. LineCachingViewSet)
+        '''
+        view = view if view is not None else ViewSet()
+        for name, value in vars(ViewSet).items():
+            if isinstance(value, staticmethod):
+                setattr(self, name, self._timed_view(profile, name, getattr(view, name)))
+
+    @staticmethod
+    def _timed_view(profile, name, view):
+        if inspect.isgeneratorfunction(view):
+            # Only time spent on producing items is measured,
+            # not the time the template spends on using them
+            @functools.wraps(view)
+            def timed_iter_view(*args, **kw):
+                with _timed(profile.views, name):
+                    items = view(*args, **kw)
+                while True:
+                    try:
+                        with _timed(profile.views, name, calls=0):
+                            item = next(items)
+                    except StopIteration:
+                        return
+                    yield item
+            return timed_iter_view
+
+        @functools.wraps(view)
+        def timed_view(*args, **kw):
+            with _timed(profile.views, name):
+                return view(*args, **kw)
+        return timed_view
+
+
+class MemoCache:
+    '''
+        Cache of database query results and view outputs that templates
+        of a run share, so that the same query or the same view of the same
+        hosts is computed only once per run (see MemoizingDB and
+        MemoizingViewSet). Query results are kept as document ids, so
+        templates still get documents of their own.
+        The cache must not outlive the database it was filled from.
+    '''
+
+    def __init__(self):
+        self.queries = {} # (group, method, query structure) -> doc ids or count
+        self.views = {} # (view name, arguments with doc ids of hosts) -> output
+
+    @staticmethod
+    def new_stats():
+        '''
+            Make dict of hit/miss statistics of a template.
+        '''
+        return {"queries": {"hits": 0, "misses": 0}, "views": {"hits": 0, "misses": 0}}
+
+    @staticmethod
+    def add_stats(total, stats):
+        '''
+            Add statistics of a template to total statistics.
+        '''
+        for kind, counts in stats.items():
+            for name, count in counts.items():
+                total[kind][name] += count
+
+
+class MemoizingDB:
+    '''
+        Wrapper around HostDB that answers queries from MemoCache.
+        Queries are identified by their structure (the '_hash' attribute
+        of TinyDB query) and by the group of hosts the database holds.
+        Queries without structure (e.g. plain callables or Query.map())
+        and queries with unhashable values are always run. Results are
+        cached as document ids, and documents of a cached result are read
+        from the database at once (see HostDB.documents). Searches that
+        SqliteHostDB answers in SQL alone are not cached, since reading
+        their documents again costs as much as running them.
+    '''
+
+    def __init__(self, db, memo, stats, group=None):
+        '''
+            Parameters:
+                db - HostDB instance to forward queries to
+                memo - MemoCache instance of the run
+                stats - dict of statistics to count hits and misses in
+                        (see MemoCache.new_stats)
+                group - (key, name) tuple if db holds a group of hosts
+        '''
+        self._db = db
+        self._memo = memo
+        self._stats = stats["queries"]
+        self._group = group
+
+    def _query(self, method, cond, run):
+        '''
+            Get result of a query from the cache, or run it and cache it.
+            Parameters:
+                method - 'search', 'get' or 'count'
+                cond - the query
+                run - function that runs the query and returns
+                      cacheable result
+            Returns:
+                doc ids (or count) of the result
+        '''
+        query_hash = getattr(cond, "_hash", None)
+        key = (self._group, method, query_hash)
+        try:
+            result = self._memo.queries.get(key) if query_hash is not None else None
+        except TypeError:
+            query_hash = result = None # unhashable value in query
+        if result is not None:
+            self._stats["hits"] += 1
+            return result
+        result = run(cond)
+        if query_hash is not None:
+            self._stats["misses"] += 1
+            self._memo.queries[key] = result
+        return result
+
+    def __len__(self):
+        return len(self._db)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        return self._db.all()
+
+    def _indexed(self, cond):
+        answers_in_sql = getattr(self._db, "answers_in_sql", None)
+        return answers_in_sql is not None and answers_in_sql(cond)
+
+    def search(self, cond):
+        if self._indexed(cond):
+            return self._db.search(cond)
+        docs = None # documents of a query that is run, which are not read again
+        def run(cond):
+            nonlocal docs
+            docs = self._db.search(cond)
+            return array.array("L", (doc.doc_id for doc in docs))
+        found = self._query("search", cond, run)
+        return docs if docs is not None else self._db.documents(found)
+
+    def get(self, cond=None, doc_id=None):
+        if doc_id is not None:
+            return self._db.get(doc_id=doc_id)
+        if cond is None:
+            raise RuntimeError("You have to pass either cond or doc_id")
+        if self._indexed(cond):
+            return self._db.get(cond)
+        docs = None
+        def run(cond):
+            nonlocal docs
+            docs = [self._db.get(cond)]
+            return array.array("L", [docs[0].doc_id] if docs[0] is not None else [])
+        found = self._query("get", cond, run)
+        if docs is not None:
+            return docs[0]
+        return self._db.documents(found)[0] if found else None
+
+    def count(self, cond):
+        return self._query("count", cond, self._db.count)
+
+    def contains(self, cond=None, doc_id=None):
+        return self.get(cond, doc_id) is not None
+
+    def source(self, doc_id):
+        return self._db.source(doc_id)
+
+
+class MemoizingViewSet(ViewSet):
+    '''
+        ViewSet that takes outputs of views from MemoCache. Output is
+        identified by the view, its arguments and ids of the hosts, so it
+        is cached only if every host is an unmodified document read from
+        HostDB. Generator views are not cached, they are meant to keep
+        large outputs out of memory.
+    '''
+
+    # Views whose outputs are cached
+    MEMOIZED_VIEWS = ("hosts", "dns", "rdns", "dhcp")
+
+    def __init__(self, memo, stats, view=None):
+        '''
+            Parameters:
+                memo - MemoCache instance of the run
+                stats - dict of statistics to count hits and misses in
+                        (see MemoCache.new_stats)
+                view - ViewSet to compute outputs with (e.g. ProfilingViewSet)
+        '''
+        view = view if view is not None else ViewSet()
+        for name, value in vars(ViewSet).items():
+            if isinstance(value, staticmethod):
+                func = getattr(view, name)
+                if name in self.MEMOIZED_VIEWS:
+                    func = self._memoized_view(memo, stats["views"], name, func)
+                setattr(self, name, func)
+
+    @staticmethod
+    def _memoized_view(memo, stats, name, view):
+        signature = inspect.signature(getattr(ViewSet, name))
+
+        @functools.wraps(view)
+        def memoized_view(*args, **kw):
+            try:
+                arguments = signature.bind(*args, **kw)
+            except TypeError:
+                return view(*args, **kw) # let the view complain
+            arguments.apply_defaults()
+            hosts = arguments.arguments["hosts"] = list(arguments.arguments["hosts"])
+            if all(isinstance(host, HostRecord) and not host.modified for host in hosts):
+                key = (name, tuple(host.doc_id for host in hosts),
+                       tuple(arguments.arguments.items())[1:])
+                try:
+                    output = memo.views.get(key)
+                except TypeError:
+                    key = output = None # unhashable argument
+                if output is not None:
+                    stats["hits"] += 1
+                    return output
+                if key is not None:
+                    stats["misses"] += 1
+                    output = memo.views[key] = view(*arguments.args, **arguments.kwargs)
+                    return output
+            return view(*arguments.args, **arguments.kwargs)
+        return memoized_view
+
+
+class LineCache:
+    '''
+        Cache of lines that views format for single hosts, kept on disk
+        between runs, so that only the lines of hosts that changed are
+        formatted again. A line is identified by the view, options of the
+        view and values of the columns the line is made of, so changes of
+        other columns do not make it stale. Lines are cached only for values
+        of plain types (strings, integers and None) of hosts that templates
+        did not change, so they are always the same as the formatted ones.
+        When the cache grows over its size, lines that were not used for
+        the most runs are dropped. Lines made by another version of this
+        script are not used.
+    '''
+
+    # Format version of cache file
+    VERSION = 1
+
+    # Types of values that lines are cached for
+    CACHED_TYPES = frozenset([str, int, type(None)])
+
+    def __init__(self, max_bytes, lines=None):
+        '''
+            Parameters:
+                max_bytes - size the cache is kept within when saved,
+                            as total length of its keys and lines
+                lines - dict mapping keys to lines, least recently
+                        used first (see load)
+        '''
+        self.max_bytes = max_bytes
+        self.lines = lines if lines is not None else {}
+        self.used = set() # keys used by this run
+        self.new = {} # lines formatted since the last take_changes
+        self.hits = self.misses = 0
+
+    @classmethod
+    def load(cls, path, max_bytes):
+        '''
+            Load cache from file. Cache is empty if the file does not exist
+            or was written by another version of this script; broken file
+            is logged and ignored.
+        '''
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            if data["version"] == cls.VERSION and data["script"] == _script_digest():
+                return cls(max_bytes, data["lines"])
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            logging.warning("ignoring broken line cache '{}': {}".format(path, exc))
+        return cls(max_bytes)
+
+    def save(self, path):
+        '''
+            Save cache into file, dropping the least recently used lines
+            if it is over its size.
+            Raises:
+                IOError if unable to write file
+        '''
+        keys = [key for key in self.lines if key not in self.used]
+        keys.extend(key for key in self.lines if key in self.used)
+        sizes = [self._size(key, self.lines[key]) for key in keys]
+        total, first = sum(sizes), 0
+        while total > self.max_bytes and first < len(keys):
+            total -= sizes[first]
+            first += 1
+        self.lines = {key: self.lines[key] for key in keys[first:]}
+        data = {"version": self.VERSION, "script": _script_digest(), "lines": self.lines}
+        write_file_atomic(path, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _size(key, line):
+        view, options, values = key
+        return len(view) + len(line) + sum(len(str(value)) for value in options + values)
+
+    def formatter(self, view, line, columns, *options):
+        '''
+            Make function that formats line of a host just like
+            line(host, *options) does, taking it from the cache
+            if the host has the same values of columns.
+            Parameters:
+                view - name of the view
+                line - function that formats line of a host
+                columns - names of the columns the line is made of
+                options - other arguments of line
+        '''
+        format_line = lambda host: line(host, *options)
+        if not all(type(option) in self.CACHED_TYPES | {bool} for option in options):
+            return format_line
+        options_key = tuple((type(option).__name__, option) for option in options)
+        lines, used, new = self.lines, self.used, self.new
+        get_values, cached_type = operator.itemgetter(*columns), self.CACHED_TYPES.__contains__
+
+        def cached_line(host):
+            try:
+                values = get_values(host)
+            except Exception:
+                return format_line(host) # let the view complain
+            if getattr(host, "modified", False) or not all(map(cached_type, map(type, values))):
+                return format_line(host)
+            key = (view, options_key, values)
+            text = lines.get(key)
+            if text is None:
+                text = lines[key] = new[key] = format_line(host)
+                self.misses += 1
+            else:
+                self.hits += 1
+            used.add(key)
+            return text
+        return cached_line
+
+    def take_changes(self):
+        '''
+            Get lines formatted and keys used since the last call, along
+            with hit and miss counts, to be merged into the cache of
+            another process (see merge).
+        '''
+        changes = (self.new, list(self.used), self.hits, self.misses)
+        self.new, self.used = {}, set()
+        self.hits = self.misses = 0
+        return changes
+
+    def merge(self, changes):
+        '''
+            Merge changes taken from the cache of another process.
+        '''
+        new, used, hits, misses = changes
+        self.lines.update(new)
+        self.used.update(used)
+        self.hits += hits
+        self.misses += misses
+
+
+class LineCachingViewSet(ViewSet):
+    '''
+        ViewSet that takes lines of dhcp view from LineCache instead of
+        formatting them every time. Outputs are the same as those of
+        ViewSet. Lines of the other views are formatted with a single
+        str.format call, which takes as long as looking them up in the
+        cache, so they are not cached.
+    '''
+
+    def __init__(self, cache):
+        '''
+            Parameters:
+                cache - LineCache instance of the run
+        '''
+        self._cache = cache
+
+    def dhcp(self, hosts, with_hostname=True, router_ip=None, filename=None):
+        return "\n".join(self.iter_dhcp(hosts, with_hostname, router_ip, filename))
+
+    def iter_dhcp(self, hosts, with_hostname=True, router_ip=None, filename=None):
+        yield from _iter_dhcp(hosts, self._cache.formatter("dhcp", _dhcp_line,
+            ("hostname", "domain", "ip", "mac", "mask"), with_hostname, router_ip, filename))
+
+
+def file_digest(path):
+    '''
+        Compute SHA-256 hex digest of file contents.
+        Raises IOError if unable to read file.
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_file_atomic(path, data):
+    '''
+        Write data into file atomically: data is written into a temporary
+        file in the same directory, which is then renamed over the target,
+        so that readers see either old or new contents of the file but never
+        a partially written one. Permissions of existing file are kept.
+        Parameters:
+            path - path to file
+            data - bytes to write
+        Raises:
+            IOError if unable to write file
+    '''
+    tmp_path = _atomic_tmp_path(path)
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        _replace_atomic(tmp_path, path)
+    except IOError:
+        _unlink_quietly(tmp_path)
+        raise
+
+
+def _atomic_tmp_path(path, suffix="tmp"):
+    '''
+        Get path of temporary file that is renamed over given file.
+    '''
+    return os.path.join(os.path.dirname(path),
+                        ".{}.{}.{}".format(os.path.basename(path), os.getpid(), suffix))
+
+
+def _replace_atomic(tmp_path, path):
+    '''
+        Rename temporary file over given file, keeping permissions
+        of the existing file.
+    '''
+    try:
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+    except FileNotFoundError:
+        pass # new file
+    os.replace(tmp_path, path)
+
+
+def _unlink_quietly(path):
+    '''
+        Remove file, ignoring errors.
+    '''
+    try:
+        os.unlink(path)
+    except IOError:
+        pass
+
+
+def write_output(path, text):
+    '''
+        Write rendered template into output file unless the file
+        already has exactly the same contents. The file is replaced
+        atomically, see write_file_atomic.
+        Parameters:
+            path - path to output file
+            text - rendered template
+        Returns:
+            True if file was written, False if it was left untouched
+        Raises:
+            IOError if unable to write file
+    '''
+    data = text.encode("utf8")
+    try:
+        if os.path.getsize(path) == len(data) and \
+                file_digest(path) == hashlib.sha256(data).hexdigest():
+            return False
+    except IOError:
+        pass # no such file or unable to read it, just try to write it
+    write_file_atomic(path, data)
+    return True
+
+
+def write_changes(path, entries, outputs, tree=None):
+    '''
+        Write manifest of changes made by this run, so that deployment
+        can ship only changed outputs. It is a JSON file with lists of
+        'changed', 'unchanged', 'failed' and 'removed' outputs. Outputs
+        are 'removed' if they were in the previous version of the manifest
+        but there is no template for them anymore (files are not deleted).
+        Parameters:
+            path - path to manifest of changes
+            entries - manifest entries of rendered outputs (see render_template)
+            outputs - paths of all the outputs of this run, including failed ones
+            tree - paths of all the outputs of all the shards if this run
+                   renders a shard (see shard_templates), so that outputs
+                   of other shards are not taken for removed ones
+        Raises:
+            IOError if unable to write manifest
+    '''
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            previous = json.load(f)
+        previous_outputs = set(itertools.chain(previous["changed"],
+                previous["unchanged"], previous["failed"]))
+    except (IOError, ValueError, KeyError, TypeError):
+        previous_outputs = set()
+
+    rendered = {entry["output"]: entry.get("changed", True) for entry in entries}
+    changes = {
+        "changed": sorted(output for output, changed in rendered.items() if changed),
+        "unchanged": sorted(output for output, changed in rendered.items() if not changed),
+        "failed": sorted(set(outputs) - set(rendered)),
+        "removed": sorted(previous_outputs - set(outputs if tree is None else tree))
+    }
+    write_file_atomic(path, json.dumps(changes, indent=1).encode("utf8"))
+
+
+def strip_mako_extension(path):
+    '''
+        Strip '.mako' extension from path if present.
+    '''
+    return path[:-len(".mako")] if path.endswith(".mako") else path
+
+
+class IncrementalState:
+    '''
+        State of incremental rendering: the manifest of the previous run
+        that tells which inputs every output file was rendered from.
+        An output is up to date if its template and variables file are
+        the same and every database query the template made returns
+        the same rows as before.
+        Functions passed to Query.test() are recorded only by their
+        digests, so templates whose queries use them are rendered again.
+    '''
+
+    # Manifest format version
+    VERSION = 1
+
+    def __init__(self, entries=None, var_digest=None):
+        '''
+            Parameters:
+                entries - dict mapping output path to its manifest entry
+                var_digest - digest of the current variables file
+        '''
+        self.entries = entries or {}
+        self.var_digest = var_digest
+
+    @classmethod
+    def load(cls, path, var_digest):
+        '''
+            Load manifest of the previous run. Missing, unreadable or
+            incompatible manifest is treated as empty one.
+            Parameters:
+                path - path to manifest file
+                var_digest - digest of the current variables file
+        '''
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                manifest = json.load(f)
+            if manifest["version"] != cls.VERSION or \
+                    manifest["python"] != sys.implementation.cache_tag:
+                raise ValueError("incompatible manifest")
+            return cls(manifest["outputs"], var_digest)
+        except (IOError, ValueError, KeyError, TypeError):
+            return cls({}, var_digest)
+
+    @classmethod
+    def save(cls, path, entries):
+        '''
+            Save manifest for the next run.
+            Parameters:
+                path - path to manifest file
+                entries - iterable of manifest entries as returned
+                          by render_template
+            Raises:
+                IOError if unable to write manifest
+        '''
+        manifest = {
+            "version": cls.VERSION,
+            "python": sys.implementation.cache_tag,
+            "outputs": {entry["output"]: entry for entry in entries}
+        }
+        write_file_atomic(path, json.dumps(manifest, sort_keys=True).encode("utf8"))
+
+    def up_to_date(self, infile, outfile, template_digest, db):
+        '''
+            Check whether output file does not need to be rendered again.
+            Parameters:
+                infile - path to template file
+                outfile - path to output file
+                template_digest - digest of the current template file
+                db - HostDB instance with the current hosts
+            Returns:
+                True if output file exists and none of its inputs changed
+        '''
+        entry = self.entries.get(outfile)
+        return entry is not None \
+            and entry.get("template") == infile \
+            and entry.get("template_digest") == template_digest \
+            and entry.get("var_digest") == self.var_digest \
+            and entry.get("queries") is not None \
+            and os.path.exists(outfile) \
+            and RecordingDB.replay(db, entry["queries"])
+
+    def entry(self, infile, outfile, template_digest, recording_db):
+        '''
+            Make manifest entry for a freshly rendered output file.
+        '''
+        return {
+            "output": outfile,
+            "template": infile,
+            "template_digest": template_digest,
+            "var_digest": self.var_digest,
+            "queries": recording_db.queries if recording_db.replayable else None
+        }
+
+
+def parse_csv(csvpath, columnar=False):
+    '''
+        Parse given CSV file and return a list of dicts,
+        where each dict represents a host on the network.
+        See iter_csv for details.
+        Parameters:
+            csvpath - path to CSV file
+            columnar - if True, return compact HostTable instead of list
+        Return value:
+            list of dicts, where each dict corresponds to CSV file row,
+            or HostTable with the same rows
+        Raises:
+            IOError if unable to open given file
+            csv.Error if CSV file is invalid
+            CsvIntegrityError if there are missing columns or invalid values
+    '''
+    if columnar:
+        return HostTable(iter_csv(csvpath))
+    return list(iter_csv(csvpath))
+
+
+def iter_csv(csvpath):
+    '''
+        Parse given CSV file and yield dicts one by one,
+        where each dict represents a host on the network.
+        See iter_csv_rows for details.
+    '''
+    for _, row in iter_csv_rows(csvpath):
+        yield row
+
+
+def iter_csv_rows(csvpath):
+    '''
+        Parse given CSV file and yield dicts one by one along with
+        their row numbers, where each dict represents a host on the network.
+        The file is read, validated and transformed row by row,
+        so only one row at a time is kept in memory.
+        Make all columns names lowercase and replace spaces with underscores.
+        Check that the following columns exist: 'hostname', 'domain',
+        'ip', 'mac', 'vlan'. Check IP/MAC addresses for validity.
+        If column 'gendalf_ignore' is present, then any row
+        that has non-blank value in this column is getting ignored.
+        Parameters:
+            csvpath - path to CSV file
+        Yields:
+            (row number, dict) tuples, where each dict corresponds to CSV file row
+        Raises (while iterating):
+            IOError if unable to open given file
+            csv.Error if CSV file is invalid
+            CsvIntegrityError if there are missing columns or invalid values
+    '''
+    # Go ahead and read csv file. This raises IOError on error
+    with open(csvpath, "r") as f:
+
+        # Strip comments (lines that start with '#')
+        lines = (l for l in f if not l.lstrip().lstrip('"').lstrip().startswith('#'))
+
+        # Do sanity checks and transforms
+        yield from check_rows(enumerate(csv.DictReader(lines), start=2), csvpath) # raises csv.Error on error
+
+
+def check_rows(raw_rows, path):
+    '''
+        Validate and transform rows read from an inventory file of any
+        format, so that every format gives the same rows as CSV file.
+        See iter_csv_rows for details. Values that are strings are checked
+        as in CSV file. Values that are already typed skip parsing where
+        it is safe: integers in 'vlan' and 'mask' columns are only checked
+        for range, integers in 'ip' column are converted into IP addresses,
+        other numbers are converted into strings and checked as such, and
+        None is taken for an empty value.
+        Parameters:
+            raw_rows - iterable of (row number, dict) tuples, where every
+                       dict has the same keys
+            path - path to inventory file, for error messages
+        Yields:
+            (row number, dict) tuples
+        Raises (while iterating):
+            CsvIntegrityError if there are invalid values
+    '''
+
+    # Define a function that transforms column names.
+    # Make column name lowercase and replace spaces with underscores.
+    colname_transform = lambda colname: colname.lower().strip().replace(" ", "_")
+
+    # Define validator functions for every column.
+    # Value considered invalid if validator returns False
+    # or raises ValueError.
+    column_validators = {
+        "hostname": lambda s: bool(s),
+        "domain": lambda s: bool(s),
+        "vlan": lambda s: s.strip() == "" or 0 < int(s) < 4096,
+        "ip": lambda s: s.count(".") == 3 and all(0 <= int(x) <= 255 and (x == "0" or x[0] != "0") for x in s.split(".")),
+        "mask": lambda s: 0 <= int(s) <= 32,
+        "mac": lambda s: not s or s.count(":") == 5 and all(0 <= int(x,16) <= 255 and len(x) == 2 for x in s.split(":")),
+        "entity_type": lambda s: s in ("comp", "head", "alias", "cimc", "fi", "hardware")
+    }
+
+    # Define column transformer functions.
+    # Those functions are applied to corresponding columns
+    # after value has been validated with functions above.
+    # Note that by default all the values are stripped even before validating.
+    column_transformers = {
+        "vlan": lambda s: int(s) if s.strip() != "" else None,
+        "mask": int
+    }
+
+    # Validators and transformers of integer values of typed inputs
+    integer_validators = {
+        "vlan": lambda n: 0 < n < 4096,
+        "mask": lambda n: 0 <= n <= 32,
+        "ip": lambda n: 0 <= n <= 0xFFFFFFFF
+    }
+    integer_transformers = {
+        "ip": int_to_ip
+    }
+
+    # Mapping of column names is built from the first row
+    colname_map = None
+
+    for n, raw_row in raw_rows:
+
+        # Build the mapping of column names
+        if colname_map is None:
+            colname_map = {colname: colname_transform(colname) for colname in raw_row.keys()}
+            ignore_column = ([old_col for old_col, new_col in colname_map.items()
+                    if new_col == "gandalf_ignore"] + [None])[0] # column that says to ignore row
+
+        # If transformed columns contain non-blank 'gandalf_ignore' value,
+        # then skip this row
+        ignore = raw_row.get(ignore_column)
+        if ignore is not None and str(ignore).strip() != "":
+            continue
+
+        # Row after processing
+        row = {}
+
+        # For every column and value in row
+        for colname, value in raw_row.items():
+
+            # Transfrom column name
+            new_colname = colname_map[colname]
+
+            # Integers of typed inputs that need not be parsed
+            if type(value) is int and new_colname in integer_validators:
+                if not integer_validators[new_colname](value):
+                    raise CsvIntegrityError("invalid value: {} (file '{}', row {}, column '{}')"
+                                            .format(repr(value), path, n, colname))
+                row[new_colname] = integer_transformers.get(new_colname, lambda x: x)(value)
+                continue
+
+            # Other typed values are checked as strings
+            if value is None:
+                value = ""
+            elif type(value) in (int, float):
+                value = str(value)
+            elif type(value) is not str:
+                raise CsvIntegrityError("invalid value: {} (file '{}', row {}, column '{}')"
+                                        .format(repr(value), path, n, colname))
+
+            # Strip column value
+            value = value.strip()
+
+            # Check if value is valid
+            try:
+                is_valid = column_validators.get(new_colname, lambda x: True)(value)
+            except ValueError:
+                is_valid = False
+            if not is_valid:
+                raise CsvIntegrityError("invalid value: {} (file '{}', row {}, column '{}')"
+                                        .format(repr(value), path, n, colname))
+
+            # Update column name and value
+            row[new_colname] = column_transformers.get(new_colname, lambda x: x)(value)
+
+        # Yay, seems ok
+        yield n, row
+
+
+def iter_jsonl_rows(path):
+    '''
+        Parse JSON Lines file, where every line is a JSON object with
+        columns of a host (blank lines are skipped), and yield checked
+        rows along with their line numbers (see check_rows). Columns are
+        the keys of all the objects in the order they are first seen;
+        columns that an object lacks are empty. The file is read twice:
+        once to find out the columns and once to yield the rows, so that
+        only one row at a time is kept in memory.
+        Raises (while iterating):
+            IOError if unable to open given file
+            csv.Error if file is invalid
+            CsvIntegrityError if there are invalid values
+    '''
+    def objects(f):
+        for n, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError as exc:
+                raise csv.Error("invalid JSON on line {}: {}".format(n, exc))
+            if not isinstance(obj, dict):
+                raise csv.Error("line {} is not a JSON object".format(n))
+            yield n, obj
+
+    with open(path, "r", encoding="utf8") as f:
+        columns = {}
+        for _, obj in objects(f):
+            columns.update(dict.fromkeys(obj))
+        f.seek(0)
+        yield from check_rows(((n, {colname: obj.get(colname) for colname in columns})
+                               for n, obj in objects(f)), path)
+
+
+def iter_sqlite_rows(path):
+    '''
+        Read hosts from table 'hosts' of SQLite database (or from its
+        only table, if it has one) and yield checked rows along with
+        their numbers (see check_rows). Integer columns are not parsed
+        again.
+        Raises (while iterating):
+            IOError if unable to open given file
+            csv.Error if database or its table is invalid
+            CsvIntegrityError if there are invalid values
+    '''
+    if not os.path.isfile(path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    try:
+        uri = "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(path)))
+        conn = sqlite3.connect(uri, uri=True)
+        try:
+            tables = [name for name, in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+            table = "hosts" if "hosts" in tables else tables[0] if len(tables) == 1 else None
+            if table is None:
+                raise csv.Error("no 'hosts' table in database")
+            cursor = conn.execute('SELECT * FROM "{}" ORDER BY rowid'.format(table.replace('"', '""')))
+            columns = [description[0] for description in cursor.description]
+            rows = ((n, dict(zip(columns, values))) for n, values in enumerate(cursor, start=1))
+            yield from check_rows(rows, path)
+        finally:
+            conn.close()
+    except sqlite3.Error as exc:
+        raise csv.Error("SQLite error: {}".format(exc))
+
+
+def iter_arrow_rows(path):
+    '''
+        Read hosts from columnar Arrow IPC (Feather) or Parquet file and
+        yield checked rows along with their numbers (see check_rows).
+        Arrow files are memory-mapped, so columns are read from the file
+        without copying them; both formats are read in record batches,
+        so only one batch of rows at a time is kept in memory. Typed
+        columns are not parsed again. Requires pyarrow.
+        Raises (while iterating):
+            IOError if unable to open given file
+            csv.Error if file is invalid or pyarrow is not installed
+            CsvIntegrityError if there are invalid values
+    '''
+    # Only the module of the format is imported, which spares
+    # importing Parquet support for Arrow files
+    parquet = path.lower().endswith(".parquet")
+    try:
+        import pyarrow
+        if parquet:
+            import pyarrow.parquet
+        else:
+            import pyarrow.feather
+    except ImportError:
+        raise csv.Error("pyarrow is required to read '{}'".format(path))
+
+    def batches():
+        if parquet:
+            yield from pyarrow.parquet.ParquetFile(path, memory_map=True).iter_batches()
+        else:
+            yield from pyarrow.feather.read_table(path, memory_map=True).to_batches()
+
+    def rows():
+        n = 1
+        for batch in batches():
+            for row in batch.to_pylist():
+                yield n, row
+                n += 1
+
+    if not os.path.isfile(path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    try:
+        yield from check_rows(rows(), path)
+    except pyarrow.ArrowException as exc:
+        raise csv.Error("Arrow error: {}".format(exc))
+
+
+# Readers of inventory files by extension; files of other
+# extensions are read as CSV files
+INVENTORY_READERS = {
+    ".csv": iter_csv_rows,
+    ".jsonl": iter_jsonl_rows,
+    ".ndjson": iter_jsonl_rows,
+    ".sqlite": iter_sqlite_rows,
+    ".sqlite3": iter_sqlite_rows,
+    ".arrow": iter_arrow_rows,
+    ".feather": iter_arrow_rows,
+    ".parquet": iter_arrow_rows
+}
+
+
+def iter_inventory_rows(path):
+    '''
+        Read inventory file of any format that is known by its extension
+        (see INVENTORY_READERS) and yield checked rows along with their
+        numbers. Every format gives the same rows as CSV file does.
+        Raises (while iterating):
+            IOError if unable to open given file
+            csv.Error if file is invalid
+            CsvIntegrityError if there are invalid values
+    '''
+    reader = INVENTORY_READERS.get(os.path.splitext(path)[1].lower(), iter_csv_rows)
+    return reader(path)
+
+
+# Key of variables file that declares derived columns
+DERIVED_COLUMNS_KEY = "gandalf_derived_columns"
+
+# Built-in derived columns: expressions that compute them
+BUILTIN_DERIVED_COLUMNS = {
+    "fqdn": 'hostname + "." + domain',
+    "ip_int": 'ip_to_int(ip)',
+    "rdns_label": 'ip.split(".")[-1]',
+    "net24": 'int_to_ip(ip_to_int(ip) & 0xFFFFFF00) + "/24"',
+    "broadcast": 'int_to_ip(ip_to_int(ip) | ((1 << (32 - mask)) - 1))'
+}
+
+# Functions that expressions of derived columns can use besides builtins
+_DERIVED_GLOBALS = {"ip_to_int": ip_to_int, "int_to_ip": int_to_ip,
+                    "mac_to_int": mac_to_int, "int_to_mac": int_to_mac,
+                    "ipaddress": ipaddress}
+
+
+def derived_columns(var):
+    '''
+        Get derived columns declared in variables file: a mapping of
+        column names to Python expressions over the other columns of
+        a row, evaluated once per row when hosts are loaded, e.g.
+
+            gandalf_derived_columns:
+              fqdn:
+              mgmt_name: hostname + "-mgmt." + domain
+
+        Columns without expression are built-in ones (see
+        BUILTIN_DERIVED_COLUMNS), which may be given as a list as well.
+        Columns are computed in the given order, so expressions may refer
+        to columns declared before.
+        Parameters:
+            var - dict of variables (see load_var)
+        Returns:
+            dict mapping column name to its expression, empty if
+            no columns are declared
+        Raises:
+            ValueError if declaration is not valid
+    '''
+    declared = var.get(DERIVED_COLUMNS_KEY) if isinstance(var, dict) else None
+    if declared is None:
+        return {}
+    if isinstance(declared, list):
+        declared = {name: None for name in declared}
+    if not isinstance(declared, dict):
+        raise ValueError("'{}' must be a mapping of column names to expressions"
+                         .format(DERIVED_COLUMNS_KEY))
+    columns = {}
+    for name, expression in declared.items():
+        if not isinstance(name, str) or not name.isidentifier():
+            raise ValueError("invalid derived column name: {!r}".format(name))
+        if expression is None:
+            if name not in BUILTIN_DERIVED_COLUMNS:
+                raise ValueError("unknown built-in derived column '{}' (use one of: {})"
+                                 .format(name, ", ".join(BUILTIN_DERIVED_COLUMNS)))
+            expression = BUILTIN_DERIVED_COLUMNS[name]
+        if not isinstance(expression, str):
+            raise ValueError("expression of derived column '{}' is not a string".format(name))
+        try:
+            compile(expression, "<derived column '{}'>".format(name), "eval")
+        except SyntaxError as exc:
+            raise ValueError("invalid expression of derived column '{}': {}"
+                             .format(name, exc.msg))
+        columns[name] = expression
+    return columns
+
+
+def derive_columns(rows, columns, csvpath):
+    '''
+        Add derived columns to rows of CSV file as they are loaded, so
+        that they are computed once instead of in every template and view.
+        Expressions are compiled only once and evaluated with values of
+        the row as variables.
+        Parameters:
+            rows - iterable of (row number, row) tuples (see iter_csv_rows)
+            columns - dict mapping column names to expressions
+                      (see derived_columns)
+            csvpath - path to CSV file, for error messages
+        Yields:
+            (row number, row) tuples with derived columns added
+        Raises (while iterating):
+            CsvIntegrityError if file has a column of the same name or
+            an expression can not be evaluated against some row
+    '''
+    compiled = [(name, compile(expression, "<derived column '{}'>".format(name), "eval"))
+                for name, expression in columns.items()]
+    for n, row in rows:
+        for name, code in compiled:
+            if name in row:
+                raise CsvIntegrityError("derived column '{}' is already in file '{}'"
+                                        .format(name, csvpath))
+            try:
+                row[name] = eval(code, _DERIVED_GLOBALS, row)
+            except Exception as exc:
+                raise CsvIntegrityError("unable to compute column '{}': {}: {} (file '{}', row {})"
+                                        .format(name, type(exc).__name__, exc, csvpath, n))
+        yield n, row
+
+
+def find_csv_files(paths):
+    '''
+        Find CSV files (and inventory files of other formats, see
+        INVENTORY_READERS) to load hosts from.
+        Parameters:
+            paths - list of paths to CSV files or directories;
+                    directories are searched for '*.csv' files (and
+                    files of other formats) recursively
+        Returns:
+            list of paths to CSV files, files of every directory are sorted,
+            every file is listed only once
+    '''
+    csvfiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                csvfiles.extend(os.path.join(dirpath, filename) for filename in sorted(filenames)
+                                if os.path.splitext(filename)[1].lower() in INVENTORY_READERS)
+        else:
+            csvfiles.append(path)
+    seen = set()
+    return [path for path in csvfiles if not (os.path.normpath(path) in seen
+            or seen.add(os.path.normpath(path)))]
+
+
+def merge_csv_files(csvfiles, parsed, sources):
+    '''
+        Chain rows of several CSV files and remember where every row comes
+        from. Conflicts between files are checked later (see check_conflicts).
+        Parameters:
+            csvfiles - list of paths to CSV files
+            parsed - iterable of iterables of (row number, row) tuples
+                     (as yielded by iter_csv_rows), one for every file
+            sources - tuple of list of file paths, array of file indexes
+                      and array of row numbers, which is filled in
+                      (see HostDB)
+        Yields:
+            rows
+        Raises (while iterating):
+            csv.Error and CsvIntegrityError as iter_csv_rows does
+    '''
+    files, indexes, row_numbers = sources
+    parsed = iter(parsed)
+    for index, path in enumerate(csvfiles):
+        files.append(path)
+        try:
+            for n, row in next(parsed):
+                indexes.append(index)
+                row_numbers.append(n)
+                yield row
+        except csv.Error as exc:
+            raise csv.Error("{} (file '{}')".format(exc, path)) from exc
+
+
+def check_conflicts(db):
+    '''
+        Report all the hosts that conflict with each other at once (see
+        HostDB.conflicts), before anything is rendered. It is an error if
+        a host name, IP address or MAC address is defined in more than one
+        CSV file. Within one file IP address may be shared (e.g. by aliases),
+        while a shared host name or MAC address is logged as a warning.
+        Parameters:
+            db - HostDB instance that knows sources of hosts
+        Raises:
+            CsvIntegrityError listing all the errors, one per line
+    '''
+    errors = []
+    for kind, value, doc_ids in db.conflicts():
+        sources = [db.source(doc_id) or (None, doc_id) for doc_id in doc_ids]
+        places = ["'{}' (row {})".format(path, n) if path is not None else "host {}".format(n)
+                  for path, n in sources]
+        message = "{} {} is defined in {}".format(kind, value,
+            "both {} and {}".format(*places) if len(places) == 2 else
+            "{} and {}".format(", ".join(places[:-1]), places[-1]))
+        if len({path for path, _ in sources}) > 1:
+            errors.append(message)
+        elif kind != "IP address":
+            logging.warning(message)
+    if errors:
+        raise CsvIntegrityError("\n".join(errors))
+
+
+def _parse_csv_file(csvpath):
+    '''
+        Parse inventory file in a load_hosts() worker process.
+        Returns list of (row number, row) tuples.
+    '''
+    return list(iter_inventory_rows(csvpath))
+
+
+def find_templates(inpath, outpath, dnspath):
+    '''
+        Recursively find all template files in a given inpath
+        and yield tuples of (template_path, output_path, dns_path).
+        Parameters:
+            inpath - path to template file or directory with those files
+            outpath - base path of output files
+            dnspath - base path of existing DNS files
+        Returns:
+            For each found template file yield a tuple of
+            (template_path, output_path, dns_path), where the first value
+            is path to found template file, second value is
+            a path to the output file for this template,
+            an third value is just the same file under dnspath
+    '''
+    if not os.path.isdir(inpath):
+        if not os.path.isdir(outpath):
+            outfile = outpath
+        else:
+            outfile = os.path.join(outpath, os.path.basename(inpath))
+        if '\000' in dnspath or not os.path.isdir(dnspath):
+            dnsfile = dnspath
+        else:
+            dnsfile = os.path.join(dnspath, os.path.basename(inpath))
+        yield (inpath, outfile, dnsfile)
+    else:
+        for root, dirs, files in os.walk(inpath):
+            for filename in files:
+                template_path = os.path.join(root, filename)
+                output_path = os.path.join(outpath, root[len(inpath):].strip("/"), filename)
+                dns_path = os.path.join(dnspath, root[len(inpath):].strip("/"), filename)
+                yield template_path, output_path, dns_path
+
+
+# Mako comment line that declares fan-out key of a template,
+# e.g. '## fan-out: vlan' (see fan_out_templates)
+FAN_OUT_DIRECTIVE = "fan-out:"
+
+
+def read_fan_out_key(path):
+    '''
+        Find fan-out key that template declares in a comment line
+        like '## fan-out: vlan'.
+        Returns:
+            fan-out key or None if template does not declare it
+        Raises:
+            IOError if unable to read template file
+            ValueError if the key is not valid (see HostDB.parse_group_key)
+    '''
+    with open(path, "r", encoding="utf8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("##") and line[2:].strip().startswith(FAN_OUT_DIRECTIVE):
+                key = line[2:].strip()[len(FAN_OUT_DIRECTIVE):].strip()
+                HostDB.parse_group_key(key)
+                return key
+    return None
+
+
+def fan_out_path(path, name):
+    '''
+        Get path of output file of a fan-out group: '{}' in file name is
+        replaced with group name, otherwise group name is appended to file
+        name after a dot. '.mako' extension is stripped.
+    '''
+    dirname, filename = os.path.split(strip_mako_extension(path))
+    if "{}" in filename:
+        filename = filename.replace("{}", name)
+    else:
+        filename = "{}.{}".format(filename, name)
+    return os.path.join(dirname, filename)
+
+
+def fan_out_templates(templates, db):
+    '''
+        Expand templates that declare a fan-out key (see read_fan_out_key)
+        into one task per group of hosts, so that such template is rendered
+        once for every VLAN, cluster, /24 network etc. Hosts are grouped
+        once per key for all the templates (see HostDB.group_names).
+        Groups whose names can not be used in file names are left out.
+        Errors are logged.
+        Parameters:
+            templates - list of (template_path, output_path, dns_path)
+                        tuples as yielded by find_templates
+            db - HostDB instance with hosts
+        Returns:
+            list of (template_path, output_path, dns_path) tuples of ordinary
+            templates and (template_path, output_path, dns_path, (key, name))
+            tuples of groups of fan-out templates
+    '''
+    tasks = []
+    for infile, outfile, dnsfile in templates:
+        try:
+            key = read_fan_out_key(infile)
+        except IOError:
+            key = None # render_template reports it
+        except ValueError as exc:
+            logging.error("invalid fan-out key in template '{}': {}".format(infile, exc))
+            continue
+        if key is None:
+            tasks.append((infile, outfile, dnsfile))
+            continue
+        for name in db.group_names(key):
+            if name in (".", "..") or "/" in name or "\000" in name:
+                logging.error("group '{}' of template '{}' can not be used in file name"
+                              .format(name, infile))
+                continue
+            tasks.append((infile, fan_out_path(outfile, name), fan_out_path(dnsfile, name),
+                          (key, name)))
+    return tasks
+
+
+def relative_output(outfile, outpath):
+    '''
+        Get path of output file relative to output path given on
+        command line ('.mako' extension is stripped). If output path
+        is the output file itself, its file name is returned.
+    '''
+    relpath = os.path.relpath(strip_mako_extension(outfile), outpath)
+    if relpath == "." or relpath.startswith(".."):
+        relpath = os.path.basename(strip_mako_extension(outfile))
+    return relpath
+
+
+def parse_shard(text):
+    '''
+        Parse shard given as 'I/N': I-th shard of N, counting from 1.
+        Returns:
+            tuple of shard number and number of shards
+        Raises:
+            ValueError if text is not a valid shard
+    '''
+    shard, slash, count = text.partition("/")
+    if not slash or not shard.isdigit() or not count.isdigit() \
+            or not 1 <= int(shard) <= int(count):
+        raise ValueError("invalid shard: '{}' (use 'I/N' with I from 1 to N)".format(text))
+    return int(shard), int(count)
+
+
+def shard_templates(templates, shard, count, outpath, costs=None):
+    '''
+        Split templates into shards deterministically and get the ones
+        of a given shard, so that several machines can render the whole
+        tree from the same inputs, each its own share. Templates are
+        weighed by their cost, e.g. rendering time from the last run
+        (templates of unknown cost weigh as much as an average one),
+        and given out heaviest first to the shard that has the least
+        weight so far. Every shard gets the same split as long as
+        it is given the same templates and costs.
+        Parameters:
+            templates - list of (template_path, output_path, dns_path[, group])
+                        tuples as returned by fan_out_templates
+            shard - shard number, from 1 to count
+            count - number of shards
+            outpath - output path given on command line
+            costs - dict mapping output file (see relative_output) to its cost
+        Returns:
+            list of templates of the shard, in the same order
+    '''
+    costs = costs or {}
+    keys = [relative_output(task[1], outpath) for task in templates]
+    known = [costs[key] for key in keys if key in costs]
+    default = sum(known) / len(known) if known else 1.0
+    order = sorted(range(len(templates)), key=lambda n: (-costs.get(keys[n], default), keys[n]))
+
+    loads = [(0.0, n) for n in range(1, count + 1)]
+    mine = set()
+    for n in order:
+        load, owner = heapq.heappop(loads)
+        if owner == shard:
+            mine.add(n)
+        heapq.heappush(loads, (load + costs.get(keys[n], default), owner))
+    return [task for n, task in enumerate(templates) if n in mine]
+
+
+# Format version of shard manifests
+SHARD_MANIFEST_VERSION = 1
+
+
+def load_shard_costs(path):
+    '''
+        Load costs of output files from a file written by merge_shards
+        (or from a shard manifest).
+        Returns:
+            dict mapping output file to its cost
+        Raises:
+            IOError if unable to read file
+            ValueError if file is not valid
+    '''
+    with open(path, "r", encoding="utf8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get("version") != SHARD_MANIFEST_VERSION \
+            or not isinstance(data.get("costs"), dict):
+        raise ValueError("not a valid costs file")
+    return data["costs"]
+
+
+def write_shard_manifest(path, shard, count, templates, tasks, entries, outpath):
+    '''
+        Write manifest of a shard: the whole tree of output files that
+        was split into shards, the ones of this shard, the ones that were
+        rendered and their costs, so that merge_shards can check shards
+        against each other.
+        Parameters:
+            path - path to manifest file
+            shard, count - shard number and number of shards
+            templates - all the templates (see shard_templates)
+            tasks - templates of this shard
+            entries - manifest entries of output files of this shard
+            outpath - output path given on command line
+        Raises:
+            IOError if unable to write manifest
+    '''
+    manifest = {
+        "version": SHARD_MANIFEST_VERSION,
+        "shard": shard,
+        "shards": count,
+        "tree": sorted(relative_output(task[1], outpath) for task in templates),
+        "assigned": sorted(relative_output(task[1], outpath) for task in tasks),
+        "rendered": sorted(relative_output(entry["output"], outpath) for entry in entries),
+        "costs": {relative_output(entry["output"], outpath): entry["cost"]
+                  for entry in entries if "cost" in entry}
+    }
+    write_file_atomic(path, json.dumps(manifest, indent=1, sort_keys=True).encode("utf8"))
+
+
+def merge_shards(manifests):
+    '''
+        Check that shards cover the whole tree of output files exactly
+        once: every shard of the same split is there once, every output
+        file is assigned to exactly one shard and was rendered by it.
+        Parameters:
+            manifests - list of shard manifests (see write_shard_manifest)
+        Returns:
+            tuple of list of errors and dict of costs of all the output
+            files, to weigh templates of the next run with
+    '''
+    errors = []
+    if not manifests:
+        return ["no shard manifests"], {}
+    count, tree = manifests[0]["shards"], manifests[0]["tree"]
+    shards = sorted(manifest["shard"] for manifest in manifests)
+    if shards != list(range(1, count + 1)):
+        errors.append("expected shards 1 to {}, got {}".format(
+            count, ", ".join(str(shard) for shard in shards)))
+    for manifest in manifests[1:]:
+        if manifest["shards"] != count or manifest["tree"] != tree:
+            errors.append("shard {} split another tree of outputs or into another "
+                          "number of shards".format(manifest["shard"]))
+
+    owners, rendered, costs = {}, set(), {}
+    for manifest in manifests:
+        for output in manifest["assigned"]:
+            owners.setdefault(output, []).append(manifest["shard"])
+        rendered.update(manifest["rendered"])
+        costs.update(manifest["costs"])
+    for output in tree:
+        if output not in owners:
+            errors.append("output '{}' is not assigned to any shard".format(output))
+        elif len(owners[output]) > 1:
+            errors.append("output '{}' is assigned to shards {}".format(
+                output, ", ".join(str(shard) for shard in sorted(owners[output]))))
+        elif output not in rendered:
+            errors.append("output '{}' failed to render in shard {}".format(
+                output, owners[output][0]))
+    errors.extend("output '{}' is not in the tree".format(output)
+                  for output in sorted(set(owners) - set(tree)))
+    return errors, costs
+
+
+def merge_shards_main(argv):
+    '''
+        Command 'merge-shards': check manifests of all the shards of a run
+        (see merge_shards) and optionally write costs of output files
+        for the next run. Exits with status 0 if shards cover the whole
+        tree exactly once.
+    '''
+    parser = argparse.ArgumentParser(prog="gandalf merge-shards")
+    parser.add_argument("manifests", metavar="MANIFEST", nargs="+",
+                        help="shard manifests written with --shard-manifest")
+    parser.add_argument("-o", "--costs", metavar="COSTFILE",
+                        help="write costs of output files into COSTFILE "
+                             "(to be given with --shard-costs next time)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    manifests = []
+    for path in args.manifests:
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") != SHARD_MANIFEST_VERSION or not all(key in manifest
+                    for key in ("shard", "shards", "tree", "assigned", "rendered", "costs")):
+                raise ValueError("unsupported version")
+        except IOError as exc:
+            logging.fatal("unable to open '{}': {}".format(path, exc.strerror))
+            return sys.exit(1)
+        except (ValueError, AttributeError) as exc:
+            logging.fatal("invalid shard manifest '{}': {}".format(path, exc))
+            return sys.exit(2)
+        manifests.append(manifest)
+
+    errors, costs = merge_shards(manifests)
+    for error in errors:
+        logging.error(error)
+    if args.costs:
+        try:
+            write_file_atomic(args.costs, json.dumps({"version": SHARD_MANIFEST_VERSION,
+                "costs": costs}, indent=1, sort_keys=True).encode("utf8"))
+        except IOError as exc:
+            logging.fatal("could not write costs file '{}': {}".format(args.costs, exc.strerror))
+            return sys.exit(1)
+    if errors:
+        return sys.exit(3)
+    logging.info("{} shards cover all {} outputs".format(len(manifests), len(manifests[0]["tree"])))
+    return sys.exit(0)
+
+
+def read_text(path):
+    '''
+        Read text file.
+        Raises:
+            IOError if unable to read file
+    '''
+    with open(path, "r") as f:
+        return f.read()
+
+
+def apply_dns_version_hack(text, dnsfile, zone_state=None, read=read_text):
+    '''
+        Replace DNS_HACK_ANCHOR with an appropriate DNS file version number.
+        Parameters:
+            text - string conraining rendered template
+            dnsfile - path to dns file that rendered template is compared against
+                (does not need to be existing file or even a valid DNS zone file)
+            zone_state - dict with 'serial' and 'digest' of the zone as it was
+                rendered last time (see DnsState). If it has a digest, the zone
+                is compared by digest and dnsfile is not read at all.
+                The dict is updated with the new serial and digest.
+            read - function that reads dnsfile (e.g. BackgroundIO.read)
+        Returns:
+            text where DNS_HACK_ANCHOR is replaced with DNS file version
+    '''
+    digest = dns_digest(text) if zone_state is not None else None
+    if zone_state is not None and zone_state.get("digest"):
+        old_version = zone_state.get("serial", 0)
+        changed = digest != zone_state["digest"] or not old_version
+    else:
+        try:
+            old_text = read(dnsfile)
+        except (IOError, ValueError, TypeError):
+            changed = True # consider that the file has changed
+            old_version = 0 # fake last version of a file
+        else:
+            old_version = parse_dns_version(old_text)
+            changed = dns_changed(text, old_text) or not old_version
+
+    version = next_dns_version(old_version, changed)
+
+    # Remember the zone state for the next time
+    if zone_state is not None:
+        zone_state["serial"] = version
+        zone_state["digest"] = digest
+
+    return text.replace(DNS_HACK_ANCHOR, str(version))
+
+
+def next_dns_version(old_version, changed):
+    '''
+        Decide DNS file version number: if the zone has not changed,
+        its old version is kept, otherwise it is today's date followed
+        by two digits (or the old version plus one if that is greater).
+        Parameters:
+            old_version - old version number (0 if unknown)
+            changed - whether zone has changed
+    '''
+    # Candidate for a current version of file if changed
+    version_candidate = int(datetime.datetime.strftime(datetime.datetime.now(), "%Y%m%d") + "00")
+
+    if not changed:
+        return old_version
+    return old_version + 1 if version_candidate <= old_version else version_candidate
+
+
+def dns_changed(this_dns, other_dns):
+    '''
+        Return True if there is something different between the two DNS file texts.
+        Parameters:
+            this_dns, other_dns - DNS file contents to compare
+        Returns:
+            True or False
+    '''
+    # Compare signatures and return results
+    return dns_signature(this_dns) != dns_signature(other_dns)
+
+
+def dns_signature(text):
+    '''
+        Get a signature of DNS file text: its contents without comments,
+        version line and insignificant whitespace.
+        Parameters:
+            text - DNS file contents
+        Returns:
+            string that is the same for equivalent DNS files
+    '''
+    return " ".join(_dns_signature_lines(text.split('\n')))
+
+
+def _dns_signature_lines(lines):
+    '''
+        Yield non-empty lines of DNS file signature (see dns_signature).
+    '''
+    line_codephrase = DNS_HACK_COMMENT.split()[-1]
+    for line in lines:
+        if line_codephrase not in line:
+            line = " ".join(line.split(";")[0].strip().split())
+            if line:
+                yield line
+
+
+def dns_digest(text):
+    '''
+        Get SHA-256 hex digest of DNS file signature (see dns_signature).
+    '''
+    return hashlib.sha256(dns_signature(text).encode("utf8")).hexdigest()
+
+
+def dns_lines_digest(lines):
+    '''
+        Get the same digest as dns_digest does, but from an iterable
+        of lines of DNS file, so that the file does not have to be
+        read into memory as a whole.
+    '''
+    digest = hashlib.sha256()
+    separator = b""
+    for line in _dns_signature_lines(lines):
+        digest.update(separator + line.encode("utf8"))
+        separator = b" "
+    return digest.hexdigest()
+
+
+def read_dns_file(path):
+    '''
+        Read DNS zone file line by line and get its version number (see
+        parse_dns_version) and signature digest (see dns_lines_digest).
+        Returns:
+            tuple of version number and digest
+        Raises:
+            IOError if unable to read file
+    '''
+    line_codephrase = DNS_HACK_COMMENT.split()[-1]
+    version = None
+    def scan(lines):
+        nonlocal version
+        for line in lines:
+            if version is None and line_codephrase in line:
+                version = parse_dns_version(line)
+            yield line
+    with open(path, "r") as f:
+        digest = dns_lines_digest(scan(f))
+    return version or 0, digest
+
+
+def parse_dns_version(text):
+    '''
+        Get dns version from DNS zone file text.
+        Parameters:
+            text - DNS file contents
+        Returns:
+            DNS zone number or 0 if not found
+    '''
+    line_codephrase = DNS_HACK_COMMENT.split()[-1]
+    try:
+        line = next(line for line in text.split('\n') if line_codephrase in line)
+    except StopIteration:
+        return 0
+    try:
+        return int(line.split(";")[0].split()[-1])
+    except (ValueError, IndexError):
+        return 0
+
+
+class DnsState:
+    '''
+        Persistent state of DNS zones: serial and signature digest of every
+        zone as it was rendered last time. With this state new serials are
+        decided by comparing digests, without reading old zone files.
+        Zones are identified by paths of output files.
+    '''
+
+    # State file format version
+    VERSION = 1
+
+    def __init__(self, zones=None):
+        '''
+            Parameters:
+                zones - dict mapping zone to dict with 'serial' and 'digest'
+        '''
+        self.zones = zones or {}
+
+    @classmethod
+    def load(cls, path):
+        '''
+            Load state from file. Missing file is treated as empty state.
+            Raises:
+                IOError if unable to read existing file
+                ValueError if file is not a valid state file
+        '''
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        if not isinstance(state, dict) or state.get("version") != cls.VERSION \
+                or not isinstance(state.get("zones"), dict):
+            raise ValueError("not a valid DNS state file")
+        return cls(state["zones"])
+
+    def save(self, path):
+        '''
+            Save state to file. The file is replaced atomically.
+            Raises IOError if unable to write file.
+        '''
+        state = {"version": self.VERSION, "zones": self.zones}
+        write_file_atomic(path, json.dumps(state, indent=1, sort_keys=True).encode("utf8"))
+
+    def get(self, zone):
+        '''
+            Get a copy of zone state (empty dict for unknown zone).
+        '''
+        return dict(self.zones.get(zone, {}))
+
+
+# Classes of DNS records and units of TTL values in zone files
+_ZONE_CLASSES = {"IN", "CH", "HS", "CS"}
+_TTL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# Fields of record data that are domain names, by record type
+_NAME_FIELDS = {"NS": (0,), "CNAME": (0,), "PTR": (0,), "DNAME": (0,),
+                "MX": (1,), "SRV": (3,), "SOA": (0, 1)}
+
+# Tokens of a zone file line: quoted string, parenthesis, comment or word
+_ZONE_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[()]|;.*|[^\s;()"]+')
+_ZONE_SPECIAL_RE = re.compile(r'[";()]')
+
+
+def parse_ttl(text):
+    '''
+        Parse TTL value of zone file, either in seconds or with units
+        like '1h30m' or '90d'.
+        Returns:
+            number of seconds
+        Raises:
+            ValueError if text is not a TTL value
+    '''
+    if text.isdigit():
+        return int(text)
+    parts = re.findall(r"(\d+)([smhdw])", text.lower())
+    if not parts or "".join(n + unit for n, unit in parts) != text.lower():
+        raise ValueError("invalid TTL value: '{}'".format(text))
+    return sum(int(n) * _TTL_UNITS[unit] for n, unit in parts)
+
+
+def _zone_entries(lines):
+    '''
+        Yield entries of zone file (records and directives, which may span
+        several lines in parentheses) as tuples of whether the entry has
+        no owner name (the line starts with a blank) and list of its tokens.
+        Raises:
+            ValueError if parentheses are not balanced
+    '''
+    tokens, depth, no_owner = [], 0, False
+    for line in lines:
+        if not depth:
+            tokens, no_owner = [], line[:1] in (" ", "\t")
+
+        # Most lines have neither quotes nor parentheses nor comments
+        if not _ZONE_SPECIAL_RE.search(line):
+            tokens.extend(line.split())
+            if not depth and tokens:
+                yield no_owner, tokens
+            continue
+
+        for token in _ZONE_TOKEN_RE.findall(line):
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+                if depth < 0:
+                    raise ValueError("unbalanced parentheses in zone file")
+            elif not token.startswith(";"):
+                tokens.append(token)
+        if not depth and tokens:
+            yield no_owner, tokens
+    if depth:
+        raise ValueError("unbalanced parentheses in zone file")
+
+
+def _absolute_name(name, origin):
+    '''
+        Make domain name of zone file absolute and lowercase.
+        Raises:
+            ValueError if name is relative and there is no origin
+    '''
+    if name == "@":
+        name = origin
+    elif not name.endswith("."):
+        if origin is None:
+            raise ValueError("relative name '{}' without $ORIGIN".format(name))
+        name = "{}.{}".format(name, origin) if origin != "." else name + "."
+    if name is None:
+        raise ValueError("'@' without $ORIGIN")
+    return name.lower()
+
+
+def parse_zone(lines):
+    '''
+        Parse records of zone file. Names (owners and names in record data)
+        are made absolute and lowercase, TTL values are converted to seconds.
+        Parameters:
+            lines - iterable of lines of zone file
+        Returns:
+            tuple of zone name (owner of SOA record) and set of records,
+            which are (name, ttl, class, type, data) tuples
+        Raises:
+            ValueError if zone file is not valid or uses directives other
+            than $ORIGIN and $TTL
+    '''
+    origin = default_ttl = last_ttl = owner = zone = None
+    last_class = "IN"
+    records = set()
+    for no_owner, tokens in _zone_entries(lines):
+
+        # Directives
+        if tokens[0].startswith("$"):
+            directive = tokens[0].upper()
+            if directive == "$ORIGIN" and len(tokens) == 2:
+                origin = _absolute_name(tokens[1], origin)
+            elif directive == "$TTL" and len(tokens) == 2:
+                default_ttl = parse_ttl(tokens[1])
+            else:
+                raise ValueError("unsupported directive: '{}'".format(" ".join(tokens)))
+            continue
+
+        # Owner, TTL and class (the last two in any order) of a record
+        if not no_owner:
+            owner = _absolute_name(tokens.pop(0), origin)
+        elif owner is None:
+            raise ValueError("record without owner: '{}'".format(" ".join(tokens)))
+        ttl = class_ = None
+        while tokens:
+            if class_ is None and tokens[0].upper() in _ZONE_CLASSES:
+                class_ = tokens.pop(0).upper()
+            elif ttl is None and tokens[0][:1].isdigit():
+                ttl = parse_ttl(tokens.pop(0))
+            else:
+                break
+        if not tokens:
+            raise ValueError("record without type at '{}'".format(owner))
+        if ttl is None:
+            ttl = default_ttl if default_ttl is not None else last_ttl
+        if ttl is None:
+            raise ValueError("record without TTL at '{}'".format(owner))
+        last_ttl, last_class = ttl, class_ or last_class
+
+        # Record type and data
+        type_, data = tokens[0].upper(), tokens[1:]
+        if type_ == "SOA":
+            if zone is not None:
+                raise ValueError("more than one SOA record")
+            zone = owner
+            if len(data) == 7:
+                data[3:] = [str(parse_ttl(value)) for value in data[3:]]
+        if type_ != "SOA" or len(data) == 7: # other SOA records are kept as they are
+            for n in _NAME_FIELDS.get(type_, ()):
+                if n < len(data):
+                    data[n] = _absolute_name(data[n], origin)
+        records.add((owner, ttl, last_class, type_, " ".join(data)))
+
+    if zone is None:
+        raise ValueError("no SOA record in zone file")
+    return zone, records
+
+
+def nsupdate_script(old_lines, new_lines):
+    '''
+        Make nsupdate script that turns old zone into the new one with
+        a single RFC 2136 dynamic update: records that are gone are deleted
+        and new records are added. Changed SOA record is added only, as the
+        server replaces SOA record with the one that is added (SOA record
+        that is not valid is left out, the server increments serial then).
+        Parameters:
+            old_lines, new_lines - iterables of lines of old and new zone file
+        Returns:
+            text of nsupdate script or None if zones have the same records
+        Raises:
+            ValueError if zone file is not valid (see parse_zone)
+                       or zones have different names
+    '''
+    zone, old = parse_zone(old_lines)
+    new_zone, new = parse_zone(new_lines)
+    if zone != new_zone:
+        raise ValueError("zone '{}' was renamed to '{}'".format(zone, new_zone))
+    removed = sorted(record for record in old - new if record[3] != "SOA")
+    added = sorted(record for record in new - old
+                   if record[3] != "SOA" or len(record[4].split()) == 7)
+    if not removed and not added:
+        return None
+
+    lines = ["; changes of zone {}: records deleted: {}, added: {}".format(
+                 zone, len(removed), len(added)),
+             "zone {}".format(zone)]
+    lines.extend("update delete {} {} {} {}".format(name, class_, type_, data)
+                 for name, ttl, class_, type_, data in removed)
+    lines.extend("update add {} {} {} {} {}".format(name, ttl, class_, type_, data)
+                 for name, ttl, class_, type_, data in added)
+    lines.append("send")
+    return "\n".join(lines) + "\n"
+
+
+def nsupdate_path(outfile, outpath, nsupdate_dir):
+    '''
+        Get path of nsupdate script of output file: the script is put
+        into nsupdate_dir the same way output file is put into outpath,
+        with '.nsupdate' extension added.
+    '''
+    return os.path.join(nsupdate_dir, relative_output(outfile, outpath) + ".nsupdate")
+
+
+def write_nsupdate(path, old_lines, new_lines):
+    '''
+        Write nsupdate script (see nsupdate_script) of a zone. If the zone
+        has the same records as the old one or there is no old zone,
+        script of the previous run is removed instead.
+        Parameters:
+            path - path to script file
+            old_lines - iterable of lines of old zone file, None if there is none
+            new_lines - iterable of lines of new zone file
+        Returns:
+            True if script was written, False otherwise
+        Raises:
+            IOError if unable to write script
+            ValueError if zone file is not valid (see nsupdate_script)
+    '''
+    script = nsupdate_script(old_lines, new_lines) if old_lines is not None else None
+    if script is None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return False
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file_atomic(path, script.encode("utf8"))
+    return True
+
+
+def compile_template(infile, cache_dir=None, compiled=None):
+    '''
+        Create Mako template from file.
+        If compiled dict is given, then templates are kept in it and reused
+        for as long as modification time and size of template file stay the
+        same, which saves compiling templates again in long-running process.
+        If cache_dir is given, then Python module that the template is
+        compiled into is stored in this directory and reused later on,
+        so that the template is not lexed, parsed and compiled again.
+        Cached module name is derived from template path and SHA-256 hash of
+        its contents, so editing a template always yields a new module, and
+        Mako itself recompiles the module if template is newer than that.
+        Modules are written into temporary files and atomically renamed,
+        so the same cache directory can be shared by concurrent processes.
+        Parameters:
+            infile - path to template file
+            cache_dir - directory for compiled modules (optional)
+            compiled - dict mapping template path to its compiled template
+                       (optional)
+        Returns:
+            mako.template.Template instance
+        Raises:
+            IOError if unable to read template file
+            mako.exceptions.MakoException if template is invalid
+    '''
+    if compiled is not None:
+        st = os.stat(infile)
+        key = (st.st_mtime_ns, st.st_size)
+        if infile in compiled and compiled[infile][0] == key:
+            return compiled[infile][1]
+        template = compile_template(infile, cache_dir)
+        compiled[infile] = (key, template)
+        return template
+
+    if cache_dir is None:
+        return mako.template.Template(filename=infile)
+
+    # Key module by template location, contents and Mako version
+    with open(infile, "rb") as f:
+        digest = hashlib.sha256(f.read())
+    digest.update(os.path.abspath(infile).encode("utf8"))
+    digest.update(mako.__version__.encode("utf8"))
+    module_name = "{}-{}.py".format(os.path.basename(infile).replace(".", "_"),
+                                    digest.hexdigest()[:32])
+
+    return mako.template.Template(filename=infile,
+            module_filename=os.path.join(os.path.abspath(cache_dir), module_name))
+
+
+class BackgroundIO:
+    '''
+        Pool of threads that does file I/O of render_template in the
+        background: old DNS files of upcoming templates are read ahead and
+        outputs are written while the next templates are being rendered.
+        The number of outputs waiting to be written is bounded, so that
+        rendered texts do not pile up in memory if writing is slower than
+        rendering. Prefetching and reading are meant to be done by one
+        thread only.
+    '''
+
+    def __init__(self, threads, max_pending=None):
+        '''
+            Parameters:
+                threads - number of I/O threads
+                max_pending - maximum number of outputs waiting to be written
+                              (default: twice the number of threads)
+        '''
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._pending = threading.BoundedSemaphore(max_pending or 2 * threads)
+        self._reads = {} # path -> future of its contents
+        self.read_paths = set() # paths of the files that have been read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''
+            Wait until everything is written and stop the threads.
+        '''
+        self._executor.shutdown(wait=True)
+
+    def prefetch(self, path):
+        '''
+            Start reading a text file unless it is already being read.
+        '''
+        if path not in self._reads:
+            self._reads[path] = self._executor.submit(read_text, path)
+
+    def read(self, path):
+        '''
+            Get contents of a text file, either prefetched or read right now.
+            Raises:
+                IOError if unable to read file
+        '''
+        self.read_paths.add(path)
+        future = self._reads.pop(path, None)
+        if future is None:
+            return read_text(path)
+        return future.result()
+
+    def discard(self, path):
+        '''
+            Forget prefetched contents of a file that is not needed.
+        '''
+        self._reads.pop(path, None)
+
+    def submit(self, func, *args):
+        '''
+            Call function with arguments in the background. Blocks while
+            there are too many calls waiting to be done.
+            Returns:
+                concurrent.futures.Future of the result
+        '''
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda future: self._pending.release())
+        return future
+
+
+class OutputStream:
+    '''
+        Output file that a template is rendered into piece by piece (it is
+        used as Mako buffer), so that the rendered text is never kept in
+        memory as a whole. Text is encoded and written in chunks into a
+        temporary file next to the output file, which then replaces the
+        output file unless it already has the same contents, just like
+        write_output does it. DNS_HACK_ANCHOR is looked for on the way and
+        replaced with DNS version afterwards, line by line.
+    '''
+
+    # Number of characters collected before they are written
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, path):
+        '''
+            Parameters:
+                path - path to output file; its directory must exist
+            Raises:
+                IOError if unable to create temporary file
+        '''
+        self.path = path
+        self.has_dns_anchor = False
+        self.error = None # error while writing temporary file
+        self._tmp_path = _atomic_tmp_path(path)
+        self._file = open(self._tmp_path, "wb")
+        self._digest = hashlib.sha256()
+        self._size = 0
+        self._pending = [] # pieces of text not written yet
+        self._pending_size = 0
+
+    def write(self, text):
+        '''
+            Add text to the output.
+            Raises:
+                IOError if unable to write temporary file
+        '''
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= self.CHUNK_SIZE:
+            # Keep the end of text that may be the beginning of anchor
+            self._write_pending(keep=len(DNS_HACK_ANCHOR) - 1)
+
+    def _write_pending(self, keep=0):
+        text = "".join(self._pending)
+        if DNS_HACK_ANCHOR in text:
+            self.has_dns_anchor = True
+        keep = min(keep, len(text))
+        self._pending = [text[len(text) - keep:]] if keep else []
+        self._pending_size = keep
+        try:
+            self._write_data(text[:len(text) - keep].encode("utf8"))
+        except IOError as exc:
+            self.error = exc # so that it is not taken for template error
+            raise
+
+    def _write_data(self, data):
+        self._digest.update(data)
+        self._size += len(data)
+        self._file.write(data)
+
+    def close(self):
+        '''
+            Write the rest of the output into temporary file.
+            Raises:
+                IOError if unable to write temporary file
+        '''
+        try:
+            self._write_pending()
+        finally:
+            try:
+                self._file.close()
+            except IOError as exc:
+                self.error = exc
+                raise
+
+    def discard(self):
+        '''
+            Remove temporary file, leaving output file untouched.
+        '''
+        self._file.close()
+        _unlink_quietly(self._tmp_path)
+
+    def apply_dns_version_hack(self, dnsfile, zone_state=None):
+        '''
+            Replace DNS_HACK_ANCHOR in closed output with DNS version, which is
+            decided just like apply_dns_version_hack does it, except that
+            old DNS file is compared by signature digest (see read_dns_file).
+            Parameters:
+                dnsfile, zone_state - see apply_dns_version_hack
+            Raises:
+                IOError if unable to read or write temporary file
+        '''
+        def output_digest():
+            with open(self._tmp_path, "rb") as f:
+                return dns_lines_digest(line.decode("utf8") for line in f)
+
+        # Digest of the output is computed only if it is needed
+        digest = output_digest() if zone_state is not None else None
+        if zone_state is not None and zone_state.get("digest"):
+            old_version = zone_state.get("serial", 0)
+            changed = digest != zone_state["digest"] or not old_version
+        else:
+            try:
+                old_version, old_digest = read_dns_file(dnsfile)
+            except (IOError, ValueError, TypeError):
+                changed = True # consider that the file has changed
+                old_version = 0 # fake last version of a file
+            else:
+                changed = (digest or output_digest()) != old_digest or not old_version
+        version = next_dns_version(old_version, changed)
+
+        # Remember the zone state for the next time
+        if zone_state is not None:
+            zone_state["serial"] = version
+            zone_state["digest"] = digest
+
+        # Copy the output into another temporary file with version in place
+        anchor, version = DNS_HACK_ANCHOR.encode("utf8"), str(version).encode("utf8")
+        tmp_path = _atomic_tmp_path(self.path, "dns.tmp")
+        self._digest, self._size = hashlib.sha256(), 0
+        try:
+            with open(self._tmp_path, "rb") as f:
+                self._file = open(tmp_path, "wb")
+                with self._file:
+                    for line in f:
+                        self._write_data(line.replace(anchor, version))
+        except IOError:
+            _unlink_quietly(tmp_path)
+            raise
+        _unlink_quietly(self._tmp_path)
+        self._tmp_path = tmp_path
+
+    def lines(self):
+        '''
+            Yield lines of closed output, read back from temporary file.
+            Raises:
+                IOError if unable to read temporary file
+        '''
+        with open(self._tmp_path, "r", encoding="utf8") as f:
+            yield from f
+
+    def commit(self):
+        '''
+            Replace output file with closed output unless it is the same.
+            Returns:
+                True if output file was written, False if it was left untouched
+            Raises:
+                IOError if unable to replace output file
+        '''
+        try:
+            unchanged = os.path.getsize(self.path) == self._size and \
+                        file_digest(self.path) == self._digest.hexdigest()
+        except IOError:
+            unchanged = False # no such file or unable to read it
+        if unchanged:
+            self.discard()
+            return False
+        try:
+            _replace_atomic(self._tmp_path, self.path)
+        except IOError:
+            self.discard()
+            raise
+        return True
+
+
+def _make_parent_dir(path):
+    '''
+        Make parent directories of a file if they do not exist.
+        Errors are logged.
+        Returns:
+            True if directory exists, False otherwise
+    '''
+    dirname = os.path.dirname(path)
+    if dirname:
+        try:
+            os.makedirs(dirname, exist_ok=True)
+        except OSError as exc:
+            logging.error("could not create directory '{}': {}".format(dirname, exc.strerror))
+            return False
+    return True
+
+
+def stream_template(template, namespace, infile, outfile, dnsfile, dns_state=None, profile=None,
+                    nsupdate=None):
+    '''
+        Render template straight into output file (see OutputStream)
+        and fill DNS version in if needed. Errors are logged.
+        Parameters:
+            template - mako.template.Template instance
+            namespace - dict of names that are passed to the template
+            infile, outfile, dnsfile - paths to template, output file
+                                       and old DNS file
+            dns_state - DnsState instance (optional, see render_template)
+            profile - Profile of the template (optional)
+            nsupdate - path to nsupdate script of the zone (optional,
+                       see update_nsupdate)
+        Returns:
+            tuple of whether output file was written (or left untouched)
+            and the new zone state (None if output has no DNS version
+            or dns_state is not given), or None if template could not
+            be rendered or written
+    '''
+    if not _make_parent_dir(outfile):
+        return None
+    try:
+        output = OutputStream(outfile)
+    except IOError as exc:
+        logging.error("could not write to file '{}': {}".format(outfile, exc.strerror))
+        return None
+
+    try:
+        # Render template
+        with _stage(profile, "render"):
+            try:
+                template.render_context(mako.runtime.Context(output, **namespace))
+                output.close()
+            except Exception:
+                if output.error is not None:
+                    raise output.error
+                tb = mako.exceptions.text_error_template().render().strip()
+                logging.error("unhandled exception while rendering template '{}':\n{}"
+                              .format(infile, tb))
+                output.discard()
+                return None
+
+        # Apply DNS version hack if needed
+        zone_state = None
+        if output.has_dns_anchor:
+            with _stage(profile, "dns"):
+                if dns_state is not None:
+                    zone_state = dns_state.get(outfile)
+                output.apply_dns_version_hack(dnsfile, zone_state)
+        if output.has_dns_anchor and nsupdate is not None:
+            with _stage(profile, "nsupdate"):
+                try:
+                    old_file = open(dnsfile, "r")
+                except (IOError, ValueError, TypeError):
+                    update_nsupdate(nsupdate, outfile, None, ())
+                else:
+                    with old_file:
+                        update_nsupdate(nsupdate, outfile, old_file, output.lines())
+
+        # Replace output file unless it is the same
+        with _stage(profile, "write"):
+            return output.commit(), zone_state
+    except IOError as exc:
+        output.discard()
+        logging.error("could not write to file '{}': {}".format(outfile, exc.strerror))
+        return None
+
+
+def update_nsupdate(path, outfile, old_lines, new_lines):
+    '''
+        Write nsupdate script of a zone rendered into output file (see
+        write_nsupdate). Errors are logged, and script of the previous
+        run is removed if the zone can not be compared.
+        Parameters:
+            path - path to script file
+            outfile - path to output file
+            old_lines, new_lines - see write_nsupdate
+    '''
+    try:
+        write_nsupdate(path, old_lines, new_lines)
+    except ValueError as exc:
+        _unlink_quietly(path)
+        logging.error("could not make nsupdate script of '{}': {}".format(outfile, exc))
+    except IOError as exc:
+        logging.error("could not make nsupdate script '{}': {}".format(path, exc.strerror or exc))
+
+
+def write_rendered(outfile, output, entry, profile=None):
+    '''
+        Write rendered template into output file, making its parent
+        directories if needed, and finish its manifest entry.
+        Errors are logged.
+        Parameters:
+            outfile - path to output file
+            output - rendered template
+            entry - manifest entry of output file; 'changed' key is added to it
+            profile - Profile of the template (optional); its report is
+                      added to the entry under 'profile' key
+        Returns:
+            the entry or None if output file could not be written
+    '''
+    with _stage(profile, "write"):
+
+        # Make parent directories if they do not exist
+        if not _make_parent_dir(outfile):
+            return None
+
+        # Write rendered template unless the output file is already the same
+        try:
+            changed = write_output(outfile, output)
+        except IOError as exc:
+            logging.error("could not write to file '{}': {}".format(outfile, exc.strerror))
+            return None
+
+    entry["changed"] = changed
+    if profile is not None:
+        entry["profile"] = profile.report()
+    return entry
+
+
+def render_template(infile, outfile, dnsfile, db, var, cache_dir=None, incremental=None,
+                    dns_state=None, compiled=None, profiling=False, io=None, stream=False,
+                    group=None, nsupdate=None, memo=None, cost=False, line_cache=None):
+    '''
+        Render a single template and write the result into output file.
+        Errors are logged and never propagate to the caller, so that
+        one broken template does not prevent the others from rendering.
+        Parameters:
+            infile - path to template file
+            outfile - path to output file ('.mako' extension is stripped)
+            dnsfile - path to old DNS file ('.mako' extension is stripped)
+            db - database with hosts that is passed to the template
+            var - dict of variables that is passed to the template
+            cache_dir - directory for compiled templates (optional)
+            incremental - IncrementalState instance; if given, template is
+                          not rendered if its output is up to date
+            dns_state - DnsState instance; if given, DNS version is decided
+                        using it instead of old DNS file (the state itself is
+                        not changed, the new zone state is returned in manifest
+                        entry under 'dns' key instead)
+            compiled - dict to keep compiled templates in, see compile_template
+            profiling - whether to measure rendering; if True, report of the
+                        template (see Profile) is returned in manifest entry
+                        under 'profile' key
+            io - BackgroundIO instance; if given, old DNS file is read and
+                 output file is written using it
+            stream - whether to write output file while the template is being
+                     rendered instead of rendering it into a string first (see
+                     stream_template); io is not used then
+            group - (key, name) tuple of a group of hosts to render fan-out
+                    template for (see fan_out_templates); the template gets
+                    only hosts of the group in db and group name in GROUP
+            nsupdate - (outpath, nsupdate_dir) tuple; if given, DNS zone
+                       is compared with the old DNS file and nsupdate script
+                       of the changes is written (see nsupdate_path and
+                       update_nsupdate)
+            memo - MemoCache instance of the run; if given, results of queries
+                   and outputs of views are taken from it (see MemoizingDB and
+                   MemoizingViewSet), and hit/miss statistics of the template
+                   are returned in manifest entry under 'memo' key
+            cost - whether to measure how long it takes to render the template;
+                   if True, wall clock seconds are returned in manifest entry
+                   under 'cost' key (see shard_templates)
+            line_cache - LineCache instance of the run; if given, views take
+                         lines of hosts from it (see LineCachingViewSet)
+        Returns:
+            manifest entry of output file (a dict) if output file was written
+            or is up to date, None otherwise. Entry has 'changed' key that
+            tells whether output file contents changed. If io is given and
+            the template is rendered, concurrent.futures.Future of the entry
+            is returned instead, since output file is written in background.
+    '''
+    # Strip '.mako' extension if present
+    started = time.perf_counter()
+    outfile = strip_mako_extension(outfile)
+    dnsfile = strip_mako_extension(dnsfile)
+    profile = Profile() if profiling else None
+    view = ViewSet() if line_cache is None else LineCachingViewSet(line_cache)
+    if profile is not None:
+        view = ProfilingViewSet(profile, view)
+    if group is not None:
+        db = db.group(*group)
+    if nsupdate is not None:
+        nsupdate = nsupdate_path(outfile, *nsupdate)
+
+    # Skip template if nothing it depends on has changed since the last run,
+    # otherwise record the queries that it makes
+    if incremental is not None:
+        with _stage(profile, "check"):
+            try:
+                template_digest = file_digest(infile)
+            except IOError as exc:
+                logging.error("unable to open '{}': {}".format(infile, exc.strerror))
+                return None
+            up_to_date = incremental.up_to_date(infile, outfile, template_digest, db)
+        if up_to_date:
+            entry = dict(incremental.entries[outfile], changed=False)
+            if profile is not None:
+                entry["profile"] = profile.report()
+            return entry
+    if memo is not None:
+        memo_stats = MemoCache.new_stats()
+        db = MemoizingDB(db, memo, memo_stats, group)
+        view = MemoizingViewSet(memo, memo_stats, view)
+    if profile is not None:
+        db = ProfilingDB(db, profile)
+    if incremental is not None:
+        db = RecordingDB(db)
+
+    # Create template
+    with _stage(profile, "compile"):
+        try:
+            template = compile_template(infile, cache_dir, compiled)
+        except IOError as exc:
+            logging.error("unable to open '{}': {}".format(infile, exc.strerror))
+            return None
+        except mako.exceptions.MakoException as exc:
+            logging.error("template error while reading '{}': {}".format(infile, exc))
+            return None
+
+    # Names available in template
+    namespace = {"var": var, "db": db, "host": HostQuery(), "view": view,
+                 "FILE_NAME": os.path.basename(outfile),
+                 "GROUP": group[1] if group is not None else None,
+                 "get_dns_version": lambda: DNS_HACK_ANCHOR + DNS_HACK_COMMENT}
+
+    # Render template straight into output file
+    if stream:
+        result = stream_template(template, namespace, infile, outfile, dnsfile,
+                                 dns_state, profile, nsupdate)
+        if result is None:
+            return None
+        changed, zone_state = result
+        if incremental is not None:
+            entry = incremental.entry(infile, outfile, template_digest, db)
+        else:
+            entry = {"output": outfile, "template": infile}
+        if zone_state is not None:
+            entry["dns"] = zone_state
+        if memo is not None:
+            entry["memo"] = memo_stats
+        if cost:
+            entry["cost"] = round(time.perf_counter() - started, 6)
+        entry["changed"] = changed
+        if profile is not None:
+            entry["profile"] = profile.report()
+        return entry
+
+    # Render template
+    with _stage(profile, "render"):
+        try:
+            output = template.render_unicode(**namespace)
+        except Exception:
+            tb = mako.exceptions.text_error_template().render().strip()
+            logging.error("unhandled exception while rendering template '{}':\n{}"
+                          .format(infile, tb))
+            return None
+
+    # Apply DNS version hack if needed
+    zone_state = None
+    if DNS_HACK_ANCHOR in output:
+        read = io.read if io is not None else read_text
+        if nsupdate is not None:
+            # Old DNS file is read only once
+            try:
+                old_zone = read(dnsfile)
+            except (IOError, ValueError, TypeError):
+                old_zone = None
+            read = lambda path: read_text(path) if old_zone is None else old_zone
+        with _stage(profile, "dns"):
+            if dns_state is not None:
+                zone_state = dns_state.get(outfile)
+                output = apply_dns_version_hack(output, dnsfile, zone_state, read)
+            else:
+                output = apply_dns_version_hack(output, dnsfile, read=read)
+        if nsupdate is not None:
+            with _stage(profile, "nsupdate"):
+                update_nsupdate(nsupdate, outfile, None if old_zone is None else
+                                old_zone.split("\n"), output.split("\n"))
+
+    # Write output file
+    if incremental is not None:
+        entry = incremental.entry(infile, outfile, template_digest, db)
+    else:
+        entry = {"output": outfile, "template": infile}
+    if zone_state is not None:
+        entry["dns"] = zone_state
+    if memo is not None:
+        entry["memo"] = memo_stats
+    if cost:
+        entry["cost"] = round(time.perf_counter() - started, 6)
+    if io is not None:
+        return io.submit(write_rendered, outfile, output, entry, profile)
+    return write_rendered(outfile, output, entry, profile)
+
+
+def _render_task(task, db, var, **options):
+    '''
+        Render a (template_path, output_path, dns_path[, group]) task
+        as yielded by find_templates or fan_out_templates.
+        Parameters and return value are the same as for render_template.
+    '''
+    infile, outfile, dnsfile, *group = task
+    if group:
+        options["group"] = group[0]
+    return render_template(infile, outfile, dnsfile, db, var, **options)
+
+
+def render_serial(templates, db, var, io_threads=0, prefetch=True, **options):
+    '''
+        Render templates one by one in this process.
+        Parameters:
+            templates - list of (template_path, output_path, dns_path[, group])
+                        tuples as yielded by find_templates or fan_out_templates
+            db - HostDB instance with hosts
+            var - dict of variables that is passed to the templates
+            io_threads - number of threads to do file I/O in background with
+                         (see BackgroundIO); if 0, it is done in between
+                         rendering templates (streamed templates do their
+                         I/O while they are being rendered)
+            prefetch - whether to read old DNS files ahead
+            options - keyword arguments to render_template
+        Returns:
+            list of manifest entries of output files (see render_template)
+    '''
+    if not io_threads or options.get("stream"):
+        entries = (_render_task(task, db, var, **options) for task in templates)
+        return [entry for entry in entries if entry is not None]
+
+    # Old DNS files are read ahead only for outputs known to be zones: by
+    # DNS state or manifest of the previous run, or because their template
+    # has already made a zone in this run (e.g. fan-out templates)
+    dns_state, incremental = options.get("dns_state"), options.get("incremental")
+    zones = set(dns_state.zones) if dns_state is not None else set()
+    if incremental is not None:
+        zones.update(outfile for outfile, entry in incremental.entries.items() if "dns" in entry)
+    zone_templates = set()
+
+    # Old DNS files are needed unless zones are compared by digests
+    # and no nsupdate scripts are made
+    def needs_dns_file(infile, outfile):
+        outfile = strip_mako_extension(outfile)
+        return prefetch and (outfile in zones or infile in zone_templates) and (
+            dns_state is None or options.get("nsupdate") is not None or
+            not dns_state.zones.get(outfile, {}).get("digest"))
+
+    results = []
+    with BackgroundIO(io_threads) as io:
+        for n, task in enumerate(templates):
+            for next_infile, next_outfile, next_dnsfile, *_ in templates[n:n + io_threads]:
+                if needs_dns_file(next_infile, next_outfile):
+                    io.prefetch(strip_mako_extension(next_dnsfile))
+            results.append(_render_task(task, db, var, io=io, **options))
+            dnsfile = strip_mako_extension(task[2])
+            if dnsfile in io.read_paths:
+                zone_templates.add(task[0])
+            io.discard(dnsfile)
+
+    entries = []
+    for (infile, *_), result in zip(templates, results):
+        if isinstance(result, concurrent.futures.Future):
+            try:
+                result = result.result()
+            except Exception as exc:
+                logging.error("failed to write output of template '{}': {}".format(infile, exc))
+                continue
+        if result is not None:
+            entries.append(result)
+    return entries
+
+
+# Per-process state of the render_parallel() workers. It is filled
+# once by _init_worker() so that the host table is not shipped
+# along with every single template.
+_worker_state = {}
+
+
+def _init_worker(db, var, options):
+    '''
+        Initialize a render_parallel() worker process: configure logging
+        and remember the database, variables and rendering options.
+        Parameters:
+            db - HostDB instance with hosts
+            var - dict of variables that is passed to the templates
+            options - dict of keyword arguments to render_template
+    '''
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    _worker_state["db"] = db
+    _worker_state["var"] = var
+    _worker_state["options"] = options
+
+
+def _render_in_worker(*task):
+    '''
+        Render a single template inside of a render_parallel() worker.
+        Parameters and return value are the same as for _render_task.
+        Lines that the template added to the line cache of the worker
+        are returned in manifest entry under 'lines' key (see
+        LineCache.take_changes).
+    '''
+    options = _worker_state["options"]
+    entry = _render_task(task, _worker_state["db"], _worker_state["var"], **options)
+    if entry is not None and options.get("line_cache") is not None:
+        entry["lines"] = options["line_cache"].take_changes()
+    return entry
+
+
+def render_parallel(templates, db, var, jobs, **options):
+    '''
+        Render templates in a pool of worker processes.
+        Every template is submitted as a separate task, so one slow
+        template does not hold back the others. Errors are logged
+        by the workers in the same way render_template does it.
+        Parameters:
+            templates - iterable of (template_path, output_path, dns_path[, group])
+                        tuples as yielded by find_templates or fan_out_templates
+            db - HostDB instance with hosts; it is handed over to every
+                 worker once, not with every template
+            var - dict of variables that is passed to the templates
+            jobs - number of worker processes
+            options - keyword arguments to render_template
+        Returns:
+            list of manifest entries of output files (see render_template)
+    '''
+    entries = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+            initializer=_init_worker, initargs=(db, var, options)) as executor:
+        futures = {executor.submit(_render_in_worker, *paths): paths for paths in templates}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                entry = future.result()
+            except Exception as exc:
+                logging.error("worker failed while rendering template '{}': {}"
+                              .format(futures[future][0], exc))
+            else:
+                if entry is not None:
+                    entries.append(entry)
+    return entries
+
+
+# Version of format of inventory snapshots
+SNAPSHOT_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def _script_digest():
+    '''
+        Digest of this script, so that snapshots made by other versions
+        of it (that may e.g. validate CSV files differently) are not used.
+    '''
+    try:
+        return file_digest(__file__)
+    except IOError:
+        return ""
+
+
+def load_snapshot(cache_dir, kind, srcpath, build, options=()):
+    '''
+        Load object built from a source file (e.g. database of hosts built
+        from CSV file) from a snapshot in cache directory. If there is no
+        snapshot for the current contents of the source file, the object
+        is built and its snapshot is saved, replacing snapshots of the
+        older contents of the same file built with the same options.
+        Snapshots are pickle files, so cache directory should be trusted
+        just like templates are. Errors while saving snapshots are logged.
+        Parameters:
+            cache_dir - directory to keep snapshots in
+            kind - kind of object, e.g. 'hosts'
+            srcpath - path to source file or list of paths to source files
+            build - function that builds object from srcpath
+            options - JSON serializable options that the object depends on
+        Returns:
+            the object
+        Raises:
+            IOError if unable to read source file
+            anything that build raises
+    '''
+    srcpaths = [srcpath] if isinstance(srcpath, str) else list(srcpath)
+    digest = [file_digest(path) for path in srcpaths]
+    key = hashlib.sha256(json.dumps([SNAPSHOT_VERSION, sys.implementation.cache_tag,
+        _script_digest(), kind, digest, options]).encode("utf8")).hexdigest()[:32]
+    prefix = "{}-{}-".format(kind, hashlib.sha256(json.dumps(
+        [[os.path.abspath(path) for path in srcpaths], options]).encode("utf8")).hexdigest()[:16])
+    snapshot = os.path.join(cache_dir, prefix + key + ".pickle")
+
+    try:
+        with open(snapshot, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as exc:
+        logging.warning("ignoring broken snapshot '{}': {}".format(snapshot, exc))
+
+    obj = build(srcpath)
+    if [file_digest(path) for path in srcpaths] != digest:
+        return obj # source file was changed while building, do not save
+
+    try:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        os.makedirs(cache_dir, exist_ok=True)
+        write_file_atomic(snapshot, data)
+        for filename in os.listdir(cache_dir):
+            if filename.startswith(prefix) and filename != os.path.basename(snapshot):
+                os.unlink(os.path.join(cache_dir, filename))
+    except (pickle.PicklingError, TypeError, AttributeError) as exc:
+        logging.warning("could not make snapshot of '{}': {}".format(srcpath, exc))
+    except OSError as exc:
+        logging.warning("could not write snapshot '{}': {}".format(snapshot, exc.strerror))
+    return obj
+
+
+def load_hosts(csvpaths, compact=False, cache_dir=None, jobs=1, sqlite=None, derived=None):
+    '''
+        Parse CSV files and create in-memory indexed database from the list
+        of network entities. Rows are validated as they are loaded.
+        Rows of several files are merged in the order of files, and no
+        host name, IP or MAC address may be defined in more than one file
+        (see check_conflicts, which reports all the conflicts at once).
+        Database remembers which file and row every host comes from.
+        If cache_dir is given, the database is loaded from its snapshot
+        if CSV files have not changed since the snapshot was made.
+        If sqlite is given, hosts are kept in SQLite database file instead
+        of memory (see SqliteHostDB). The file is built again only if
+        CSV files have changed since it was built.
+        Derived columns are added to every row right after it is parsed
+        and are indexed like frequently queried columns (see derive_columns).
+        Parameters:
+            csvpaths - path or list of paths to CSV files or directories
+                       with CSV files (see find_csv_files)
+            compact - store hosts in compact columnar table
+            cache_dir - directory to keep snapshots in (optional)
+            jobs - number of worker processes to parse several files with
+            sqlite - path to SQLite database file (optional)
+            derived - dict mapping names of derived columns to their
+                      expressions (see derived_columns)
+        Returns:
+            HostDB or SqliteHostDB instance
+        Raises:
+            IOError if unable to open CSV file
+            csv.Error if unable to parse CSV file
+            CsvIntegrityError if CSV files contain invalid or conflicting data
+    '''
+    if isinstance(csvpaths, str):
+        csvpaths = [csvpaths]
+    csvfiles = find_csv_files(csvpaths)
+    if not csvfiles:
+        raise FileNotFoundError(errno.ENOENT, "no CSV files found", " ".join(csvpaths))
+    derived = derived or {}
+    if sqlite is not None:
+        db = _load_sqlite_hosts(sqlite, csvfiles, jobs, derived)
+    elif cache_dir is not None:
+        db = load_snapshot(cache_dir, "hosts", csvfiles,
+                           lambda paths: _build_hosts(paths, compact, jobs, derived=derived),
+                           [compact, derived])
+    else:
+        db = _build_hosts(csvfiles, compact, jobs, derived=derived)
+    check_conflicts(db)
+    return db
+
+
+def _build_hosts(csvfiles, compact, jobs, build=None, derived=None):
+    '''
+        Parse CSV files and build HostDB, see load_hosts.
+        If build is given, it is called with rows and sources of hosts
+        and names of columns to index to build database instead.
+    '''
+    sources = ([], array.array("H"), array.array("L"))
+    derived = derived or {}
+    indexed_columns = HostDB.INDEXED_COLUMNS + tuple(name for name in derived
+                                                     if name not in HostDB.INDEXED_COLUMNS)
+    if build is None:
+        build = lambda hosts, sources, indexed_columns: HostDB(
+            HostTable(hosts) if compact else hosts, indexed_columns, sources)
+
+    def derive(parsed):
+        if not derived:
+            return parsed
+        return (derive_columns(rows, derived, path) for path, rows in zip(csvfiles, parsed))
+
+    if jobs > 1 and len(csvfiles) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(csvfiles))) as executor:
+            hosts = merge_csv_files(csvfiles, derive(executor.map(_parse_csv_file, csvfiles)),
+                                    sources)
+            return build(hosts, sources, indexed_columns)
+    hosts = merge_csv_files(csvfiles, derive(map(iter_inventory_rows, csvfiles)), sources)
+    return build(hosts, sources, indexed_columns)
+
+
+def _load_sqlite_hosts(path, csvfiles, jobs, derived=None):
+    '''
+        Open SQLite database of hosts if it was built from the current
+        contents of CSV files, otherwise build it again, see load_hosts.
+    '''
+    digest = hashlib.sha256(json.dumps([_script_digest(),
+        [os.path.abspath(csvpath) for csvpath in csvfiles],
+        [file_digest(csvpath) for csvpath in csvfiles], derived or {}]).encode("utf8")).hexdigest()
+    try:
+        db = SqliteHostDB(path)
+    except (sqlite3.Error, ValueError, KeyError):
+        pass # no database yet, or it is broken
+    else:
+        if db.digest == digest:
+            return db
+    return _build_hosts(csvfiles, False, jobs, lambda hosts, sources, indexed_columns:
+                        SqliteHostDB.create(path, hosts, sources, digest, indexed_columns),
+                        derived)
+
+
+def load_var(varpath, cache_dir=None):
+    '''
+        Load variables from yaml file, or from its snapshot if cache_dir
+        is given and the file has not changed since the snapshot was made.
+        Raises:
+            IOError if unable to open variables file
+            yaml.error.YAMLError if variables file is invalid
+    '''
+    if cache_dir is not None:
+        return load_snapshot(cache_dir, "var", varpath, load_var)
+    with open(varpath, "r") as f:
+        return yaml.safe_load(f)
+
+
+def render_all(args, db, var, incremental=None, dns_state=None, compiled=None, profile=None):
+    '''
+        Render all templates given on command line and save the state
+        files (DNS state, manifest of changes, incremental manifest,
+        profiling report). Errors while saving state files are logged.
+        Parameters:
+            args - parsed command line arguments
+            db - HostDB instance with hosts
+            var - dict of variables
+            incremental - IncrementalState instance (optional); its entries
+                          are replaced with the ones of this run
+            dns_state - DnsState instance (optional); it is updated with
+                        the new zone states
+            compiled - dict to keep compiled templates in between runs
+                       (optional, used only if templates are rendered
+                       in this process)
+            profile - Profile instance of the run (optional); if given,
+                      stages and templates are profiled and the report
+                      is saved into args.profile
+        Returns:
+            list of manifest entries of output files that were written
+            or are up to date
+    '''
+    # Iterate over each input/output path pair
+    # There is also a hack with iterating over files in DNS directory in parallel
+    with _stage(profile, "find_templates"):
+        templates = list(find_templates(args.templates, args.output, args.dnsdir))
+    with _stage(profile, "fan_out"):
+        templates = fan_out_templates(templates, db)
+    options = {"cache_dir": args.cache_dir, "incremental": incremental, "dns_state": dns_state}
+
+    # Render only templates of the shard. Nothing is rendered if costs
+    # can not be loaded, as the split would differ from other shards.
+    tree = None
+    if args.shard:
+        try:
+            with _stage(profile, "load_shard_costs"):
+                costs = load_shard_costs(args.shard_costs) if args.shard_costs else None
+        except IOError as exc:
+            logging.error("unable to open '{}': {}".format(args.shard_costs, exc.strerror))
+            return []
+        except ValueError as exc:
+            logging.error("error in costs file '{}': {}".format(args.shard_costs, exc))
+            return []
+        tree = templates
+        with _stage(profile, "shard"):
+            templates = shard_templates(templates, *args.shard, args.output, costs)
+        options["cost"] = True
+
+    if profile is not None:
+        options["profiling"] = True
+    if args.stream:
+        options["stream"] = True
+    if args.nsupdate:
+        options["nsupdate"] = (args.output, args.nsupdate)
+    if args.memoize:
+        options["memo"] = MemoCache()
+    if args.line_cache:
+        line_cache_path = os.path.join(args.cache_dir, "lines.pickle")
+        with _stage(profile, "load_line_cache"):
+            options["line_cache"] = LineCache.load(line_cache_path, args.line_cache << 20)
+    with _stage(profile, "render"):
+        if args.jobs > 1:
+            entries = render_parallel(templates, db, var, args.jobs, **options)
+        else:
+            if compiled is not None:
+                options["compiled"] = compiled
+            entries = render_serial(templates, db, var, args.io_threads,
+                                    args.dnsdir != "\000", **options)
+
+    # Collect reports of templates
+    if profile is not None:
+        for entry in entries:
+            profile.templates.append(dict(entry.pop("profile"), template=entry["template"],
+                                          output=entry["output"]))
+
+    # Sum up statistics of the cache of queries and views
+    if args.memoize:
+        memo_stats = MemoCache.new_stats()
+        for entry in entries:
+            if "memo" in entry:
+                MemoCache.add_stats(memo_stats, entry.pop("memo"))
+        logging.info("memoized queries: {} hits, {} misses; views: {} hits, {} misses".format(
+            memo_stats["queries"]["hits"], memo_stats["queries"]["misses"],
+            memo_stats["views"]["hits"], memo_stats["views"]["misses"]))
+        if profile is not None:
+            profile.memo = memo_stats
+
+    # Save lines of views, along with the ones of worker processes
+    if args.line_cache:
+        line_cache = options["line_cache"]
+        for entry in entries:
+            if "lines" in entry:
+                line_cache.merge(entry.pop("lines"))
+        logging.info("cached lines: {} reused, {} formatted".format(
+            line_cache.hits, line_cache.misses))
+        with _stage(profile, "save_line_cache"):
+            try:
+                line_cache.save(line_cache_path)
+            except IOError as exc:
+                logging.error("could not write line cache '{}': {}"
+                              .format(line_cache_path, exc.strerror))
+
+    with _stage(profile, "save"):
+        save_state(args, entries, templates, incremental, dns_state, tree)
+
+    # Save profiling report
+    if profile is not None:
+        try:
+            profile.save(args.profile)
+        except IOError as exc:
+            logging.error("could not write profiling report '{}': {}"
+                          .format(args.profile, exc.strerror))
+
+    return entries
+
+
+def save_state(args, entries, templates, incremental=None, dns_state=None, tree=None):
+    '''
+        Save state files given on command line after templates are rendered.
+        Errors are logged.
+        Parameters:
+            args - parsed command line arguments
+            entries - manifest entries of output files
+            templates - list of (template_path, output_path, dns_path[, group])
+                        tuples
+            incremental - IncrementalState instance (optional); its entries
+                          are replaced with the given ones
+            dns_state - DnsState instance (optional); it is updated with
+                        the new zone states
+            tree - list of all the templates if templates are the ones
+                   of a shard (see shard_templates)
+    '''
+    # Save the new state of DNS zones
+    if dns_state is not None:
+        for entry in entries:
+            if "dns" in entry:
+                dns_state.zones[entry["output"]] = entry["dns"]
+        try:
+            dns_state.save(args.dns_state)
+        except IOError as exc:
+            logging.error("could not write DNS state file '{}': {}"
+                          .format(args.dns_state, exc.strerror))
+
+    # Save manifest of changes
+    if args.changes:
+        try:
+            write_changes(args.changes, entries,
+                          [strip_mako_extension(task[1]) for task in templates],
+                          None if tree is None else
+                          [strip_mako_extension(task[1]) for task in tree])
+        except IOError as exc:
+            logging.error("could not write manifest of changes '{}': {}"
+                          .format(args.changes, exc.strerror))
+
+    # Save manifest of the shard
+    if tree is not None:
+        try:
+            write_shard_manifest(args.shard_manifest, args.shard[0], args.shard[1],
+                                 tree, templates, entries, args.output)
+        except IOError as exc:
+            logging.error("could not write shard manifest '{}': {}"
+                          .format(args.shard_manifest, exc.strerror))
+
+    # Save manifest for the next incremental run. Outputs that failed
+    # to render are left out of it, so they are rendered next time.
+    if incremental is not None:
+        incremental.entries = {entry["output"]: entry for entry in entries}
+    if args.incremental:
+        try:
+            IncrementalState.save(args.incremental, entries)
+        except IOError as exc:
+            logging.error("could not write manifest '{}': {}"
+                          .format(args.incremental, exc.strerror))
+
+
+def watch_snapshot(args):
+    '''
+        Take snapshot of all input files: CSV files, variables file
+        and every file in templates directory.
+        Parameters:
+            args - parsed command line arguments
+        Returns:
+            dict mapping path of existing input file to tuple of its
+            modification time and size
+    '''
+    paths = find_csv_files(args.csvfile)
+    if args.var:
+        paths.append(args.var)
+    if os.path.isdir(args.templates):
+        for dirpath, _, filenames in os.walk(args.templates):
+            paths.extend(os.path.join(dirpath, filename) for filename in filenames)
+    else:
+        paths.append(args.templates)
+
+    snapshot = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        snapshot[path] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+def watch(args, db, var, incremental, dns_state, compiled):
+    '''
+        Poll input files and render templates again whenever some of them
+        change, until interrupted. Hosts, variables and compiled templates
+        are kept in memory and only the inputs that changed are loaded
+        again. Incremental state then tells which outputs depend on the
+        change, so only these are rendered. If a changed input cannot be
+        loaded, the error is logged and its previous version is used
+        until the file changes again.
+        Parameters:
+            args - parsed command line arguments
+            db - HostDB instance with hosts of the first run
+            var - dict of variables of the first run
+            incremental - IncrementalState instance of the first run
+            dns_state - DnsState instance (optional)
+            compiled - dict with compiled templates of the first run
+    '''
+    snapshot = watch_snapshot(args)
+    csvfiles = set(find_csv_files(args.csvfile))
+    derived = derived_columns(var)
+    logging.info("watching '{}' for changes".format(args.templates))
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+            current = watch_snapshot(args)
+            changed = {path for path in set(snapshot) | set(current)
+                       if snapshot.get(path) != current.get(path)}
+            snapshot = current
+            if not changed:
+                continue
+            profile = Profile() if args.profile else None
+
+            # Load changed variables file
+            previous_derived = derived
+            if args.var and args.var in changed:
+                try:
+                    with _stage(profile, "load_var"):
+                        new_var = load_var(args.var, args.cache_dir)
+                        new_derived = derived_columns(new_var)
+                        incremental.var_digest = file_digest(args.var)
+                        var, derived = new_var, new_derived
+                except IOError as exc:
+                    logging.error("unable to open '{}': {}".format(args.var, exc.strerror))
+                except yaml.error.YAMLError as exc:
+                    logging.error("yaml error: {}".format(exc))
+                except ValueError as exc:
+                    logging.error("error in variables file '{}': {}".format(args.var, exc))
+
+            # Load changed, added or removed CSV files, or all of them
+            # if other columns are to be derived now
+            previous_csvfiles, csvfiles = csvfiles, set(find_csv_files(args.csvfile))
+            if changed & (previous_csvfiles | csvfiles) or derived != previous_derived:
+                try:
+                    with _stage(profile, "load_hosts"):
+                        db = load_hosts(args.csvfile, args.compact, args.cache_dir, args.jobs,
+                                        sqlite=args.sqlite, derived=derived)
+                except IOError as exc:
+                    logging.error("unable to open '{}': {}".format(exc.filename, exc.strerror))
+                except csv.Error as exc:
+                    logging.error("unable to parse csv file: {}".format(exc))
+                except CsvIntegrityError as exc:
+                    logging.error("error in csv file: {}".format(exc))
+
+            # Render outputs affected by the change
+            entries = render_all(args, db, var, incremental, dns_state, compiled, profile)
+            logging.info("{} input files changed, {} output files changed".format(
+                len(changed), sum(1 for entry in entries if entry["changed"])))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+
+    # Other commands
+    if sys.argv[1:2] == ["merge-shards"]:
+        return merge_shards_main(sys.argv[2:])
+
+    # Define command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csvfile", nargs="+",
+                        help="CSV files (or JSON Lines, SQLite, Arrow or Parquet files) "
+                             "containing hosts or directories with such files")
+    parser.add_argument("templates", help="template file or directory")
+    parser.add_argument("output", help="output file or directory")
+    parser.add_argument("-d", "--dnsdir", metavar="DNSDIR", default="\000",
+                        help="directory with the old DNS files")
+    parser.add_argument("-v", "--var", metavar="VARFILE",
+                        help="yaml file with variables")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="number of CSV files to parse and templates to render in parallel")
+    parser.add_argument("--io-threads", metavar="N", type=int, default=4,
+                        help="number of threads that read old DNS files and write "
+                             "output files while templates are being rendered, "
+                             "0 to do it in between (default: 4, not used with -j "
+                             "or --stream)")
+    parser.add_argument("--stream", action="store_true",
+                        help="write output files while templates are being rendered, "
+                             "without keeping the whole output in memory")
+    parser.add_argument("-c", "--cache-dir", metavar="CACHEDIR",
+                        default=os.environ.get("GANDALF_CACHE_DIR"),
+                        help="directory to keep compiled templates and snapshots "
+                             "of hosts and variables in (default: $GANDALF_CACHE_DIR, "
+                             "no caching if not set)")
+    parser.add_argument("-i", "--incremental", metavar="MANIFEST",
+                        help="render only templates whose inputs changed since "
+                             "the run that wrote MANIFEST, then update MANIFEST")
+    parser.add_argument("--compact", action="store_true",
+                        help="store hosts in compact columnar table "
+                             "(uses less memory on large CSV files)")
+    parser.add_argument("--sqlite", metavar="DBFILE",
+                        help="keep hosts in SQLite database file DBFILE instead of memory "
+                             "(it is built again when CSV files change)")
+    parser.add_argument("--memoize", action="store_true",
+                        help="compute the same database query or view of the same "
+                             "hosts only once per run, for all the templates")
+    parser.add_argument("--line-cache", metavar="MB", type=int, default=0,
+                        help="keep up to MB megabytes of lines formatted by views "
+                             "in CACHEDIR, so that only lines of changed hosts are "
+                             "formatted again (requires -c)")
+    parser.add_argument("-s", "--dns-state", metavar="STATEFILE",
+                        help="file to keep serials and digests of DNS zones in, "
+                             "so that old DNS files are not needed")
+    parser.add_argument("--nsupdate", metavar="NSUPDATEDIR",
+                        help="compare DNS zones with the old DNS files and write "
+                             "nsupdate scripts with the changed records into "
+                             "NSUPDATEDIR (requires -d)")
+    parser.add_argument("--shard", metavar="I/N", type=parse_shard,
+                        help="render only the I-th of N shards of the templates, "
+                             "split deterministically by their costs")
+    parser.add_argument("--shard-manifest", metavar="MANIFEST",
+                        help="write manifest of the shard into MANIFEST "
+                             "(required with --shard, see merge-shards command)")
+    parser.add_argument("--shard-costs", metavar="COSTFILE",
+                        help="weigh templates by their costs in COSTFILE written "
+                             "by merge-shards command after the last run")
+    parser.add_argument("-m", "--changes", metavar="CHANGESFILE",
+                        help="write lists of changed, unchanged, failed and "
+                             "removed output files into CHANGESFILE")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="keep running and render affected templates again "
+                             "whenever CSV file, variables file or templates change")
+    parser.add_argument("--watch-interval", metavar="SECONDS", type=float, default=2.0,
+                        help="how often to check input files in watch mode (default: 2)")
+    parser.add_argument("-p", "--profile", metavar="REPORTFILE",
+                        help="measure time spent in every stage, template, query and "
+                             "view and write JSON report into REPORTFILE")
+
+    # Parse arguments
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("number of jobs must be positive")
+    if args.io_threads < 0:
+        parser.error("number of I/O threads must not be negative")
+    if args.watch and args.watch_interval <= 0:
+        parser.error("watch interval must be positive")
+    if args.line_cache < 0:
+        parser.error("size of line cache must not be negative")
+    if args.line_cache and not args.cache_dir:
+        parser.error("--line-cache requires cache directory (-c)")
+    if args.shard and not args.shard_manifest:
+        parser.error("--shard requires --shard-manifest")
+    if args.sqlite and args.compact:
+        parser.error("--compact can not be used with --sqlite")
+    if args.nsupdate and args.dnsdir == "\000":
+        parser.error("--nsupdate requires directory with the old DNS files (-d)")
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    # Profile of the run (if requested)
+    profile = Profile() if args.profile else None
+
+    # Parse variables file (if given). It is loaded first, as it
+    # declares columns to be derived while hosts are loaded.
+    if args.var:
+        try:
+            with _stage(profile, "load_var"):
+                var = load_var(args.var, args.cache_dir)
+            derived = derived_columns(var)
+        except IOError as exc:
+            logging.fatal("unable to open '{}': {}".format(args.var, exc.strerror))
+            return sys.exit(4)
+        except yaml.error.YAMLError as exc:
+            logging.fatal("yaml error: {}".format(exc))
+            return sys.exit(5)
+        except ValueError as exc:
+            logging.fatal("error in variables file '{}': {}".format(args.var, exc))
+            return sys.exit(5)
+    else:
+        var, derived = {}, {}
+
+    # Parse CSV file and create in-memory indexed database
+    try:
+        with _stage(profile, "load_hosts"):
+            db = load_hosts(args.csvfile, args.compact, args.cache_dir, args.jobs,
+                            sqlite=args.sqlite, derived=derived)
+    except IOError as exc:
+        logging.fatal("unable to open '{}': {}".format(exc.filename, exc.strerror))
+        return sys.exit(1)
+    except csv.Error as exc:
+        logging.fatal("unable to parse csv file: {}".format(exc))
+        return sys.exit(2)
+    except CsvIntegrityError as exc:
+        logging.fatal("error in csv file: {}".format(exc))
+        return sys.exit(3)
+
+    # Load manifest of the previous run in incremental mode. Watch mode
+    # keeps its manifest in memory if there is no manifest file.
+    if args.incremental or args.watch:
+        try:
+            var_digest = file_digest(args.var) if args.var else None
+        except IOError as exc:
+            logging.fatal("unable to open '{}': {}".format(args.var, exc.strerror))
+            return sys.exit(4)
+        if args.incremental:
+            with _stage(profile, "load_manifest"):
+                incremental = IncrementalState.load(args.incremental, var_digest)
+        else:
+            incremental = IncrementalState({}, var_digest)
+    else:
+        incremental = None
+
+    # Load state of DNS zones
+    if args.dns_state:
+        try:
+            with _stage(profile, "load_dns_state"):
+                dns_state = DnsState.load(args.dns_state)
+        except IOError as exc:
+            logging.fatal("unable to open '{}': {}".format(args.dns_state, exc.strerror))
+            return sys.exit(6)
+        except ValueError as exc:
+            logging.fatal("error in DNS state file '{}': {}".format(args.dns_state, exc))
+            return sys.exit(7)
+    else:
+        dns_state = None
 
+    # Render templates, then keep doing so on changes in watch mode
+    compiled = {} if args.watch else None
+    render_all(args, db, var, incremental, dns_state, compiled, profile)
+    if args.watch:
+        watch(args, db, var, incremental, dns_state, compiled)
 
     # All done
     return sys.exit(0)
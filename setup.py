@@ -13,6 +13,9 @@ setup(
     author_email='sergio-dna@yandex.ru',
     py_modules=['gandalf'],
     install_requires=['tinydb', 'mako', 'pyyaml'],
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
     entry_points = {
         'console_scripts': [
             'gandalf = gandalf:main'
@@ -4,15 +4,20 @@
     A set of unit tests for the 'gandalf' script.
 '''
 
+import os
 import csv
 import yaml
 import mako
 import unittest
 import argparse
 import datetime
+import tempfile
+import importlib.util
+import concurrent.futures
 from unittest import mock
 
 import gandalf
+import benchmark
 
 
 class TestViewSet(unittest.TestCase):
@@ -112,6 +117,8 @@ class TestViewSet(unittest.TestCase):
             "2                       1d      IN      PTR     solnishko-lu4istoe.bar.com.\n" \
             "3                       1d      IN      PTR     foo-10.bar.com."
         self.assertEqual(gandalf.ViewSet.rdns(hosts), expected_output)
+        self.assertEqual(gandalf.ViewSet.rdns(iter(hosts)), expected_output)
+        self.assertEqual("\n".join(gandalf.ViewSet.iter_rdns(h for h in hosts)), expected_output)
 
         # Host the case when duplicate IP addresses are present
         hosts_duplicates = [
@@ -119,6 +126,7 @@ class TestViewSet(unittest.TestCase):
             {"ip": "10.12.13.1", "hostname": "mew-11", "domain": "bar.com"},
         ]
         self.assertRaises(ValueError, gandalf.ViewSet.rdns, hosts_duplicates)
+        self.assertRaises(ValueError, gandalf.ViewSet.rdns, iter(hosts_duplicates))
 
 
     def test_dhcp(self):
@@ -174,6 +182,1147 @@ class TestViewSet(unittest.TestCase):
                          expected_output_filename)
 
 
+    def test_iter_views(self):
+        '''
+            Test that generator views yield lines of the other views.
+        '''
+        hosts = [
+            {"hostname": "foo", "ip": "10.12.13.14", "mask": 8, "domain": "bar.com",
+                "mac": "00:00:00:00:00:00", "resides_on": "mew"},
+            {"hostname": "mew", "ip": "10.12.13.1", "mask": 8, "domain": "bar.com",
+                "mac": "10:00:00:00:00:00", "resides_on": "mew"},
+            {"hostname": "qux", "ip": "10.12.13.1", "mask": 8, "domain": "bar.com",
+                "mac": "20:00:00:00:00:00", "resides_on": "mew"}
+        ]
+        self.assertEqual(list(gandalf.ViewSet.iter_hosts(hosts)),
+                         gandalf.ViewSet.hosts(hosts).split("\n"))
+        self.assertEqual(list(gandalf.ViewSet.iter_dns(hosts, "cname")),
+                         gandalf.ViewSet.dns(hosts, "cname").split("\n"))
+        self.assertEqual(list(gandalf.ViewSet.iter_rdns(hosts[:2])),
+                         gandalf.ViewSet.rdns(hosts[:2]).split("\n"))
+        self.assertEqual(list(gandalf.ViewSet.iter_dhcp(hosts, router_ip="10.0.0.1")),
+                         gandalf.ViewSet.dhcp(hosts, router_ip="10.0.0.1").split("\n"))
+        self.assertEqual(list(gandalf.ViewSet.iter_dns([])), [])
+
+        # Errors are raised as soon as iteration starts
+        lines = gandalf.ViewSet.iter_rdns(hosts)
+        self.assertRaises(ValueError, next, lines)
+        lines = gandalf.ViewSet.iter_dns(hosts, "foobar")
+        self.assertRaises(ValueError, next, lines)
+
+
+class TestHostDB(unittest.TestCase):
+    '''
+        A set of tests for HostDB class.
+    '''
+
+    def setUp(self):
+        self.hosts = [
+            {"hostname": "foo", "vlan": 10, "type": "comp", "ip": "10.0.0.1"},
+            {"hostname": "bar", "vlan": 20, "type": "head", "ip": "10.0.0.2"},
+            {"hostname": "mew", "vlan": 10, "type": "head", "ip": "192.168.0.1"},
+            {"hostname": "baz", "vlan": None, "type": "cimc", "ip": "192.168.0.2"},
+            {"hostname": "qux", "vlan": 20, "type": "comp"}
+        ]
+        self.db = gandalf.HostDB(self.hosts)
+        self.host = gandalf.tinydb.Query()
+
+
+    def search(self, cond):
+        '''
+            Search both HostDB and a reference TinyDB, check that results
+            are the same and return list of found hostnames.
+        '''
+        reference = gandalf.tinydb.TinyDB(storage=gandalf.tinydb.storages.MemoryStorage)
+        reference.insert_multiple(self.hosts)
+        result = self.db.search(cond)
+        self.assertEqual(result, reference.search(cond))
+        self.assertEqual([doc.doc_id for doc in result], [doc.doc_id for doc in reference.search(cond)])
+        return [doc["hostname"] for doc in result]
+
+
+    def test_search(self):
+        '''
+            Test that search results are the same as with TinyDB.
+        '''
+        host = self.host
+        self.assertEqual(self.search(host.vlan == 10), ["foo", "mew"])
+        self.assertEqual(self.search(host.vlan == "10"), [])
+        self.assertEqual(self.search(host.vlan == None), ["baz"])
+        self.assertEqual(self.search(host.type.one_of(["head", "cimc"])), ["bar", "mew", "baz"])
+        self.assertEqual(self.search((host.vlan == 20) & (host.type == "comp")), ["qux"])
+        self.assertEqual(self.search((host.vlan == 20) | (host.type == "comp")), ["foo", "bar", "qux"])
+        self.assertEqual(self.search((host.vlan == 10) & host.ip.test(lambda s: s.startswith("192."))), ["mew"])
+        self.assertEqual(self.search((host.vlan == 10) | host.ip.exists()), ["foo", "bar", "mew", "baz"])
+        self.assertEqual(self.search(~(host.vlan == 10)), ["bar", "baz", "qux"])
+        self.assertEqual(self.search(host.vlan.one_of([[10]])), [])
+        self.assertEqual(self.search(host.ip == "10.0.0.2"), ["bar"])
+        self.assertEqual(self.search(host.unknown == 1), [])
+
+
+    def test_index_usage(self):
+        '''
+            Test that indexed conditions narrow down the set of documents
+            that the rest of the query is evaluated against.
+        '''
+        checked = []
+        def check(value):
+            checked.append(value)
+            return True
+        self.db.search((self.host.vlan == 20) & self.host.hostname.test(check))
+        self.assertEqual(checked, ["bar", "qux"])
+
+        # Column that is not indexed requires a full scan
+        db = gandalf.HostDB(self.hosts, indexed_columns=())
+        checked.clear()
+        db.search((self.host.vlan == 20) & self.host.hostname.test(check))
+        self.assertEqual(len(checked), 2)
+        self.assertEqual(db.search(self.host.vlan == 20), self.db.search(self.host.vlan == 20))
+
+
+    def test_host_table(self):
+        '''
+            Test that HostDB over HostTable yields the same results.
+        '''
+        host = self.host
+        self.hosts[-1]["ip"] = "192.168.0.3"
+        self.db = gandalf.HostDB(self.hosts)
+        db = gandalf.HostDB(gandalf.HostTable(self.hosts))
+        self.assertEqual(db.all(), self.db.all())
+        for cond in [host.vlan == 10, host.type.one_of(["head", "cimc"]),
+                     (host.vlan == 20) & host.ip.exists(), ~(host.vlan == 10),
+                     host.ip.test(lambda s: s.startswith("192.")), host.noop(),
+                     host.fragment({"vlan": 20}), lambda doc: len(doc) == 4,
+                     host.unknown == 1]:
+            self.assertEqual(db.search(cond), self.db.search(cond))
+            self.assertEqual([doc.doc_id for doc in db.search(cond)],
+                             [doc.doc_id for doc in self.db.search(cond)])
+        self.assertEqual(db.get(doc_id=2), self.hosts[1])
+        self.assertEqual(db.get(doc_id=2).ip_int, 0x0A000002)
+        self.assertEqual(db.count(host.type == "head"), 2)
+
+        # Queries are evaluated against the columns they refer to only
+        checked = []
+        db.search(host.ip.test(lambda s: checked.append(s)))
+        self.assertEqual(checked, ["10.0.0.1", "10.0.0.2", "192.168.0.1", "192.168.0.2",
+                                   "192.168.0.3"])
+
+
+    def test_ip_ranges(self):
+        '''
+            Test in_subnet and in_range queries.
+        '''
+        host = gandalf.HostQuery()
+        self.assertEqual(self.search(host.ip.in_subnet("192.168.0.0/24")), ["mew", "baz"])
+        self.assertEqual(self.search(host.ip.in_subnet("10.0.0.4/30")), [])
+        self.assertEqual(self.search(host.ip.in_subnet("10.0.0.2/31")), ["bar"])
+        self.assertEqual(self.search(host.ip.in_subnet("10.0.0.2/32")), ["bar"])
+        self.assertEqual(self.search(host.ip.in_subnet("0.0.0.0/0")), ["foo", "bar", "mew", "baz"])
+        self.assertEqual(self.search(host.ip.in_range("10.0.0.2", "192.168.0.1")), ["bar", "mew"])
+        self.assertEqual(self.search(host.ip.in_subnet("10.0.0.0/8") | (host.type == "cimc")),
+                         ["foo", "bar", "baz"])
+        self.assertEqual(self.search(host.ip.in_subnet("192.168.0.0/16") & (host.vlan == 10)),
+                         ["mew"])
+        self.assertEqual(self.search(host.hostname.in_range("0.0.0.0", "255.255.255.255")), [])
+        self.assertRaises(ValueError, host.ip.in_subnet, "10.0.0.1/24")
+        self.assertRaises(ValueError, host.ip.in_subnet, "10.0.0.0/33")
+        self.assertRaises(ValueError, host.ip.in_range, "10.0.0.1", "foo")
+
+        # Range conditions are answered from index
+        checked = []
+        def check(value):
+            checked.append(value)
+            return True
+        self.db.search(host.ip.in_subnet("10.0.0.0/24") & host.hostname.test(check))
+        self.assertEqual(checked, ["foo", "bar"])
+
+        # The same for HostTable
+        self.hosts[-1]["ip"] = "10.0.1.1"
+        self.db = gandalf.HostDB(gandalf.HostTable(self.hosts))
+        self.assertEqual(self.search(host.ip.in_subnet("10.0.0.0/23")), ["foo", "bar", "qux"])
+
+
+    def test_other_methods(self):
+        '''
+            Test all, get, count, contains and other methods.
+        '''
+        host = self.host
+        self.assertEqual(self.db.all(), self.hosts)
+        self.assertEqual(list(self.db), self.hosts)
+        self.assertEqual(len(self.db), 5)
+        self.assertEqual(self.db.get(host.vlan == 20)["hostname"], "bar")
+        self.assertEqual(self.db.get(host.vlan == 30), None)
+        self.assertEqual(self.db.get(doc_id=3)["hostname"], "mew")
+        self.assertEqual(self.db.get(doc_id=6), None)
+        self.assertRaises(RuntimeError, self.db.get)
+        self.assertEqual(self.db.count(host.type == "head"), 2)
+        self.assertTrue(self.db.contains(host.hostname == "qux"))
+        self.assertFalse(self.db.contains(host.hostname == "quux"))
+        self.assertTrue(self.db.contains(doc_id=1))
+
+        # Changing returned documents does not change the database
+        self.db.search(host.vlan == 20)[0]["vlan"] = 10
+        self.assertEqual(self.db.count(host.vlan == 10), 2)
+        self.assertEqual(self.db.all()[1]["vlan"], 20)
+
+
+    def test_groups(self):
+        '''
+            Test grouping hosts by columns and IP networks.
+        '''
+        host = self.host
+        self.assertEqual(gandalf.HostDB.parse_group_key("vlan"), "vlan")
+        self.assertEqual(gandalf.HostDB.parse_group_key(" ip/24 "), ("ip", 24))
+        for key in ["", "ip/", "ip/0", "ip/33", "ip/x", "vlan/24", "a b", "/24"]:
+            self.assertRaises(ValueError, gandalf.HostDB.parse_group_key, key)
+
+        for db in [self.db, gandalf.HostDB(gandalf.HostTable(
+                       [dict(h, ip=h.get("ip", "10.0.1.1")) for h in self.hosts]))]:
+            self.assertEqual(db.group_names("vlan"), ["10", "20"])
+            self.assertEqual(db.group_names("type"), ["cimc", "comp", "head"])
+            self.assertEqual(db.group_names("unknown"), [])
+            self.assertRaises(KeyError, db.group, "vlan", "30")
+            self.assertRaises(ValueError, db.group_names, "ip/40")
+
+            # Group restricts every query to its hosts
+            group = db.group("vlan", "20")
+            self.assertEqual(len(group), 2)
+            self.assertEqual([h["hostname"] for h in group.all()], ["bar", "qux"])
+            self.assertEqual([h["hostname"] for h in group], ["bar", "qux"])
+            self.assertEqual(group.search(host.type == "comp"), [db.get(doc_id=5)])
+            self.assertEqual(group.search(host.type == "comp")[0].doc_id, 5)
+            self.assertEqual(group.count(host.hostname.test(lambda s: True)), 2)
+            self.assertEqual(group.get(doc_id=1), None)
+            self.assertEqual(group.get(doc_id=2)["hostname"], "bar")
+            self.assertFalse(group.contains(host.hostname == "foo"))
+            self.assertEqual(group.group_names("type"), ["comp", "head"])
+            self.assertEqual([h["hostname"] for h in group.group("type", "head").all()], ["bar"])
+            self.assertEqual(group.source(1), None)
+
+        # Hosts are grouped by networks, hosts without IP address are left out
+        self.assertEqual(self.db.group_names("ip/24"), ["10.0.0.0", "192.168.0.0"])
+        self.assertEqual(self.db.group_names("ip/1"), ["0.0.0.0", "128.0.0.0"])
+        self.assertEqual([h["hostname"] for h in self.db.group("ip/24", "192.168.0.0").all()],
+                         ["mew", "baz"])
+        self.assertEqual(self.db.group("ip/24", "10.0.0.0").search(
+                             gandalf.HostQuery().ip.in_subnet("10.0.0.2/32")),
+                         [self.hosts[1]])
+
+        # Column that is not indexed is grouped in a single pass
+        db = gandalf.HostDB(self.hosts, indexed_columns=())
+        self.assertEqual(db.group_names("vlan"), ["10", "20"])
+        self.assertEqual(db.group("vlan", "10").all(), [self.hosts[0], self.hosts[2]])
+        self.assertIs(db._partition("vlan"), db._partition("vlan"))
+
+
+    def test_conflicts(self):
+        '''
+            Test that shared IP addresses, MAC addresses and host names are found.
+        '''
+        hosts = [
+            {"hostname": "foo", "domain": "a.com", "ip": "10.0.0.1", "mac": "aa:00:00:00:00:01"},
+            {"hostname": "bar", "domain": "a.com", "ip": "10.0.0.2", "mac": "AA:00:00:00:00:01"},
+            {"hostname": "foo", "domain": "b.com", "ip": "10.0.0.3", "mac": ""},
+            {"hostname": "bar", "domain": "a.com", "ip": "10.0.0.1", "mac": ""},
+            {"hostname": "mew", "domain": "a.com", "ip": "10.0.0.4", "mac": "aa:00:00:00:00:02"}
+        ]
+        expected = [("IP address", "10.0.0.1", [1, 4]),
+                    ("MAC address", "aa:00:00:00:00:01", [1, 2]),
+                    ("host name", "bar.a.com", [2, 4])]
+        for db in [gandalf.HostDB(hosts), gandalf.HostDB(gandalf.HostTable(hosts)),
+                   gandalf.HostDB(hosts, indexed_columns=())]:
+            self.assertEqual(db.conflicts(), expected)
+            self.assertEqual([doc.ip_shared for doc in db.all()], [True, False, False, True, False])
+            self.assertEqual(db.group("domain", "a.com").conflicts(), expected)
+        self.assertEqual(gandalf.HostDB(hosts[2:]).conflicts(), [])
+        self.assertEqual(gandalf.HostDB([]).conflicts(), [])
+
+        # Views check only hosts that are not known to have unique IP address
+        db = gandalf.HostDB(hosts)
+        self.assertRaises(ValueError, gandalf.ViewSet.rdns, db.all())
+        self.assertEqual(gandalf.ViewSet.rdns(db.all()[1:]), gandalf.ViewSet.rdns(hosts[1:]))
+        records = [gandalf.HostRecord(hosts[0], 1), gandalf.HostRecord(hosts[3], 4)]
+        self.assertEqual(len(gandalf.ViewSet.rdns(records).split("\n")), 2)
+        self.assertRaises(ValueError, gandalf.ViewSet.rdns, [dict(h) for h in records])
+
+        # Records that are given twice or changed are checked as well
+        for db in [gandalf.HostDB(hosts), gandalf.HostDB(gandalf.HostTable(hosts))]:
+            records = db.all()
+            self.assertRaises(ValueError, gandalf.ViewSet.rdns, records[1:3] + records[2:4])
+            self.assertRaises(ValueError, gandalf.ViewSet.rdns, iter(records[2:] * 2))
+            records[2]["ip"] = records[4]["ip"]
+            self.assertRaises(ValueError, gandalf.ViewSet.rdns, records[1:3] + records[4:])
+
+
+class TestHostTable(unittest.TestCase):
+    '''
+        A set of tests for HostTable class.
+    '''
+
+    def test_host_table(self):
+        '''
+            Test that rows read from HostTable are the same
+            as rows it was built from.
+        '''
+        hosts = [
+            {"hostname": "foo", "ip": "10.0.0.1", "mac": "ab:cd:ef:01:02:03",
+                "vlan": 10, "mask": 8, "type": "comp"},
+            {"hostname": "bar", "ip": "255.255.255.255", "mac": "AB:CD:EF:01:02:03",
+                "vlan": None, "mask": 32, "type": "comp"},
+            {"hostname": "mew", "ip": "0.0.0.0", "mac": "",
+                "vlan": 4095, "mask": 0, "type": "head"}
+        ]
+        table = gandalf.HostTable(hosts)
+        self.assertEqual(list(table), hosts)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.columns, ["hostname", "ip", "mac", "vlan", "mask", "type"])
+        self.assertEqual(list(table.integers("ip")), [0x0A000001, 0xFFFFFFFF, 0])
+        self.assertEqual(table.integers("type"), None)
+        values, codes = table.distinct("type")
+        self.assertEqual(values, ["comp", "head"])
+        self.assertEqual(list(codes), [0, 0, 1])
+        self.assertEqual(table.distinct("ip"), None)
+        self.assertEqual(table.value(1, "mac"), "AB:CD:EF:01:02:03")
+
+        # Values that do not fit into integer columns
+        hosts += [{"hostname": "baz", "ip": "10.0.0.01", "mac": "Ab:cd:ef:01:02:03",
+                   "vlan": True, "mask": "8", "type": 1}]
+        table = gandalf.HostTable(hosts)
+        self.assertEqual(list(table), hosts)
+        self.assertEqual(table.integers("ip"), None)
+        self.assertEqual(table.value(3, "type"), 1)
+        self.assertEqual(table.value(3, "vlan"), True)
+
+        # Rows with different columns
+        self.assertEqual(list(gandalf.HostTable([{"a": 1}, {"b": 1}])),
+                         [{"a": 1, "b": None}, {"a": None, "b": 1}])
+        table = gandalf.HostTable([{"a": 1}, {"a": 2, "ip": "10.0.0.1", "vlan": 5}, {"vlan": 6}])
+        self.assertEqual(list(table), [{"a": 1, "ip": None, "vlan": None},
+                                       {"a": 2, "ip": "10.0.0.1", "vlan": 5},
+                                       {"a": None, "ip": None, "vlan": 6}])
+        self.assertEqual(list(table.integers("vlan")), [0, 5, 6])
+        self.assertEqual(list(gandalf.HostTable([])), [])
+
+
+    def test_views(self):
+        '''
+            Test that views produce the same output for rows from HostTable.
+        '''
+        hosts = [
+            {"hostname": "foo", "ip": "10.12.13.14", "mask": 8, "domain": "bar.com",
+                "mac": "00:00:00:00:00:00", "resides_on": "foo"},
+            {"hostname": "mew", "ip": "10.12.13.1", "mask": 8, "domain": "bar.com",
+                "mac": "10:00:00:00:00:00", "resides_on": "mew"},
+            {"hostname": "sun", "ip": "130.12.13.14", "mask": 16, "domain": "bum.com",
+                "mac": "20:00:00:00:00:00", "resides_on": "sun"},
+            {"hostname": "rain", "ip": "10.12.14.1", "mask": 24, "domain": "go.com",
+                "mac": "30:00:00:00:00:00", "resides_on": "rain"}
+        ]
+        records = gandalf.HostDB(gandalf.HostTable(hosts)).all()
+        self.assertTrue(all(isinstance(r, gandalf.HostRecord) for r in records))
+        for view in [gandalf.ViewSet.hosts, gandalf.ViewSet.dns,
+                     gandalf.ViewSet.rdns, gandalf.ViewSet.dhcp]:
+            self.assertEqual(view(records), view(hosts))
+
+        # Address that a template changes is used instead of the stored one
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sqlite = gandalf.SqliteHostDB.create(tmpdir + "/hosts.db", hosts)
+            expected = [dict(host) for host in hosts]
+            expected[1]["ip"] = "10.9.9.200"
+            for records in [gandalf.HostDB(gandalf.HostTable(hosts)).all(), sqlite.all()]:
+                records[1]["ip"] = "10.9.9.200"
+                for view in [gandalf.ViewSet.hosts, gandalf.ViewSet.rdns, gandalf.ViewSet.dhcp]:
+                    self.assertEqual(view(records), view(expected))
+            self.assertIn("fixed-address 10.9.9.200; option broadcast-address 10.255.255.255;",
+                          gandalf.ViewSet.dhcp(expected))
+            sqlite._conn.close()
+
+
+class TestSqliteHostDB(unittest.TestCase):
+    '''
+        A set of tests for SqliteHostDB class.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.hosts = list(benchmark.generate_hosts(300, seed=1))
+        for host in self.hosts:
+            host["vlan"] = host["vlan"] or None
+        self.hosts[5]["ip"] = self.hosts[6]["ip"]
+        self.hosts[7]["vlan"] = None
+        self.expected = gandalf.HostDB(self.hosts)
+        self.db = gandalf.SqliteHostDB.create(self.tmpdir.name + "/hosts.db", self.hosts)
+        self.host = gandalf.HostQuery()
+
+
+    def tearDown(self):
+        self.db._conn.close()
+        self.tmpdir.cleanup()
+
+
+    def test_search(self):
+        '''
+            Test that queries give the same results as HostDB.
+        '''
+        host = self.host
+        for cond in [host.vlan == 1010, host.vlan != 1010, host.vlan == None, ~(host.vlan == None),
+                     (host.vlan == 1010) | (host.type == "head"), host.mask < 25, host.mask > 24,
+                     host.hostname >= "m", host.vlan == "1010", host.type.one_of(["head", "fi"]),
+                     host.vlan.one_of([None, 1010]), host.ip.in_subnet("10.0.0.0/24"),
+                     host.missing == 1, ~(host.missing == 1), host.mac.exists(),
+                     host.hostname.matches("^a"), host.noop(),
+                     (host.vlan == 1010) & host.hostname.test(lambda name: name.endswith("1")),
+                     lambda doc: doc["mask"] == 24]:
+            self.assertEqual(self.db.search(cond), self.expected.search(cond))
+            self.assertEqual([doc.doc_id for doc in self.db.search(cond)],
+                             [doc.doc_id for doc in self.expected.search(cond)])
+            self.assertEqual(self.db.count(cond), self.expected.count(cond))
+            self.assertEqual(self.db.get(cond), self.expected.get(cond))
+
+        # What is translated into SQL
+        self.assertEqual(self.db._where((host.vlan == 1010)._hash), ("(c4 = ?)", (1010,), True))
+        sql, params, exact = self.db._where(((host.vlan == 1010) & host.hostname.matches("a"))._hash)
+        self.assertEqual((sql, params, exact), ("(c4 = ?)", (1010,), False))
+        self.assertFalse(self.db._where((host.vlan.matches("a") | (host.vlan == 1))._hash)[2])
+        self.assertFalse(self.db._where(host.ip.test(lambda ip: True)._hash)[2])
+
+
+    def test_other_methods(self):
+        '''
+            Test the rest of HostDB interface.
+        '''
+        self.assertEqual(len(self.db), 300)
+        self.assertEqual(list(self.db), self.expected.all())
+        self.assertEqual(self.db.all(), self.expected.all())
+        self.assertEqual(self.db.get(doc_id=7), self.expected.get(doc_id=7))
+        self.assertIsNone(self.db.get(doc_id=301))
+        self.assertTrue(self.db.contains(self.host.vlan == 1010))
+        self.assertFalse(self.db.contains(doc_id=0))
+        self.assertRaises(RuntimeError, self.db.get)
+        self.assertIsNone(self.db.source(1))
+        self.assertEqual(self.db.conflicts(), self.expected.conflicts())
+        self.assertEqual([doc.ip_shared for doc in self.db.all()],
+                         [doc.ip_shared for doc in self.expected.all()])
+        self.assertEqual(gandalf.ViewSet.rdns(self.db.search(self.host.ip.in_subnet("10.0.0.0/24"))),
+                         gandalf.ViewSet.rdns(self.expected.search(self.host.ip.in_subnet("10.0.0.0/24"))))
+
+        # Groups
+        for key in ["vlan", "ip/24", "type", "missing"]:
+            self.assertEqual(self.db.group_names(key), self.expected.group_names(key))
+            for name in self.db.group_names(key):
+                group, expected = self.db.group(key, name), self.expected.group(key, name)
+                self.assertEqual(len(group), len(expected))
+                self.assertEqual(group.all(), expected.all())
+                self.assertEqual(group.search(self.host.type == "comp"),
+                                 expected.search(self.host.type == "comp"))
+                self.assertEqual(group.group_names("type"), expected.group_names("type"))
+        group = self.db.group("type", "head")
+        self.assertIsNone(group.get(doc_id=self.expected.get(self.host.type == "comp").doc_id))
+        self.assertRaises(KeyError, self.db.group, "vlan", "4095")
+        self.assertRaises(ValueError, self.db.group_names, "ip/33")
+
+        # Database can be handed over to another process
+        db = gandalf.pickle.loads(gandalf.pickle.dumps(group))
+        self.assertEqual(db.all(), group.all())
+        db._conn.close()
+
+        # Rows with different columns are filled in
+        path = self.tmpdir.name + "/other.db"
+        db = gandalf.SqliteHostDB.create(path, [{"a": 1}, {"a": 2}, {"b": 1}, {"a": 3, "b": 2}])
+        self.assertEqual(db.all(), [{"a": 1, "b": None}, {"a": 2, "b": None},
+                                    {"a": None, "b": 1}, {"a": 3, "b": 2}])
+        self.assertEqual(db.search(self.host.b == None), db.all()[:2])
+        db._conn.close()
+
+        # Files of other versions are rejected
+        empty = gandalf.SqliteHostDB.create(path, [])
+        self.assertEqual((len(empty), empty.all(), empty.group_names("vlan")), (0, [], []))
+        empty._conn.close()
+        with mock.patch.object(gandalf.SqliteHostDB, 'VERSION', 0):
+            self.assertRaises(ValueError, gandalf.SqliteHostDB, path)
+        with open(path, "w") as f:
+            f.write("garbage")
+        self.assertRaises(gandalf.sqlite3.Error, gandalf.SqliteHostDB, path)
+        self.assertRaises(IOError, gandalf.SqliteHostDB.create, self.tmpdir.name + "/no/dir.db", [])
+
+
+class TestIncremental(unittest.TestCase):
+    '''
+        A set of tests for incremental rendering machinery.
+    '''
+
+    def setUp(self):
+        self.hosts = [
+            {"hostname": "foo", "vlan": 10, "type": "comp", "ip": "10.0.0.1"},
+            {"hostname": "bar", "vlan": 20, "type": "head", "ip": "10.0.0.2"},
+            {"hostname": "mew", "vlan": 10, "type": "head", "ip": "192.168.0.1"}
+        ]
+        self.db = gandalf.HostDB(self.hosts)
+        self.host = gandalf.tinydb.Query()
+
+
+    def test_encode_query(self):
+        '''
+            Test encode_query and decode_query functions.
+        '''
+        host = self.host
+        prefix = "192."
+        queries = [
+            host.vlan == 10,
+            host.vlan != 10,
+            host.vlan >= 20,
+            host.type.one_of(["comp", "cimc"]),
+            (host.vlan == 10) & ~(host.type == "comp"),
+            (host.vlan == 20) | host.hostname.exists(),
+            gandalf.HostQuery().ip.in_subnet("192.168.0.0/16"),
+            host.noop()
+        ]
+        for query in queries:
+            encoded = gandalf.encode_query(query)
+            decoded = gandalf.decode_query(gandalf.json.loads(gandalf.json.dumps(encoded)))
+            self.assertEqual(self.db.search(decoded), self.db.search(query))
+
+        # Test functions are encoded by digests of their code and closure,
+        # so queries that use them are never rebuilt
+        def starts_with(prefix):
+            return host.ip.test(lambda s: s.startswith(prefix))
+        encoded = [gandalf.encode_query(query) for query in [
+            starts_with("10."), starts_with("10."), starts_with(prefix),
+            host.ip.test(lambda s: s.startswith("10.")),
+            host.ip.test(lambda s, p: s.startswith(p), "10.0.0.2"),
+            (host.vlan == 10) & host.ip.test(lambda s: s.startswith("10."))]]
+        self.assertEqual(encoded[0], encoded[1])
+        self.assertEqual(encoded[0][:2], ["test", ["ip"]])
+        self.assertEqual(len({gandalf.json.dumps(e) for e in encoded}), len(encoded) - 1)
+        self.assertNotIn("code", gandalf.json.dumps(encoded))
+        for data in encoded:
+            self.assertRaises(ValueError, gandalf.decode_query, gandalf.json.loads(gandalf.json.dumps(data)))
+
+        # Queries that can not be rebuilt
+        for query in [host.ip.matches("10\\..*"), host.vlan == [10], host.vlan < (10,),
+                      host.ip.test(str.startswith, "10."),
+                      host.ip.test(lambda s: bool(self)),
+                      host.vlan.map(lambda v: v + 1) == 11,
+                      lambda doc: True]:
+            self.assertRaises(ValueError, gandalf.encode_query, query)
+
+
+    def test_recording_db(self):
+        '''
+            Test RecordingDB class.
+        '''
+        host = self.host
+        db = gandalf.RecordingDB(self.db)
+        self.assertEqual(db.search(host.vlan == 10), self.db.search(host.vlan == 10))
+        self.assertEqual(db.all(), self.db.all())
+        self.assertEqual(list(db), self.db.all())
+        self.assertEqual(len(db), 3)
+        self.assertEqual(db.get(host.hostname == "bar"), self.hosts[1])
+        self.assertEqual(db.get(doc_id=3), self.hosts[2])
+        self.assertEqual(db.count(host.type == "head"), 2)
+        self.assertTrue(db.contains(host.ip.one_of(["192.168.0.1", "192.168.0.2"])))
+        self.assertTrue(db.replayable)
+        self.assertTrue(gandalf.RecordingDB.replay(self.db, db.queries))
+        db.source(1)
+        self.assertEqual(db.queries[-1][0], "source")
+        self.assertTrue(gandalf.RecordingDB.replay(self.db, db.queries))
+
+        # Queries with test functions are recorded, but never replayed
+        self.assertTrue(db.contains(host.ip.test(lambda s: s.startswith("192."))))
+        self.assertTrue(db.replayable)
+        self.assertFalse(gandalf.RecordingDB.replay(self.db, db.queries))
+
+        # Change a row that is not returned by queries
+        db = gandalf.RecordingDB(self.db)
+        db.search(host.vlan == 10)
+        db.count(host.type == "comp")
+        hosts = [dict(h) for h in self.hosts]
+        hosts[1]["ip"] = "10.0.0.3"
+        self.assertTrue(gandalf.RecordingDB.replay(gandalf.HostDB(hosts), db.queries))
+
+        # Change a row so that it is returned by a query
+        hosts[1]["vlan"] = 10
+        self.assertFalse(gandalf.RecordingDB.replay(gandalf.HostDB(hosts), db.queries))
+
+        # Query that can not be encoded
+        db.search(host.ip.matches("10\\..*"))
+        self.assertFalse(db.replayable)
+
+        # Failing query is considered changed
+        self.assertFalse(gandalf.RecordingDB.replay(self.db, [["search", ["foo"], "0"]]))
+
+
+    @mock.patch('gandalf.os.path.exists')
+    def test_incremental_state(self, exists_mock):
+        '''
+            Test IncrementalState class.
+        '''
+        host = self.host
+        exists_mock.return_value = True
+        recording_db = gandalf.RecordingDB(self.db)
+        recording_db.search(host.vlan == 20)
+        entry = gandalf.IncrementalState(var_digest="v1").entry("t.mako", "out/t",
+                "d1", recording_db)
+        self.assertEqual(entry["output"], "out/t")
+        state = gandalf.IncrementalState({"out/t": entry}, "v1")
+        self.assertTrue(state.up_to_date("t.mako", "out/t", "d1", self.db))
+        self.assertFalse(state.up_to_date("t.mako", "out/other", "d1", self.db))
+        self.assertFalse(state.up_to_date("other.mako", "out/t", "d1", self.db))
+        self.assertFalse(state.up_to_date("t.mako", "out/t", "d2", self.db))
+        self.assertFalse(gandalf.IncrementalState({"out/t": entry}, "v2")
+                         .up_to_date("t.mako", "out/t", "d1", self.db))
+        self.assertFalse(state.up_to_date("t.mako", "out/t", "d1", gandalf.HostDB(self.hosts[:1])))
+        exists_mock.return_value = False
+        self.assertFalse(state.up_to_date("t.mako", "out/t", "d1", self.db))
+        exists_mock.return_value = True
+
+        # Not replayable entry is never up to date
+        recording_db.replayable = False
+        state = gandalf.IncrementalState({"out/t": state.entry("t.mako", "out/t", "d1",
+                                                              recording_db)}, "v1")
+        self.assertFalse(state.up_to_date("t.mako", "out/t", "d1", self.db))
+
+        # Manifest saving and loading
+        with mock.patch('gandalf.write_file_atomic') as write_mock:
+            gandalf.IncrementalState.save("manifest.json", [entry])
+            self.assertEqual(write_mock.call_args[0][0], "manifest.json")
+            written = write_mock.call_args[0][1].decode("utf8")
+        with mock.patch('gandalf.open', mock.mock_open(read_data=written)):
+            state = gandalf.IncrementalState.load("manifest.json", "v1")
+        self.assertEqual(state.entries, {"out/t": entry})
+        self.assertTrue(state.up_to_date("t.mako", "out/t", "d1", self.db))
+        with mock.patch('gandalf.open', mock.mock_open(read_data="{]")):
+            self.assertEqual(gandalf.IncrementalState.load("manifest.json", "v1").entries, {})
+        with mock.patch('gandalf.open', side_effect=IOError()):
+            self.assertEqual(gandalf.IncrementalState.load("manifest.json", "v1").entries, {})
+
+
+class TestProfile(unittest.TestCase):
+    '''
+        A set of tests for profiling machinery.
+    '''
+
+    def setUp(self):
+        self.hosts = [
+            {"hostname": "foo", "vlan": 10, "type": "comp", "ip": "10.0.0.1",
+             "domain": "example.com"},
+            {"hostname": "bar", "vlan": 20, "type": "head", "ip": "10.0.0.2",
+             "domain": "example.com"},
+            {"hostname": "mew", "vlan": 10, "type": "head", "ip": "192.168.0.1",
+             "domain": "example.com"}
+        ]
+        self.profile = gandalf.Profile()
+        self.db = gandalf.ProfilingDB(gandalf.HostDB(self.hosts), self.profile)
+        self.host = gandalf.HostQuery()
+
+
+    def test_profiling_db(self):
+        '''
+            Test that queries are forwarded and their statistics collected.
+        '''
+        self.assertEqual(len(self.db), 3)
+        self.assertEqual(len(list(self.db)), 3)
+        self.assertEqual(len(self.db.search(self.host.vlan == 10)), 2)
+        self.assertEqual(len(self.db.search(self.host.vlan == 10)), 2)
+        self.assertEqual(self.db.count(self.host.hostname.matches("^[fm]")), 2)
+        self.assertEqual(self.db.get(self.host.ip.in_subnet("10.0.0.0/24"))["hostname"], "foo")
+        self.assertTrue(self.db.contains(doc_id=3))
+        self.assertIsNone(self.db.get(self.host.vlan == 30))
+
+        queries = {(stats["method"], stats["query"]): stats for stats in self.profile.report()["queries"]}
+        self.assertEqual(queries[("all", None)]["returned"], 3)
+        stats = queries[("search", repr(self.host.vlan == 10))]
+        self.assertEqual((stats["calls"], stats["scanned"], stats["returned"]), (2, 4, 4))
+        stats = queries[("count", repr(self.host.hostname.matches("^[fm]")))]
+        self.assertEqual((stats["scanned"], stats["returned"]), (3, 2)) # not indexed
+        stats = queries[("get", repr(self.host.ip.in_subnet("10.0.0.0/24")))]
+        self.assertEqual((stats["scanned"], stats["returned"]), (1, 1)) # stops at first match
+        stats = queries[("get", repr(self.host.vlan == 30))]
+        self.assertEqual((stats["scanned"], stats["returned"]), (0, 0))
+        self.assertEqual(queries[("get_id", "3")]["returned"], 1)
+
+
+    def test_profiling_view_set(self):
+        '''
+            Test that views give the same results and are measured.
+        '''
+        view = gandalf.ProfilingViewSet(self.profile)
+        self.assertEqual(view.hosts(self.hosts), gandalf.ViewSet.hosts(self.hosts))
+        view.setDefaultView(view.dns)
+        self.assertEqual(view(self.hosts, "addr"), gandalf.ViewSet.dns(self.hosts))
+        view(self.hosts)
+        self.assertRaises(ValueError, view, self.hosts, "txt")
+        self.assertEqual(self.profile.views["hosts"]["calls"], 1)
+        self.assertEqual(self.profile.views["dns"]["calls"], 3)
+        self.assertNotIn("rdns", self.profile.views)
+
+        # Generator views are measured while they yield lines
+        self.assertEqual(list(view.iter_dns(self.hosts)), list(gandalf.ViewSet.iter_dns(self.hosts)))
+        self.assertEqual(self.profile.views["iter_dns"]["calls"], 1)
+        self.assertRaises(ValueError, list, view.iter_dns(self.hosts, "txt"))
+        self.assertEqual(self.profile.views["iter_dns"]["calls"], 2)
+
+
+    def test_report(self):
+        '''
+            Test reports of templates and of the run.
+        '''
+        with self.profile.stage("render"):
+            self.db.all()
+        with self.profile.stage("render"):
+            pass
+        report = self.profile.report()
+        self.assertEqual(report["stages"]["render"]["calls"], 2)
+        self.assertEqual(report["wall"], round(self.profile.stages["render"]["wall"], 6))
+        self.assertEqual(len(report["queries"]), 1)
+
+        run = gandalf.Profile()
+        run.templates = [dict(report, wall=1), dict(report, wall=2)]
+        with mock.patch('gandalf.write_file_atomic') as write_file_atomic_mock:
+            run.save("profile.json")
+        path, data = write_file_atomic_mock.call_args[0]
+        self.assertEqual(path, "profile.json")
+        self.assertEqual([t["wall"] for t in gandalf.json.loads(data.decode("utf8"))["templates"]], [2, 1])
+
+
+    def test_render_template(self):
+        '''
+            Test profiling of a template.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(tmpdir + "/hosts.mako", "w") as f:
+                f.write("${ view.hosts(db.search(host.vlan == 10)) }")
+            entry = gandalf.render_template(tmpdir + "/hosts.mako", tmpdir + "/out/hosts.mako",
+                                            "\000", gandalf.HostDB(self.hosts), {},
+                                            profiling=True)
+            with open(tmpdir + "/out/hosts") as f:
+                self.assertEqual(f.read(), gandalf.ViewSet.hosts(self.hosts[::2]))
+        report = entry["profile"]
+        self.assertEqual(set(report["stages"]), {"compile", "render", "write"})
+        self.assertEqual(report["views"]["hosts"]["calls"], 1)
+        self.assertEqual(report["queries"][0]["returned"], 2)
+
+
+class TestMemoCache(unittest.TestCase):
+    '''
+        A set of tests for memoization of queries and views.
+    '''
+
+    def setUp(self):
+        self.hosts = [
+            {"hostname": "foo", "vlan": 10, "type": "comp", "ip": "10.0.0.1",
+             "domain": "example.com", "mask": 24, "mac": "aa:00:00:00:00:01"},
+            {"hostname": "bar", "vlan": 20, "type": "head", "ip": "10.0.0.2",
+             "domain": "example.com", "mask": 24, "mac": "aa:00:00:00:00:02"},
+            {"hostname": "mew", "vlan": 10, "type": "head", "ip": "192.168.0.1",
+             "domain": "example.com", "mask": 24, "mac": "aa:00:00:00:00:03"}
+        ]
+        self.memo = gandalf.MemoCache()
+        self.stats = gandalf.MemoCache.new_stats()
+        self.host = gandalf.HostQuery()
+
+
+    def test_memoizing_db(self):
+        '''
+            Test that the same queries are run once and give the same results.
+        '''
+        hostdb = gandalf.HostDB(self.hosts)
+        db = gandalf.MemoizingDB(hostdb, self.memo, self.stats)
+        other = gandalf.MemoizingDB(hostdb, self.memo, self.stats)
+        with mock.patch.object(hostdb, 'search', wraps=hostdb.search) as search_mock:
+            self.assertEqual(db.search(self.host.vlan == 10), hostdb.search(self.host.vlan == 10))
+            self.assertEqual(other.search(self.host.vlan == 10), hostdb.search(self.host.vlan == 10))
+            self.assertEqual(search_mock.call_count, 3)
+        self.assertEqual(other.get(self.host.type == "head")["hostname"], "bar")
+        self.assertEqual(db.get(self.host.type == "head").doc_id, 2)
+        self.assertIsNone(db.get(self.host.vlan == 30))
+        self.assertIsNone(db.get(self.host.vlan == 30))
+        self.assertEqual(db.count(self.host.ip.in_subnet("10.0.0.0/8")), 2)
+        self.assertEqual(db.count(self.host.ip.in_subnet("10.0.0.0/8")), 2)
+        self.assertTrue(db.contains(doc_id=3))
+        self.assertEqual((len(db), len(list(db)), db.source(1)), (3, 3, None))
+        self.assertRaises(RuntimeError, db.get)
+        self.assertEqual(self.stats["queries"], {"hits": 4, "misses": 4})
+
+        # Templates get documents of their own
+        db.search(self.host.vlan == 10)[0]["hostname"] = "changed"
+        self.assertEqual(db.search(self.host.vlan == 10)[0]["hostname"], "foo")
+
+        # Queries without structure or with unhashable values are not cached
+        self.assertEqual(len(db.search(lambda host: host["vlan"] == 10)), 2)
+        self.assertEqual(len(db.search(self.host.vlan.test(lambda v, x: v in x, bytearray(b"\n")))), 2)
+        self.assertEqual(self.stats["queries"], {"hits": 6, "misses": 4})
+
+        # Groups of hosts are cached apart
+        group = gandalf.MemoizingDB(hostdb.group("type", "head"), self.memo, self.stats,
+                                    ("type", "head"))
+        self.assertEqual([h.doc_id for h in group.search(self.host.vlan == 10)], [3])
+        self.assertEqual([h.doc_id for h in db.search(self.host.vlan == 10)], [1, 3])
+
+
+    def test_memoizing_sqlite_db(self):
+        '''
+            Test that documents of cached results are read from SQLite
+            database with a few statements, not with one per document.
+        '''
+        hosts = list(benchmark.generate_hosts(1200, seed=1))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sqlite = gandalf.SqliteHostDB.create(tmpdir + "/hosts.db", hosts)
+            statements = []
+            sqlite._conn.set_trace_callback(statements.append)
+            query = self.host.ip.test(lambda ip: not ip.endswith(".1"))
+            expected = sqlite.search(query)
+            self.assertGreater(len(expected), 2 * sqlite.DOCUMENTS_BATCH)
+            for _ in range(2):
+                db = gandalf.MemoizingDB(sqlite, self.memo, self.stats)
+                del statements[:]
+                self.assertEqual(db.search(query), expected)
+                self.assertEqual(db.get(query), expected[0])
+            self.assertEqual(self.stats["queries"], {"hits": 2, "misses": 2})
+            self.assertEqual(len(statements), 4) # 3 batches of the search and 1 of the get
+            self.assertEqual(sqlite.documents([5, 2, 5]), [sqlite.get(doc_id=doc_id)
+                                                            for doc_id in [5, 2, 5]])
+
+            # Searches answered in SQL alone are run every time
+            self.assertEqual(db.search(self.host.type == "comp"), sqlite.search(self.host.type == "comp"))
+            self.assertEqual(db.get(self.host.type == "comp"), sqlite.get(self.host.type == "comp"))
+            self.assertEqual(self.stats["queries"], {"hits": 2, "misses": 2})
+            sqlite._conn.close()
+        hostdb = gandalf.HostDB(hosts)
+        self.assertEqual(hostdb.documents([3, 1]), [hostdb.get(doc_id=3), hostdb.get(doc_id=1)])
+
+
+    def test_memoizing_view_set(self):
+        '''
+            Test that views of the same hosts are computed once.
+        '''
+        db = gandalf.HostDB(self.hosts)
+        profile = gandalf.Profile()
+        view = gandalf.MemoizingViewSet(self.memo, self.stats, gandalf.ProfilingViewSet(profile))
+        self.assertEqual(view.dns(db.all()), gandalf.ViewSet.dns(self.hosts))
+        self.assertEqual(view.dns(iter(db.all()), type_="addr"), gandalf.ViewSet.dns(self.hosts))
+        self.assertEqual(view.dhcp(db.all(), router_ip="10.0.0.254"),
+                         gandalf.ViewSet.dhcp(self.hosts, router_ip="10.0.0.254"))
+        self.assertEqual(view.dhcp(db.all(), True, "10.0.0.254"),
+                         gandalf.ViewSet.dhcp(self.hosts, router_ip="10.0.0.254"))
+        self.assertEqual(view.dhcp(db.all()), gandalf.ViewSet.dhcp(self.hosts))
+        self.assertEqual(self.stats["views"], {"hits": 2, "misses": 3})
+        self.assertEqual(profile.views["dns"]["calls"], 1)
+
+        # Views of other hosts, modified documents and plain dicts are not taken from cache
+        self.assertEqual(view.dns(db.all()[1:]), gandalf.ViewSet.dns(self.hosts[1:]))
+        hosts = db.all()
+        hosts[0]["hostname"] = "changed"
+        self.assertIn("changed", view.dns(hosts))
+        self.assertEqual(view.dns(self.hosts), gandalf.ViewSet.dns(self.hosts))
+        self.assertEqual(list(view.iter_dns(db.all())), list(gandalf.ViewSet.iter_dns(self.hosts)))
+        self.assertEqual(self.stats["views"], {"hits": 2, "misses": 4})
+        self.assertRaises(ValueError, view.dns, db.all(), "txt")
+        self.assertRaises(TypeError, view.dns)
+        view.setDefaultView(view.hosts)
+        self.assertEqual(view(db.all()), gandalf.ViewSet.hosts(self.hosts))
+
+        # Every change of a record marks it modified
+        for change in [lambda h: h.update(vlan=1), lambda h: h.pop("vlan"), lambda h: h.clear(),
+                       lambda h: h.setdefault("new", 1), lambda h: h.__delitem__("vlan")]:
+            record = db.get(doc_id=1)
+            self.assertFalse(record.modified)
+            change(record)
+            self.assertTrue(record.modified)
+
+
+    def test_render_all(self):
+        '''
+            Test that templates of a run share the cache.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(tmpdir + "/templates")
+            for name in ["a", "b"]:
+                with open(tmpdir + "/templates/" + name, "w") as f:
+                    f.write("${ view.dns(db.search(host.vlan == 10)) }")
+            args = argparse.Namespace(templates=tmpdir + "/templates", output=tmpdir + "/out",
+                    dnsdir="\000", cache_dir=None, stream=False, nsupdate=None, jobs=1,
+                    io_threads=0, memoize=True, changes=None, incremental=None,
+                    shard=None, line_cache=0, profile=tmpdir + "/profile.json")
+            profile = gandalf.Profile()
+            with mock.patch('gandalf.logging') as logging_mock:
+                entries = gandalf.render_all(args, gandalf.HostDB(self.hosts), {}, profile=profile)
+            for name in ["a", "b"]:
+                with open(tmpdir + "/out/" + name) as f:
+                    self.assertEqual(f.read(), gandalf.ViewSet.dns(self.hosts[::2]))
+        self.assertEqual(profile.memo, {"queries": {"hits": 1, "misses": 1},
+                                        "views": {"hits": 1, "misses": 1}})
+        self.assertTrue(all("memo" not in entry for entry in entries))
+        logging_mock.info.assert_called_once_with(
+            "memoized queries: 1 hits, 1 misses; views: 1 hits, 1 misses")
+
+
+class TestLineCache(unittest.TestCase):
+    '''
+        A set of tests for the cache of lines of views.
+    '''
+
+    def setUp(self):
+        self.db = gandalf.HostDB(list(benchmark.generate_hosts(100, seed=1)))
+
+
+    def test_line_caching_view_set(self):
+        '''
+            Test that views give the same outputs with lines taken from cache.
+        '''
+        cache = gandalf.LineCache(1 << 20)
+        view = gandalf.LineCachingViewSet(cache)
+        hosts = self.db.all()
+        for args in [(), (False,), (True, "10.0.0.1", "pxe.efi")]:
+            expected = gandalf.ViewSet.dhcp(hosts, *args)
+            self.assertEqual(view.dhcp(hosts, *args), expected)
+            self.assertEqual(view.dhcp(iter(hosts), *args), expected)
+            self.assertEqual(list(view.iter_dhcp(hosts, *args)), expected.split("\n"))
+        self.assertEqual((cache.hits, cache.misses), (600, 300))
+        for name in ["hosts", "dns", "rdns"]:
+            self.assertEqual(getattr(view, name)(hosts), getattr(gandalf.ViewSet, name)(hosts))
+
+        # Changed hosts and values of other types are formatted again
+        hosts[0]["mac"] = hosts[1]["mac"].upper()
+        hosts[1]["domain"] = 5.0
+        self.assertEqual(view.dhcp(hosts[:2], False), gandalf.ViewSet.dhcp(hosts[:2], False))
+        self.assertEqual((cache.hits, cache.misses), (600, 300))
+        self.assertEqual(view.dhcp(hosts[2:], router_ip=["x"]),
+                         gandalf.ViewSet.dhcp(hosts[2:], router_ip=["x"]))
+        self.assertEqual(len(cache.lines), 300)
+        self.assertRaises(KeyError, view.dhcp, [{"hostname": "foo"}])
+
+
+    def test_save(self):
+        '''
+            Test that cache is saved and the least recently used lines are dropped.
+        '''
+        hosts = self.db.all()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = tmpdir + "/lines.pickle"
+            cache = gandalf.LineCache.load(path, 1 << 20)
+            gandalf.LineCachingViewSet(cache).dhcp(hosts)
+            cache.save(path)
+            cache = gandalf.LineCache.load(path, 1 << 20)
+            self.assertEqual(len(cache.lines), 100)
+            gandalf.LineCachingViewSet(cache).dhcp(hosts[:10], False)
+            size = sum(cache._size(key, line) for key, line in cache.lines.items()
+                       if key[1][0][1] is False)
+            cache.max_bytes = size + 1
+            cache.save(path)
+            cache = gandalf.LineCache.load(path, 1 << 20)
+            self.assertEqual(len(cache.lines), 10)
+            self.assertEqual(gandalf.LineCachingViewSet(cache).dhcp(hosts[:10], False),
+                             gandalf.ViewSet.dhcp(hosts[:10], False))
+            self.assertEqual((cache.hits, cache.misses), (10, 0))
+
+            # Changes made in another process are merged
+            other = gandalf.LineCache(1 << 20)
+            gandalf.LineCachingViewSet(other).dhcp(hosts[:20], False)
+            cache.merge(other.take_changes())
+            self.assertEqual((len(cache.lines), cache.hits, cache.misses), (20, 10, 20))
+            self.assertEqual((other.new, other.used, other.misses), ({}, set(), 0))
+
+            # Broken cache and cache of another script are not used
+            with mock.patch('gandalf._script_digest', return_value="other"):
+                self.assertEqual(gandalf.LineCache.load(path, 1 << 20).lines, {})
+            with open(path, "wb") as f:
+                f.write(b"broken")
+            with mock.patch('gandalf.logging') as logging_mock:
+                self.assertEqual(gandalf.LineCache.load(path, 1 << 20).lines, {})
+            self.assertTrue(logging_mock.warning.called)
+
+
+    def test_render_all(self):
+        '''
+            Test that lines of worker processes are saved.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(tmpdir + "/templates")
+            for name in ["a", "b"]:
+                with open(tmpdir + "/templates/" + name, "w") as f:
+                    f.write("${ view.dhcp(db.search(host.vlan == %s)) }" % name.replace("a", "1010")
+                            .replace("b", "1020"))
+            args = argparse.Namespace(templates=tmpdir + "/templates", output=tmpdir + "/out",
+                    dnsdir="\000", cache_dir=tmpdir + "/cache", stream=False, nsupdate=None,
+                    io_threads=0, memoize=False, changes=None, incremental=None,
+                    shard=None, line_cache=1, profile=None)
+            os.mkdir(args.cache_dir)
+            for jobs in (2, 1):
+                args.jobs = jobs
+                with mock.patch('gandalf.logging') as logging_mock:
+                    entries = gandalf.render_all(args, self.db, {})
+                self.assertTrue(all("lines" not in entry for entry in entries))
+                cache = gandalf.LineCache.load(args.cache_dir + "/lines.pickle", 1 << 20)
+                expected = sum(1 for host in self.db if host["vlan"] in (1010, 1020))
+                self.assertEqual(len(cache.lines), expected)
+            logging_mock.info.assert_called_once_with(
+                "cached lines: {} reused, 0 formatted".format(expected))
+            with open(tmpdir + "/out/a") as f:
+                self.assertEqual(f.read(), gandalf.ViewSet.dhcp(
+                    self.db.search(gandalf.HostQuery().vlan == 1010)))
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.templates = [("tpl/{}.mako".format(name), "out/" + name, None)
+                          for name in "abcdefghij"]
+
+
+    def test_parse_shard(self):
+        '''
+            Test parse_shard function.
+        '''
+        self.assertEqual(gandalf.parse_shard("2/3"), (2, 3))
+        for text in ["", "2", "0/3", "4/3", "a/3", "1/", "-1/3"]:
+            with self.assertRaises(ValueError):
+                gandalf.parse_shard(text)
+
+
+    def test_shard_templates(self):
+        '''
+            Test that shards cover all templates once and are balanced.
+        '''
+        shards = [gandalf.shard_templates(self.templates, n, 3, "out") for n in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, [])), self.templates)
+        self.assertEqual(sorted(len(tasks) for tasks in shards), [3, 3, 4])
+        self.assertEqual(shards[0], gandalf.shard_templates(self.templates, 1, 3, "out"))
+        self.assertEqual(shards[0], [task for task in self.templates if task in shards[0]])
+
+        # Heavy template gets a shard of its own
+        costs = dict({name: 1.0 for name in "bcdefghij"}, a=9.0)
+        shards = [gandalf.shard_templates(self.templates, n, 2, "out", costs) for n in (1, 2)]
+        self.assertEqual(shards[0], self.templates[:1])
+        self.assertEqual(shards[1], self.templates[1:])
+
+        # Unknown costs are average ones
+        costs = {"a": 9.0, "b": 1.0}
+        shards = [gandalf.shard_templates(self.templates, n, 2, "out", costs) for n in (1, 2)]
+        self.assertEqual([len(tasks) for tasks in shards], [5, 5])
+        self.assertIn(self.templates[0], shards[0])
+
+
+    def test_merge_shards(self):
+        '''
+            Test write_shard_manifest and merge_shards functions.
+        '''
+        manifests = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for n in (1, 2):
+                tasks = gandalf.shard_templates(self.templates, n, 2, "out")
+                entries = [{"output": task[1], "cost": 0.5} for task in tasks]
+                gandalf.write_shard_manifest(tmpdir + "/shard", n, 2, self.templates,
+                                             tasks, entries, "out")
+                with open(tmpdir + "/shard") as f:
+                    manifests.append(gandalf.json.load(f))
+        self.assertEqual(manifests[0]["tree"], list("abcdefghij"))
+        errors, costs = gandalf.merge_shards(manifests)
+        self.assertEqual(errors, [])
+        self.assertEqual(costs, {name: 0.5 for name in "abcdefghij"})
+
+        # Missing, duplicate and failed shards
+        self.assertEqual(gandalf.merge_shards([]), (["no shard manifests"], {}))
+        errors, _ = gandalf.merge_shards(manifests[:1])
+        self.assertIn("expected shards 1 to 2, got 1", errors)
+        self.assertEqual(len(errors), 1 + len(manifests[1]["assigned"]))
+        errors, _ = gandalf.merge_shards(manifests + manifests[1:])
+        self.assertIn("expected shards 1 to 2, got 1, 2, 2", errors)
+        self.assertIn("output '{}' is assigned to shards 2, 2".format(
+            manifests[1]["assigned"][0]), errors)
+        manifests[1]["rendered"] = manifests[1]["rendered"][1:]
+        manifests[1]["assigned"].append("z")
+        errors, _ = gandalf.merge_shards(manifests)
+        self.assertEqual(errors, [
+            "output '{}' failed to render in shard 2".format(manifests[1]["assigned"][0]),
+            "output 'z' is not in the tree"])
+        manifests[1]["shards"] = 3
+        errors, _ = gandalf.merge_shards(manifests)
+        self.assertIn("shard 2 split another tree of outputs or into another "
+                      "number of shards", errors)
+
+
+    @mock.patch('gandalf.sys.exit')
+    def test_merge_shards_main(self, exit_mock):
+        '''
+            Test merge_shards_main function and costs it writes.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch('gandalf.logging'):
+            paths = []
+            for n in (1, 2):
+                paths.append("{}/{}.json".format(tmpdir, n))
+                tasks = gandalf.shard_templates(self.templates, n, 2, "out")
+                gandalf.write_shard_manifest(paths[-1], n, 2, self.templates, tasks,
+                        [{"output": task[1], "cost": 1.0} for task in tasks], "out")
+            gandalf.merge_shards_main(paths + ["-o", tmpdir + "/costs.json"])
+            exit_mock.assert_called_once_with(0)
+            self.assertEqual(gandalf.load_shard_costs(tmpdir + "/costs.json"),
+                             {name: 1.0 for name in "abcdefghij"})
+
+            # Missing shard, missing and invalid manifests
+            for argv, status in [(paths[:1], 3), ([tmpdir + "/none.json"], 1),
+                                 ([tmpdir + "/costs.json"], 2)]:
+                exit_mock.reset_mock()
+                gandalf.merge_shards_main(argv)
+                exit_mock.assert_called_once_with(status)
+
+            # Manifests have costs too, other files do not
+            self.assertEqual(gandalf.load_shard_costs(paths[0]), {task[1][4:]: 1.0
+                for task in gandalf.shard_templates(self.templates, 1, 2, "out")})
+            with open(tmpdir + "/costs.json", "w") as f:
+                f.write('{"version": 1}')
+            with self.assertRaises(ValueError):
+                gandalf.load_shard_costs(tmpdir + "/costs.json")
+
+
+class TestBenchmark(unittest.TestCase):
+    '''
+        A set of tests for the benchmark script.
+    '''
+
+    def test_generate_hosts(self):
+        '''
+            Test that generated inventory is valid and can be rendered.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csvpath = tmpdir + "/hosts.csv"
+            benchmark.write_csv(csvpath, 600, seed=1)
+            hosts = gandalf.parse_csv(csvpath)
+
+        self.assertEqual(len(hosts), 600)
+        self.assertEqual(len({host["ip"] for host in hosts}), 600)
+        self.assertEqual(len({host["hostname"] for host in hosts}), 600)
+        self.assertEqual(hosts[0]["ip"], "192.168.0.1")
+        self.assertEqual(hosts[599]["ip"], "10.0.1.100")
+        self.assertEqual(list(benchmark.generate_hosts(50, seed=1)),
+                         list(benchmark.generate_hosts(50, seed=1)))
+        db = gandalf.HostDB(hosts)
+        self.assertEqual(len(db.search(gandalf.HostQuery().ip.in_subnet("192.168.0.0/24"))), 250)
+        self.assertTrue(db.search(gandalf.HostQuery().vlan == 1010))
+        gandalf.ViewSet.dhcp([host for host in hosts if host["mac"]])
+        gandalf.ViewSet.rdns(hosts[:250])
+
+
+    def test_measure(self):
+        '''
+            Test measure and compare_results functions.
+        '''
+        result = benchmark.measure(lambda: [0] * 100000, repeat=2)
+        self.assertGreater(result["peak_memory"], 100000 * 8)
+        self.assertGreaterEqual(result["wall"], 0)
+        self.assertIsNone(benchmark.measure(lambda: None, memory=False)["peak_memory"])
+
+        old = [{"stage": "parse_csv", "hosts": 10, "wall": 1.0, "peak_memory": 100},
+               {"stage": "main", "hosts": 10, "wall": 1.0, "peak_memory": 100}]
+        new = [{"stage": "parse_csv", "hosts": 10, "wall": 1.1, "peak_memory": 200},
+               {"stage": "main", "hosts": 10, "wall": 2.0, "peak_memory": None},
+               {"stage": "main", "hosts": 20, "wall": 5.0, "peak_memory": None}]
+        self.assertEqual(benchmark.compare_results(old, new, 1.25), [
+            ("parse_csv", 10, "peak_memory", 100, 200),
+            ("main", 10, "wall", 1.0, 2.0)
+        ])
+
+
 class TestTopLevelFunctions(unittest.TestCase):
     '''
         A set of tests for top level functions.
@@ -185,15 +1334,16 @@ class TestTopLevelFunctions(unittest.TestCase):
         '''
             Test parse_csv function.
         '''
-        # Shortcut for readlines mock
-        readlines_mock = open_mock().__enter__().readlines
+        # Shortcut for file lines mock
+        file_mock = open_mock().__enter__()
         open_mock.reset_mock()
+        def set_lines(lines):
+            file_mock.__iter__.side_effect = lambda: iter(lines)
 
         # Test that it tried to open the file
-        readlines_mock.return_value = ["foo,bar,mew"]
+        set_lines(["foo,bar,mew"])
         DictReader_mock.return_value = []
         self.assertEqual(gandalf.parse_csv("foobar_file"), [])
-        self.assertTrue(readlines_mock.called)
         open_mock.assert_called_once_with("foobar_file", "r")
 
         # Test column name transform
@@ -262,18 +1412,25 @@ class TestTopLevelFunctions(unittest.TestCase):
             {"hostname": "foo{}".format(i), "gandalf_ignore": ""} for i in range(3)
         ])
 
+        # Test that the file is read lazily and row numbers are kept
+        DictReader_mock.side_effect = lambda lines: iter([{"ip": "10.0.0.1"}, {"ip": "bad"}])
+        rows = gandalf.iter_csv("file")
+        self.assertEqual(next(rows), {"ip": "10.0.0.1"})
+        with self.assertRaisesRegex(gandalf.CsvIntegrityError, "row 3"):
+            next(rows)
+        DictReader_mock.side_effect = None
+
         # Test comments stripping
-        readlines_mock.return_value = [
+        set_lines([
             "foo,bar,mew",
             "# first easy comment",
             "  # second one with some preceeding spaces",
             "\"#quoted string comment, contains commas\"",
             "  \t\"\t # quoted string, some spaces and tabs preceeding\"",
             "1,2,3"
-        ]
-        DictReader_mock.reset_mock()
-        gandalf.parse_csv("file")
-        DictReader_mock.assert_called_once_with(["foo,bar,mew", "1,2,3"])
+        ])
+        DictReader_mock.side_effect = lambda lines: iter([{"line": l} for l in lines])
+        self.assertEqual(gandalf.parse_csv("file"), [{"line": "foo,bar,mew"}, {"line": "1,2,3"}])
 
 
     @mock.patch('gandalf.os.path.isdir')
@@ -331,6 +1488,74 @@ class TestTopLevelFunctions(unittest.TestCase):
             expected_output)
 
 
+    @mock.patch('gandalf.logging')
+    def test_fan_out_templates(self, logging_mock):
+        '''
+            Test that fan-out templates are rendered once per group of hosts.
+        '''
+        self.assertEqual(gandalf.fan_out_path("out/vlan-{}.conf.mako", "10"), "out/vlan-10.conf")
+        self.assertEqual(gandalf.fan_out_path("out/zone", "10.0.0.0"), "out/zone.10.0.0.0")
+        self.assertEqual(gandalf.fan_out_path("{}/zone", "10"), "{}/zone.10")
+
+        hosts = [
+            {"hostname": "foo", "vlan": 10, "domain": "a.com", "ip": "10.0.0.1"},
+            {"hostname": "bar", "vlan": 20, "domain": "a.com", "ip": "10.0.1.1"},
+            {"hostname": "mew", "vlan": 10, "domain": "a.com", "ip": "10.0.1.2"},
+            {"hostname": "baz", "vlan": "", "domain": "a.com", "ip": "10.0.1.3"},
+            {"hostname": "../x", "vlan": 20, "domain": "a.com", "ip": "10.0.2.1"}
+        ]
+        db = gandalf.HostDB(hosts)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            templates = {
+                "plain": "${ len(db) } ${ GROUP }",
+                "vlan-{}.mako": "## fan-out: vlan\n${ GROUP }: ${ view.hosts(db.all()) }",
+                "net": "  ##fan-out:ip/24  \n${ GROUP } ${ len(db) }",
+                "name": "## fan-out: hostname\n",
+                "invalid": "## fan-out: ip/33\n"
+            }
+            for name, text in templates.items():
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write(text)
+            self.assertEqual(gandalf.read_fan_out_key(os.path.join(tmpdir, "plain")), None)
+            self.assertEqual(gandalf.read_fan_out_key(os.path.join(tmpdir, "net")), "ip/24")
+            self.assertRaises(ValueError, gandalf.read_fan_out_key, os.path.join(tmpdir, "invalid"))
+            self.assertRaises(IOError, gandalf.read_fan_out_key, os.path.join(tmpdir, "missing"))
+
+            tasks = gandalf.fan_out_templates(
+                [(os.path.join(tmpdir, name), os.path.join("out", name), "\000")
+                 for name in sorted(templates)] + [("missing", "out/missing", "\000")], db)
+            self.assertEqual([task[1:] for task in tasks], [
+                ("out/name.bar", "\000.bar", ("hostname", "bar")),
+                ("out/name.baz", "\000.baz", ("hostname", "baz")),
+                ("out/name.foo", "\000.foo", ("hostname", "foo")),
+                ("out/name.mew", "\000.mew", ("hostname", "mew")),
+                ("out/net.10.0.0.0", "\000.10.0.0.0", ("ip/24", "10.0.0.0")),
+                ("out/net.10.0.1.0", "\000.10.0.1.0", ("ip/24", "10.0.1.0")),
+                ("out/net.10.0.2.0", "\000.10.0.2.0", ("ip/24", "10.0.2.0")),
+                ("out/plain", "\000"),
+                ("out/vlan-10", "\000.10", ("vlan", "10")),
+                ("out/vlan-20", "\000.20", ("vlan", "20")),
+                ("out/missing", "\000")
+            ])
+            self.assertEqual(logging_mock.error.call_count, 2)
+            self.assertIn("ip/33", logging_mock.error.call_args_list[0][0][0])
+            self.assertIn("'../x'", logging_mock.error.call_args_list[1][0][0])
+
+            # Render fan-out templates
+            outdir = os.path.join(tmpdir, "out")
+            tasks = [(infile, os.path.join(tmpdir, outfile), dnsfile, *group)
+                     for infile, outfile, dnsfile, *group in tasks[4:-1]]
+            entries = gandalf.render_serial(tasks, db, {})
+            self.assertEqual(len(entries), 6)
+            self.assertEqual(sorted(os.listdir(outdir)), ["net.10.0.0.0", "net.10.0.1.0",
+                             "net.10.0.2.0", "plain", "vlan-10", "vlan-20"])
+            expected = {"net.10.0.1.0": "10.0.1.0 3", "plain": "5 None",
+                        "vlan-10": "10: " + gandalf.ViewSet.hosts([hosts[0], hosts[2]])}
+            for name, text in expected.items():
+                with open(os.path.join(outdir, name)) as f:
+                    self.assertEqual(f.read(), text)
+
+
     @mock.patch('gandalf.open')
     @mock.patch('gandalf.dns_changed')
     @mock.patch('gandalf.parse_dns_version')
@@ -387,6 +1612,28 @@ class TestTopLevelFunctions(unittest.TestCase):
         self.assertEqual(gandalf.apply_dns_version_hack(dns_contents, "oldfile"),
             "foobar\n2017010100\nbarfoo")
 
+        # Test case when zone state has no digest yet: old file is used
+        open_mock.side_effect = None
+        dns_version_mock.return_value = 2016123100
+        zone_state = {}
+        self.assertEqual(gandalf.apply_dns_version_hack(dns_contents, "oldfile", zone_state),
+            "foobar\n2016123100\nbarfoo")
+        self.assertEqual(zone_state, {"serial": 2016123100,
+                                      "digest": gandalf.dns_digest(dns_contents)})
+
+        # Test case when zone state is known: old file is not read
+        open_mock.reset_mock()
+        dns_changed_mock.reset_mock()
+        self.assertEqual(gandalf.apply_dns_version_hack(dns_contents, "oldfile", zone_state),
+            "foobar\n2016123100\nbarfoo")
+        changed_contents = "foobar\n" + gandalf.DNS_HACK_ANCHOR + "\nbarfoo2"
+        self.assertEqual(gandalf.apply_dns_version_hack(changed_contents, "oldfile", zone_state),
+            "foobar\n2017010100\nbarfoo2")
+        self.assertEqual(zone_state, {"serial": 2017010100,
+                                      "digest": gandalf.dns_digest(changed_contents)})
+        self.assertFalse(open_mock.called)
+        self.assertFalse(dns_changed_mock.called)
+
 
     def test_dns_changed(self):
         '''
@@ -408,6 +1655,145 @@ class TestTopLevelFunctions(unittest.TestCase):
         self.assertTrue(gandalf.dns_changed("my_dns_config", "other_dns_config"))
 
 
+    def test_dns_state(self):
+        '''
+            Test DnsState class.
+        '''
+        # Digests do not depend on whitespace, comments and version line
+        self.assertEqual(gandalf.dns_digest("a  IN A 1.2.3.4 ; comment\n\n"),
+                         gandalf.dns_digest("a IN A 1.2.3.4\n5 " + gandalf.DNS_HACK_COMMENT))
+        self.assertNotEqual(gandalf.dns_digest("a IN A 1.2.3.4"), gandalf.dns_digest("a IN A 1.2.3.5"))
+
+        # Digest of lines is the same as digest of text
+        for text in ["", "a IN A 1.2.3.4", "\n a  IN A 1.2.3.4 ;x\n\nb IN A 1.2.3.5\n;y\n"]:
+            self.assertEqual(gandalf.dns_lines_digest(text.splitlines(True)), gandalf.dns_digest(text))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(tmpdir + "/zone", "w") as f:
+                f.write("a IN A 1.2.3.4\n 2017010100 {0}\n 1 {0}\nb IN A 1.2.3.5\n"
+                        .format(gandalf.DNS_HACK_COMMENT))
+            self.assertEqual(gandalf.read_dns_file(tmpdir + "/zone"),
+                             (2017010100, gandalf.dns_digest("a IN A 1.2.3.4\nb IN A 1.2.3.5")))
+            with open(tmpdir + "/zone", "w") as f:
+                f.write("a IN A 1.2.3.4\n")
+            self.assertEqual(gandalf.read_dns_file(tmpdir + "/zone")[0], 0)
+            self.assertRaises(IOError, gandalf.read_dns_file, tmpdir + "/missing")
+
+        # Missing file is an empty state
+        with mock.patch('gandalf.open', side_effect=FileNotFoundError()):
+            self.assertEqual(gandalf.DnsState.load("state.json").zones, {})
+        with mock.patch('gandalf.open', side_effect=PermissionError()):
+            self.assertRaises(IOError, gandalf.DnsState.load, "state.json")
+        for contents in ["[]", '{"version": 100, "zones": {}}', '{"version": 1}', "{"]:
+            with mock.patch('gandalf.open', mock.mock_open(read_data=contents)):
+                self.assertRaises(ValueError, gandalf.DnsState.load, "state.json")
+
+        # Save and load
+        state = gandalf.DnsState({"out/zone": {"serial": 2017010100, "digest": "abc"}})
+        self.assertEqual(state.get("out/zone"), {"serial": 2017010100, "digest": "abc"})
+        state.get("out/zone")["serial"] = 1
+        self.assertEqual(state.get("out/zone")["serial"], 2017010100)
+        self.assertEqual(state.get("out/other"), {})
+        with mock.patch('gandalf.write_file_atomic') as write_mock:
+            state.save("state.json")
+            self.assertEqual(write_mock.call_args[0][0], "state.json")
+            written = write_mock.call_args[0][1].decode("utf8")
+        with mock.patch('gandalf.open', mock.mock_open(read_data=written)):
+            self.assertEqual(gandalf.DnsState.load("state.json").zones, state.zones)
+
+
+    def test_nsupdate(self):
+        '''
+            Test parsing zone files and making nsupdate scripts of their changes.
+        '''
+        self.assertEqual(gandalf.parse_ttl("3600"), 3600)
+        self.assertEqual(gandalf.parse_ttl("01h07m01s"), 4021)
+        self.assertEqual(gandalf.parse_ttl("1W2D"), 777600)
+        for text in ["", "h", "1x", "1h 2m", "-1"]:
+            self.assertRaises(ValueError, gandalf.parse_ttl, text)
+
+        zone = [
+            "$TTL 1h",
+            "$ORIGIN Example.com.",
+            "@ IN SOA ns admin.example.com. (",
+            "    2017010100 " + gandalf.DNS_HACK_COMMENT,
+            "    1h 15m 30d 1h )",
+            "    48h IN NS ns ; primary",
+            "www 60 IN A 10.0.0.1",
+            "    IN 120 A 10.0.0.2",
+            "ftp IN CNAME www",
+            'txt IN TXT "a ; b" ( "c" )',
+            "1.0 IN PTR host.other.com."
+        ]
+        self.assertEqual(gandalf.parse_zone(zone), ("example.com.", {
+            ("example.com.", 3600, "IN", "SOA",
+                "ns.example.com. admin.example.com. 2017010100 3600 900 2592000 3600"),
+            ("example.com.", 172800, "IN", "NS", "ns.example.com."),
+            ("www.example.com.", 60, "IN", "A", "10.0.0.1"),
+            ("www.example.com.", 120, "IN", "A", "10.0.0.2"),
+            ("ftp.example.com.", 3600, "IN", "CNAME", "www.example.com."),
+            ("txt.example.com.", 3600, "IN", "TXT", '"a ; b" "c"'),
+            ("1.0.example.com.", 3600, "IN", "PTR", "host.other.com.")}))
+        for lines in [zone[2:], zone[:5] + ["$INCLUDE other"], zone[:2] + zone[5:],
+                      zone[:3], zone + ["a IN A ) 1.2.3.4"], zone + ["a IN"],
+                      zone + ["@ IN SOA a. b. 1 2 3 4 5"], ["a. IN SOA b. c. 1 2 3 4 5"]]:
+            self.assertRaises(ValueError, gandalf.parse_zone, lines)
+
+        # Only changed records get into the script, changed SOA is added only
+        self.assertEqual(gandalf.nsupdate_script(zone, zone), None)
+        new_zone = [line.replace("2017010100", "2017010101").replace("10.0.0.2", "10.0.0.3")
+                    for line in zone if "ftp" not in line] + ["mail IN MX 10 mx"]
+        self.assertEqual(gandalf.nsupdate_script(zone, new_zone),
+            "; changes of zone example.com.: records deleted: 2, added: 3\n"
+            "zone example.com.\n"
+            "update delete ftp.example.com. IN CNAME www.example.com.\n"
+            "update delete www.example.com. IN A 10.0.0.2\n"
+            "update add example.com. 3600 IN SOA ns.example.com. admin.example.com. "
+                "2017010101 3600 900 2592000 3600\n"
+            "update add mail.example.com. 3600 IN MX 10 mx.example.com.\n"
+            "update add www.example.com. 120 IN A 10.0.0.3\n"
+            "send\n")
+        self.assertRaises(ValueError, gandalf.nsupdate_script, zone,
+                          [line.replace("Example.com.", "example.org.") for line in zone])
+        self.assertEqual(gandalf.nsupdate_path("out/dns/zone", "out", "up"), "up/dns/zone.nsupdate")
+        self.assertEqual(gandalf.nsupdate_path("out/zone", "out/zone.mako", "up"), "up/zone.nsupdate")
+
+        # Rendered zones are compared with the old DNS files
+        template = ("$TTL 1h\n$ORIGIN example.com.\n@ IN SOA ns admin (\n${ get_dns_version() }\n"
+                    "1h 15m 30d 1h )\n${ view.dns(db.all()) }\n")
+        hosts = [{"hostname": "foo", "ip": "10.0.0.1"}, {"hostname": "bar", "ip": "10.0.0.2"}]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(tmpdir + "/zone.mako", "w") as f:
+                f.write(template)
+            gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/old/zone.mako", "\000",
+                                    gandalf.HostDB(hosts), {})
+            hosts[1]["ip"] = "10.0.0.3"
+            for stream in (False, True):
+                entry = gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/new/zone.mako",
+                                                tmpdir + "/old/zone", gandalf.HostDB(hosts), {},
+                                                stream=stream, nsupdate=(tmpdir + "/new", tmpdir + "/up"))
+                self.assertTrue(entry["changed"])
+                with open(tmpdir + "/up/zone.nsupdate") as f:
+                    script = f.read()
+                self.assertIn("\nupdate delete bar.example.com. IN A 10.0.0.2\n", script)
+                self.assertIn("\nupdate add bar.example.com. 3600 IN A 10.0.0.3\n", script)
+                self.assertEqual(script.count("update"), 3)
+                os.remove(tmpdir + "/new/zone")
+
+            # Script is removed if zone has not changed or can not be compared
+            with open(tmpdir + "/bad", "w") as f:
+                f.write("a IN A (\n")
+            with mock.patch('gandalf.logging') as logging_mock:
+                for old_zone, written, error in [("old/zone", True, False), ("new/zone", False, False),
+                                                 ("missing", False, False), ("bad", False, True)]:
+                    with open(tmpdir + "/up/zone.nsupdate", "w") as f:
+                        f.write("stale")
+                    gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/new/zone.mako",
+                                            tmpdir + "/" + old_zone, gandalf.HostDB(hosts[:1]), {},
+                                            nsupdate=(tmpdir + "/new", tmpdir + "/up"))
+                    self.assertEqual(os.path.exists(tmpdir + "/up/zone.nsupdate"), written)
+                    self.assertEqual(logging_mock.error.called, error)
+
+
     def test_parse_dns_version(self):
         '''
             Test parse_dns_version function.
@@ -434,25 +1820,24 @@ class TestTopLevelFunctions(unittest.TestCase):
     @mock.patch('gandalf.open')
     @mock.patch('gandalf.logging')
     @mock.patch('gandalf.sys.exit')
-    @mock.patch('gandalf.parse_csv')
-    @mock.patch('gandalf.yaml.load')
+    @mock.patch('gandalf.load_hosts')
+    @mock.patch('gandalf.yaml.safe_load')
     @mock.patch('gandalf.os.makedirs')
-    @mock.patch('gandalf.tinydb.TinyDB')
     @mock.patch('gandalf.find_templates')
     @mock.patch('gandalf.apply_dns_version_hack')
     @mock.patch('gandalf.mako.template.Template')
     @mock.patch('gandalf.argparse.ArgumentParser')
     def test_main(self, ArgumentParser_mock, Template_mock, apply_dns_version_hack_mock,
-                  find_templates_mock, TinyDB_mock, makedirs_mock, yaml_load_mock,
-                  parse_csv_mock, exit_mock, logging_mock, open_mock):
+                  find_templates_mock, makedirs_mock, yaml_safe_load_mock,
+                  load_hosts_mock, exit_mock, logging_mock, open_mock):
         '''
             Test main function.
         '''
         # Shortcut for resetting all mocks
         def reset_all_mocks():
             for mock in [ArgumentParser_mock, Template_mock, apply_dns_version_hack_mock,
-                         find_templates_mock, TinyDB_mock, makedirs_mock, yaml_load_mock,
-                         parse_csv_mock, exit_mock, logging_mock, open_mock]:
+                         find_templates_mock, makedirs_mock, yaml_safe_load_mock,
+                         load_hosts_mock, exit_mock, logging_mock, open_mock]:
                 mock.reset_mock()
 
         # Shortcut for checking error exit
@@ -463,6 +1848,21 @@ class TestTopLevelFunctions(unittest.TestCase):
 
         # Shortcut for command-line arguments mock
         args_mock = ArgumentParser_mock().parse_args()
+        args_mock.jobs = 1
+        args_mock.io_threads = 0
+        args_mock.cache_dir = None
+        args_mock.incremental = None
+        args_mock.compact = False
+        args_mock.dns_state = None
+        args_mock.changes = None
+        args_mock.watch = False
+        args_mock.profile = None
+        args_mock.stream = False
+        args_mock.nsupdate = None
+        args_mock.memoize = False
+        args_mock.sqlite = None
+        args_mock.shard = None
+        args_mock.line_cache = 0
         ArgumentParser_mock.reset_mock()
 
         # Test run
@@ -470,15 +1870,16 @@ class TestTopLevelFunctions(unittest.TestCase):
         exit_mock.assert_called_once_with(0)
         reset_all_mocks()
 
-        # parse_csv throws exception
-        args_mock.csvfile = "file.csv"
+        # load_hosts throws exception
+        args_mock.csvfile = ["file.csv", "csvdir"]
         for Exc in [IOError, csv.Error, gandalf.CsvIntegrityError]:
-            parse_csv_mock.side_effect = Exc()
+            load_hosts_mock.side_effect = Exc()
             gandalf.main()
-            parse_csv_mock.assert_called_once_with("file.csv")
+            load_hosts_mock.assert_called_once_with(["file.csv", "csvdir"], False, None, 1,
+                                                    sqlite=None, derived={})
             assert_error_exit()
             reset_all_mocks()
-        parse_csv_mock.side_effect = None
+        load_hosts_mock.side_effect = None
 
         # open() on args.var throws exception
         args_mock.var = "varfile.yaml"
@@ -489,12 +1890,20 @@ class TestTopLevelFunctions(unittest.TestCase):
         reset_all_mocks()
         open_mock.side_effect = None
 
-        # yaml.load throws exception
-        yaml_load_mock.side_effect = yaml.error.YAMLError()
+        # yaml.safe_load throws exception
+        yaml_safe_load_mock.side_effect = yaml.error.YAMLError()
+        gandalf.main()
+        assert_error_exit()
+        reset_all_mocks()
+        yaml_safe_load_mock.side_effect = None
+
+        # Variables file declares invalid derived columns
+        yaml_safe_load_mock.return_value = {"gandalf_derived_columns": "fqdn"}
         gandalf.main()
         assert_error_exit()
+        self.assertFalse(load_hosts_mock.called)
         reset_all_mocks()
-        yaml_load_mock.side_effect = None
+        yaml_safe_load_mock.return_value = mock.DEFAULT
 
         # mako.template.Template throws exception
         find_templates_mock.return_value = [("templates/infile.mako", "rendered/outfile.mako", "dns/dnsfile.mako")]
@@ -517,7 +1926,8 @@ class TestTopLevelFunctions(unittest.TestCase):
         # Test that DNS version hack is applied
         Template_mock().render_unicode.return_value = gandalf.DNS_HACK_ANCHOR
         gandalf.main()
-        apply_dns_version_hack_mock.assert_called_once_with(gandalf.DNS_HACK_ANCHOR, "dns/dnsfile")
+        apply_dns_version_hack_mock.assert_called_once_with(gandalf.DNS_HACK_ANCHOR, "dns/dnsfile",
+                                                            read=gandalf.read_text)
         reset_all_mocks()
 
         # Test that os.makedirs is called if neccesary
@@ -530,16 +1940,965 @@ class TestTopLevelFunctions(unittest.TestCase):
         makedirs_mock.side_effect = None
 
         # Writing rendered file throws IOError
-        write_mock = open_mock().__enter__().write
-        open_mock.reset_mock()
-        write_mock.side_effect = IOError()
-        Template_mock().render_unicode.return_value = "rendered_template"
+        with mock.patch('gandalf.write_output') as write_output_mock:
+            write_output_mock.side_effect = IOError()
+            Template_mock().render_unicode.return_value = "rendered_template"
+            gandalf.main()
+            write_output_mock.assert_called_once_with("rendered/outfile", "rendered_template")
+            self.assertTrue(logging_mock.error.called)
+            exit_mock.assert_called_once_with(0)
+            reset_all_mocks()
+
+        # Test that templates are handed over to render_parallel if jobs > 1
+        args_mock.jobs = 4
+        with mock.patch('gandalf.render_parallel') as render_parallel_mock:
+            gandalf.main()
+            load_hosts_mock.assert_called_once_with(["file.csv", "csvdir"], False, None, 4,
+                                                    sqlite=None, derived={})
+            render_parallel_mock.assert_called_once_with(find_templates_mock.return_value,
+                    load_hosts_mock(), {}, 4, cache_dir=None, incremental=None, dns_state=None)
+        self.assertFalse(Template_mock.called)
+        exit_mock.assert_called_once_with(0)
+        reset_all_mocks()
+
+        # Test that non-positive number of jobs is rejected
+        args_mock.jobs = 0
         gandalf.main()
-        open_mock.assert_called_once_with("rendered/outfile", "w", encoding="utf8")
-        write_mock.assert_called_once_with("rendered_template")
+        self.assertTrue(ArgumentParser_mock().error.called)
+        reset_all_mocks()
+        args_mock.jobs = 1
+
+        # Test that negative number of I/O threads is rejected
+        args_mock.io_threads = -1
+        with mock.patch('gandalf.render_all'):
+            gandalf.main()
+        self.assertTrue(ArgumentParser_mock().error.called)
+        reset_all_mocks()
+        args_mock.io_threads = 0
+
+        # Test that watch mode keeps state of the first run
+        args_mock.watch = True
+        args_mock.watch_interval = 1.0
+        with mock.patch('gandalf.watch') as watch_mock, \
+             mock.patch('gandalf.render_all') as render_all_mock:
+            gandalf.main()
+            self.assertEqual(render_all_mock.call_args[0][1:-1], watch_mock.call_args[0][1:])
+            self.assertIsNone(render_all_mock.call_args[0][-1])
+            db, var, incremental, dns_state, compiled = watch_mock.call_args[0][1:]
+            self.assertEqual(var, {})
+            self.assertIsInstance(incremental, gandalf.IncrementalState)
+            self.assertEqual(compiled, {})
         exit_mock.assert_called_once_with(0)
         reset_all_mocks()
-        write_mock.side_effect = None
+
+        # Test that the run is profiled if requested
+        args_mock.watch = False
+        args_mock.profile = "profile.json"
+        with mock.patch('gandalf.render_all') as render_all_mock:
+            gandalf.main()
+            self.assertIsInstance(render_all_mock.call_args[0][-1], gandalf.Profile)
+            self.assertIn("load_hosts", render_all_mock.call_args[0][-1].stages)
+        reset_all_mocks()
+        args_mock.profile = None
+        args_mock.watch = True
+
+        # Test that non-positive watch interval is rejected
+        args_mock.watch_interval = 0
+        with mock.patch('gandalf.watch'), mock.patch('gandalf.render_all'):
+            gandalf.main()
+        self.assertTrue(ArgumentParser_mock().error.called)
+        reset_all_mocks()
+        args_mock.watch = False
+        args_mock.profile = None
+
+        # Test that SQLite database can not be compact
+        args_mock.sqlite = "hosts.db"
+        args_mock.compact = True
+        with mock.patch('gandalf.render_all'):
+            gandalf.main()
+        ArgumentParser_mock().error.assert_called_once_with("--compact can not be used with --sqlite")
+        reset_all_mocks()
+        args_mock.sqlite = None
+        args_mock.compact = False
+
+        # Test that shard requires a manifest
+        args_mock.shard = (1, 2)
+        args_mock.shard_manifest = None
+        with mock.patch('gandalf.render_all'):
+            gandalf.main()
+        ArgumentParser_mock().error.assert_called_once_with("--shard requires --shard-manifest")
+        reset_all_mocks()
+        args_mock.shard = None
+
+        # Test that line cache requires cache directory
+        args_mock.line_cache = 16
+        with mock.patch('gandalf.render_all'):
+            gandalf.main()
+        ArgumentParser_mock().error.assert_called_once_with(
+            "--line-cache requires cache directory (-c)")
+        reset_all_mocks()
+        args_mock.line_cache = 0
+
+        # Test that merge-shards command is dispatched
+        with mock.patch('gandalf.merge_shards_main') as merge_shards_main_mock, \
+                mock.patch('gandalf.sys.argv', ["gandalf", "merge-shards", "1.json"]):
+            gandalf.main()
+        merge_shards_main_mock.assert_called_once_with(["1.json"])
+        self.assertFalse(ArgumentParser_mock.called)
+
+        # Test that nsupdate scripts require old DNS files
+        args_mock.nsupdate = "nsupdate"
+        args_mock.dnsdir = "\000"
+        with mock.patch('gandalf.render_all'):
+            gandalf.main()
+        ArgumentParser_mock().error.assert_called_once_with(
+            "--nsupdate requires directory with the old DNS files (-d)")
+        reset_all_mocks()
+        args_mock.nsupdate = None
+
+
+    def test_load_var(self):
+        '''
+            Test load_var function on real YAML files.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            varpath = tmpdir + "/var.yaml"
+            with open(varpath, "w") as f:
+                f.write("router: 10.0.0.1\nvlans: [10, 20]\nzone:\n  ttl: 3600\n")
+            expected = {"router": "10.0.0.1", "vlans": [10, 20], "zone": {"ttl": 3600}}
+            self.assertEqual(gandalf.load_var(varpath), expected)
+            for _ in range(2):
+                self.assertEqual(gandalf.load_var(varpath, tmpdir + "/cache"), expected)
+
+            # Arbitrary Python objects are not constructed
+            with open(varpath, "w") as f:
+                f.write("a: !!python/object/apply:os.getcwd []\n")
+            self.assertRaises(yaml.error.YAMLError, gandalf.load_var, varpath)
+
+
+    def test_load_snapshot(self):
+        '''
+            Test load_snapshot function.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcpath, cache_dir = tmpdir + "/hosts.csv", tmpdir + "/cache"
+            with open(srcpath, "w") as f:
+                f.write("first")
+            build_mock = mock.MagicMock(side_effect=lambda path: {"built": open(path).read()})
+
+            # Snapshot is made once and then loaded
+            for _ in range(2):
+                self.assertEqual(gandalf.load_snapshot(cache_dir, "hosts", srcpath, build_mock, [True]),
+                                 {"built": "first"})
+            build_mock.assert_called_once_with(srcpath)
+            snapshots = gandalf.os.listdir(cache_dir)
+            self.assertEqual(len(snapshots), 1)
+
+            # Different options make another snapshot
+            gandalf.load_snapshot(cache_dir, "hosts", srcpath, build_mock, [False])
+            self.assertEqual(build_mock.call_count, 2)
+            self.assertEqual(len(gandalf.os.listdir(cache_dir)), 2)
+
+            # New contents replace old snapshot
+            with open(srcpath, "w") as f:
+                f.write("second")
+            self.assertEqual(gandalf.load_snapshot(cache_dir, "hosts", srcpath, build_mock, [True]),
+                             {"built": "second"})
+            self.assertEqual(build_mock.call_count, 3)
+            self.assertEqual(len(gandalf.os.listdir(cache_dir)), 2)
+            self.assertNotIn(snapshots[0], gandalf.os.listdir(cache_dir))
+
+            # Broken snapshot is ignored and made again
+            for snapshot in gandalf.os.listdir(cache_dir):
+                with open(cache_dir + "/" + snapshot, "wb") as f:
+                    f.write(b"garbage")
+            with mock.patch('gandalf.logging') as logging_mock:
+                self.assertEqual(gandalf.load_snapshot(cache_dir, "hosts", srcpath, build_mock, [True]),
+                                 {"built": "second"})
+                self.assertTrue(logging_mock.warning.called)
+            self.assertEqual(gandalf.load_snapshot(cache_dir, "hosts", srcpath, build_mock, [True]),
+                             {"built": "second"})
+            self.assertEqual(build_mock.call_count, 4)
+
+            # Objects that can not be pickled are not saved
+            with mock.patch('gandalf.logging') as logging_mock:
+                result = gandalf.load_snapshot(cache_dir, "var", srcpath, lambda path: lambda: 1)
+                self.assertTrue(logging_mock.warning.called)
+            self.assertTrue(callable(result))
+            self.assertFalse([name for name in gandalf.os.listdir(cache_dir) if name.startswith("var-")])
+
+            # Snapshot is not saved if source changes while building
+            def build_and_change(path):
+                with open(path, "w") as f:
+                    f.write("third")
+                return "changing"
+            self.assertEqual(gandalf.load_snapshot(cache_dir, "var", srcpath, build_and_change), "changing")
+            self.assertFalse([name for name in gandalf.os.listdir(cache_dir) if name.startswith("var-")])
+
+            # Unreadable source file
+            self.assertRaises(IOError, gandalf.load_snapshot, cache_dir, "hosts",
+                              tmpdir + "/missing.csv", build_mock)
+
+
+    def test_load_hosts_snapshot(self):
+        '''
+            Test that hosts loaded from snapshot are the same as parsed ones.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            benchmark.write_csv(tmpdir + "/hosts.csv", 300)
+            for compact in (False, True):
+                expected = gandalf.load_hosts(tmpdir + "/hosts.csv", compact)
+                for _ in range(2):
+                    db = gandalf.load_hosts(tmpdir + "/hosts.csv", compact, tmpdir + "/cache")
+                    self.assertEqual(db.all(), expected.all())
+                    self.assertEqual(db.search(gandalf.HostQuery().vlan == 1010),
+                                     expected.search(gandalf.HostQuery().vlan == 1010))
+                with mock.patch('gandalf.iter_csv') as iter_csv_mock:
+                    gandalf.load_hosts(tmpdir + "/hosts.csv", compact, tmpdir + "/cache")
+                    self.assertFalse(iter_csv_mock.called)
+
+
+    def test_load_hosts_sqlite(self):
+        '''
+            Test that hosts are kept in SQLite database that is built only once.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            benchmark.write_csv(tmpdir + "/hosts.csv", 300)
+            expected = gandalf.load_hosts(tmpdir + "/hosts.csv")
+            db = gandalf.load_hosts(tmpdir + "/hosts.csv", sqlite=tmpdir + "/hosts.db")
+            self.assertIsInstance(db, gandalf.SqliteHostDB)
+            self.assertEqual(db.all(), expected.all())
+            self.assertEqual(db.source(2), (tmpdir + "/hosts.csv", 3))
+            with mock.patch('gandalf.iter_csv_rows') as iter_csv_rows_mock:
+                db = gandalf.load_hosts(tmpdir + "/hosts.csv", sqlite=tmpdir + "/hosts.db")
+                self.assertFalse(iter_csv_rows_mock.called)
+            self.assertEqual(db.search(gandalf.HostQuery().vlan == 1010),
+                             expected.search(gandalf.HostQuery().vlan == 1010))
+
+            # Database is built again when CSV file changes
+            benchmark.write_csv(tmpdir + "/hosts.csv", 200)
+            self.assertEqual(len(gandalf.load_hosts(tmpdir + "/hosts.csv",
+                                                    sqlite=tmpdir + "/hosts.db")), 200)
+
+
+    def test_derived_columns(self):
+        '''
+            Test declaration of derived columns in variables file.
+        '''
+        builtin = gandalf.BUILTIN_DERIVED_COLUMNS
+        self.assertEqual(gandalf.derived_columns({}), {})
+        self.assertEqual(gandalf.derived_columns({"gandalf_derived_columns": ["fqdn", "net24"]}),
+                         {"fqdn": builtin["fqdn"], "net24": builtin["net24"]})
+        self.assertEqual(gandalf.derived_columns({"gandalf_derived_columns": {
+            "ip_int": None, "mgmt": "hostname + '-mgmt'"}}),
+            {"ip_int": builtin["ip_int"], "mgmt": "hostname + '-mgmt'"})
+        for declared in ["fqdn", {"unknown": None}, {"not a name": "ip"}, {"mgmt": 1},
+                         {"mgmt": "hostname +"}]:
+            with self.assertRaises(ValueError):
+                gandalf.derived_columns({"gandalf_derived_columns": declared})
+
+
+    def test_load_hosts_derived(self):
+        '''
+            Test that derived columns are computed once when hosts are loaded
+            and are queried and indexed like the other columns.
+        '''
+        derived = gandalf.derived_columns({"gandalf_derived_columns": dict(
+            {name: None for name in gandalf.BUILTIN_DERIVED_COLUMNS},
+            mgmt="hostname + '-mgmt.' + domain")})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            benchmark.write_csv(tmpdir + "/hosts.csv", 300)
+            plain = gandalf.load_hosts(tmpdir + "/hosts.csv")
+            expected = []
+            for host in plain:
+                ip = gandalf.ip_to_int(host["ip"])
+                expected.append(dict(host, fqdn=host["hostname"] + "." + host["domain"],
+                    ip_int=ip, rdns_label=host["ip"].split(".")[-1],
+                    net24=gandalf.int_to_ip(ip & 0xFFFFFF00) + "/24",
+                    broadcast=gandalf.int_to_ip(ip | ((1 << (32 - host["mask"])) - 1)),
+                    mgmt=host["hostname"] + "-mgmt." + host["domain"]))
+
+            for options in [{}, {"compact": True}, {"cache_dir": tmpdir + "/cache"},
+                            {"sqlite": tmpdir + "/hosts.db"}]:
+                db = gandalf.load_hosts(tmpdir + "/hosts.csv", derived=derived, **options)
+                self.assertEqual(db.all(), expected)
+                fqdn = expected[7]["fqdn"]
+                self.assertEqual(db.search(gandalf.HostQuery().fqdn == fqdn), [expected[7]])
+                if isinstance(db, gandalf.HostDB):
+                    self.assertEqual(db._candidates((("==", ("fqdn",), fqdn))), [7])
+            self.assertEqual(db.all(), expected)
+            self.assertEqual(gandalf.load_hosts(tmpdir + "/hosts.csv", sqlite=tmpdir + "/hosts.db")
+                             .all(), plain.all())
+
+            # Columns that are already in file or can not be computed
+            for declared in [{"ip": "hostname"}, {"bad": "int(hostname)"}]:
+                with self.assertRaises(gandalf.CsvIntegrityError):
+                    gandalf.load_hosts(tmpdir + "/hosts.csv", derived=declared)
+
+
+    def test_main_derived_columns(self):
+        '''
+            Test rendering from command line with derived columns declared
+            in a real variables file.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            benchmark.write_csv(tmpdir + "/hosts.csv", 30)
+            hosts = gandalf.load_hosts(tmpdir + "/hosts.csv").all()
+            with open(tmpdir + "/var.yaml", "w") as f:
+                f.write("suffix: -mgmt\n"
+                        "gandalf_derived_columns:\n"
+                        "  fqdn:\n"
+                        "  mgmt: hostname + '-mgmt.' + domain\n")
+            os.makedirs(tmpdir + "/templates")
+            with open(tmpdir + "/templates/names.mako", "w") as f:
+                f.write('${ var["suffix"] } ${ " ".join(h["mgmt"] for h in '
+                        'db.search(host.fqdn == "%s.%s")) }' % (hosts[7]["hostname"], hosts[7]["domain"]))
+
+            for options in [[], ["--compact"], ["--sqlite", tmpdir + "/hosts.db"],
+                            ["-c", tmpdir + "/cache"]]:
+                with mock.patch('gandalf.sys.argv', ["gandalf", "-v", tmpdir + "/var.yaml"] +
+                                options + [tmpdir + "/hosts.csv", tmpdir + "/templates",
+                                           tmpdir + "/output"]), \
+                        self.assertRaises(SystemExit) as cm:
+                    gandalf.main()
+                self.assertEqual(cm.exception.code, 0)
+                with open(tmpdir + "/output/names") as f:
+                    self.assertEqual(f.read(), "-mgmt {}-mgmt.{}".format(
+                        hosts[7]["hostname"], hosts[7]["domain"]))
+                os.remove(tmpdir + "/output/names")
+
+
+    def test_load_hosts_formats(self):
+        '''
+            Test that JSON Lines and SQLite inventories give the same hosts as CSV.
+        '''
+        hosts = list(benchmark.generate_hosts(300, seed=1))
+        typed = [dict(host, ip=gandalf.ip_to_int(host["ip"]), mask=host["mask"],
+                      vlan=host["vlan"] if host["vlan"] != "" else None) for host in hosts]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            benchmark.write_csv(tmpdir + "/hosts.csv", 300, seed=1)
+            with open(tmpdir + "/hosts.jsonl", "w") as f:
+                for n, host in enumerate(typed):
+                    f.write(gandalf.json.dumps(host if n % 2 else dict(hosts[n])) + "\n\n")
+            conn = gandalf.sqlite3.connect(tmpdir + "/hosts.sqlite")
+            conn.execute("CREATE TABLE hosts ({})".format(", ".join(
+                '"{}" {}'.format(colname, "INTEGER" if colname in ("ip", "mask", "vlan") else "TEXT")
+                for colname in benchmark.COLUMNS)))
+            conn.executemany("INSERT INTO hosts VALUES ({})".format(", ".join(
+                "?" * len(benchmark.COLUMNS))), [[host[colname] for colname in benchmark.COLUMNS]
+                for host in typed])
+            conn.execute("CREATE TABLE other (a)")
+            conn.commit()
+            conn.close()
+
+            expected = gandalf.load_hosts(tmpdir + "/hosts.csv")
+            for path in ["/hosts.jsonl", "/hosts.sqlite"]:
+                for compact in (False, True):
+                    db = gandalf.load_hosts(tmpdir + path, compact)
+                    self.assertEqual(db.all(), expected.all())
+                self.assertEqual(db.source(3), (tmpdir + path, 5 if path == "/hosts.jsonl" else 3))
+            self.assertEqual(gandalf.find_csv_files([tmpdir]), [tmpdir + "/hosts.csv",
+                             tmpdir + "/hosts.jsonl", tmpdir + "/hosts.sqlite"])
+
+            # Invalid files and values
+            for lines, Exc in [(['{"ip": "10.0.0.1"', ], csv.Error), (['[1]'], csv.Error),
+                               (['{"vlan": 4096}'], gandalf.CsvIntegrityError),
+                               (['{"hostname": true}'], gandalf.CsvIntegrityError),
+                               (['{"ip": "010.0.0.1"}'], gandalf.CsvIntegrityError)]:
+                with open(tmpdir + "/bad.jsonl", "w") as f:
+                    f.write("\n".join(lines))
+                self.assertRaises(Exc, gandalf.load_hosts, tmpdir + "/bad.jsonl")
+            with open(tmpdir + "/bad.jsonl", "w") as f:
+                f.write('{"hostname": 5, "vlan": null, "gandalf_ignore": null}\n'
+                        '{"hostname": "a", "gandalf_ignore": 1}')
+            self.assertEqual(list(gandalf.iter_inventory_rows(tmpdir + "/bad.jsonl")),
+                             [(1, {"hostname": "5", "vlan": None, "gandalf_ignore": ""})])
+
+            # Columns of JSON Lines file are the keys of all the objects
+            with open(tmpdir + "/keys.jsonl", "w") as f:
+                f.write('{"ip": "10.0.0.1"}\n{"ip": "10.0.0.2", "vlan": 1}\n{"cluster": "c", "ip": "10.0.0.3"}')
+            self.assertEqual(list(gandalf.iter_inventory_rows(tmpdir + "/keys.jsonl")), [
+                (1, {"ip": "10.0.0.1", "vlan": None, "cluster": ""}),
+                (2, {"ip": "10.0.0.2", "vlan": 1, "cluster": ""}),
+                (3, {"ip": "10.0.0.3", "vlan": None, "cluster": "c"})])
+
+            # Files of different formats and columns are loaded together
+            with open(tmpdir + "/extra.jsonl", "w") as f:
+                f.write('{"hostname": "extra", "domain": "example.com", "ip": "192.0.2.1", '
+                        '"mask": 24, "vlan": 5, "rack": "r1"}')
+            for compact in (False, True):
+                db = gandalf.load_hosts([tmpdir + "/hosts.csv", tmpdir + "/extra.jsonl"], compact)
+                self.assertEqual(len(db), len(expected) + 1)
+                self.assertEqual(db.get(gandalf.HostQuery().rack == "r1")["hostname"], "extra")
+            conn = gandalf.sqlite3.connect(tmpdir + "/bad.sqlite")
+            conn.execute("CREATE TABLE a (b)")
+            conn.execute("CREATE TABLE c (d)")
+            conn.close()
+            self.assertRaises(csv.Error, gandalf.load_hosts, tmpdir + "/bad.sqlite")
+            self.assertRaises(IOError, gandalf.load_hosts, tmpdir + "/missing.sqlite")
+
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_load_hosts_arrow(self):
+        '''
+            Test that Arrow and Parquet inventories give the same hosts as CSV.
+        '''
+        import pyarrow, pyarrow.feather, pyarrow.parquet
+        hosts = [dict(host, mask=int(host["mask"])) for host in benchmark.generate_hosts(300)]
+        table = pyarrow.Table.from_pylist(hosts)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            benchmark.write_csv(tmpdir + "/hosts.csv", 300)
+            pyarrow.feather.write_feather(table, tmpdir + "/hosts.arrow", compression="uncompressed")
+            pyarrow.parquet.write_table(table, tmpdir + "/hosts.parquet")
+            expected = gandalf.load_hosts(tmpdir + "/hosts.csv")
+            for path in ["/hosts.arrow", "/hosts.parquet"]:
+                self.assertEqual(gandalf.load_hosts(tmpdir + path).all(), expected.all())
+
+
+    def test_load_hosts_files(self):
+        '''
+            Test loading hosts from several CSV files and directories.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(tmpdir + "/site/b")
+            hosts = list(benchmark.generate_hosts(30))
+            for path, part in [("/site/b/2.csv", hosts[20:]), ("/site/1.csv", hosts[10:20]),
+                               ("/site/a.CSV", hosts[:10])]:
+                with open(tmpdir + path, "w", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=benchmark.COLUMNS)
+                    writer.writeheader()
+                    writer.writerows(part)
+            with open(tmpdir + "/site/notes.txt", "w") as f:
+                f.write("not a CSV file")
+
+            csvfiles = [tmpdir + "/site/1.csv", tmpdir + "/site/a.CSV", tmpdir + "/site/b/2.csv"]
+            self.assertEqual(gandalf.find_csv_files([tmpdir + "/site"]), csvfiles)
+            self.assertEqual(gandalf.find_csv_files([tmpdir + "/site/b/2.csv", tmpdir + "/site/"]),
+                             [csvfiles[2]] + csvfiles[:2])
+            self.assertRaises(IOError, gandalf.load_hosts, tmpdir + "/site/b/missing")
+            os.makedirs(tmpdir + "/empty")
+            self.assertRaises(IOError, gandalf.load_hosts, [tmpdir + "/empty"])
+
+            for jobs in (1, 2):
+                db = gandalf.load_hosts([tmpdir + "/site"], jobs=jobs)
+                self.assertEqual([h["hostname"] for h in db],
+                                 [h["hostname"] for h in hosts[10:20] + hosts[:10] + hosts[20:]])
+                self.assertEqual(db.source(1), (csvfiles[0], 2))
+                self.assertEqual(db.source(30), (csvfiles[2], 11))
+                self.assertEqual(db.source(31), None)
+            self.assertEqual(gandalf.HostDB(hosts).source(1), None)
+
+            # The same address in two files
+            with open(tmpdir + "/site/b/2.csv", "a", newline="") as f:
+                csv.writer(f).writerow(["other", "example.com", hosts[5]["ip"], 24, 10,
+                                        "comp", "", "", "", "", ""])
+            for jobs in (1, 2):
+                with self.assertRaises(gandalf.CsvIntegrityError) as cm:
+                    gandalf.load_hosts([tmpdir + "/site"], jobs=jobs)
+                self.assertEqual(str(cm.exception),
+                                 "IP address {} is defined in both '{}' (row 7) and '{}' (row 12)"
+                                 .format(hosts[5]["ip"], csvfiles[1], csvfiles[2]))
+
+            # All the conflicts are reported at once, the ones within a file
+            # as warnings (IP addresses may be shared within a file)
+            with open(tmpdir + "/site/1.csv", "a", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow([hosts[1]["hostname"], hosts[1]["domain"], hosts[12]["ip"], 24, 10,
+                                 "comp", "", "", "", "", hosts[0]["mac"].upper()])
+                writer.writerow([hosts[11]["hostname"], hosts[11]["domain"], "10.0.0.1", 24, 10,
+                                 "comp", "", "", "", "", ""])
+            with self.assertRaises(gandalf.CsvIntegrityError) as cm, \
+                    mock.patch('gandalf.logging') as logging_mock:
+                gandalf.load_hosts([tmpdir + "/site"], compact=True)
+            self.assertEqual(str(cm.exception).split("\n"), [
+                "MAC address {} is defined in both '{}' (row 12) and '{}' (row 2)"
+                    .format(hosts[0]["mac"], csvfiles[0], csvfiles[1]),
+                "host name {0}.{1} is defined in both '{2}' (row 12) and '{3}' (row 3)"
+                    .format(hosts[1]["hostname"], hosts[1]["domain"], csvfiles[0], csvfiles[1]),
+                "IP address {} is defined in both '{}' (row 7) and '{}' (row 12)"
+                    .format(hosts[5]["ip"], csvfiles[1], csvfiles[2])])
+            logging_mock.warning.assert_called_once_with(
+                "host name {}.{} is defined in both '{}' (row 3) and '{}' (row 13)"
+                .format(hosts[11]["hostname"], hosts[11]["domain"], csvfiles[0], csvfiles[0]))
+
+            # Invalid value is reported with its file
+            with open(tmpdir + "/site/b/2.csv", "a", newline="") as f:
+                csv.writer(f).writerow(["bad", "example.com", "10.0.0.256", 24, 10,
+                                        "comp", "", "", "", "", ""])
+            with self.assertRaises(gandalf.CsvIntegrityError) as cm:
+                gandalf.load_hosts(tmpdir + "/site/b/2.csv")
+            self.assertIn("file '{}', row 13".format(csvfiles[2]), str(cm.exception))
+
+
+    def test_load_hosts_columns(self):
+        '''
+            Test loading hosts from files with different columns.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hosts = list(benchmark.generate_hosts(20))
+            columns = [benchmark.COLUMNS, benchmark.COLUMNS[:-1] + ["rack"]]
+            for n, part in enumerate([hosts[:10], hosts[10:]]):
+                with open(tmpdir + "/{}.csv".format(n), "w", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=columns[n], extrasaction="ignore")
+                    writer.writeheader()
+                    writer.writerows(dict(host, rack="r{}".format(i)) for i, host in enumerate(part))
+
+            plain = gandalf.load_hosts([tmpdir])
+            self.assertNotIn("rack", plain.get(doc_id=1))
+            self.assertNotIn("mac", plain.get(doc_id=11))
+            expected = [dict({"rack": None, "mac": None}, **host) for host in plain]
+            for options in [{"compact": True}, {"sqlite": tmpdir + "/hosts.db"}]:
+                db = gandalf.load_hosts([tmpdir], **options)
+                self.assertEqual(db.all(), expected)
+                self.assertEqual(db.search(gandalf.HostQuery().rack == "r3"), [expected[13]])
+                self.assertEqual(db.source(13), (tmpdir + "/1.csv", 4))
+
+
+    @mock.patch('gandalf.open')
+    @mock.patch('gandalf.mako.template.Template')
+    def test_compile_template(self, Template_mock, open_mock):
+        '''
+            Test compile_template function.
+        '''
+        read_mock = open_mock().__enter__().read
+        open_mock.reset_mock()
+
+        # Without cache directory template is compiled in memory
+        gandalf.compile_template("templates/hosts.mako")
+        Template_mock.assert_called_once_with(filename="templates/hosts.mako")
+        self.assertFalse(open_mock.called)
+
+        # With cache directory module name depends on template contents
+        def module_filename(contents):
+            read_mock.return_value = contents
+            gandalf.compile_template("templates/hosts.mako", "/cache")
+            self.assertEqual(Template_mock.call_args[1]["filename"], "templates/hosts.mako")
+            return Template_mock.call_args[1]["module_filename"]
+        first = module_filename(b"${ view(db.all()) }")
+        self.assertTrue(first.startswith("/cache/hosts_mako-"))
+        self.assertTrue(first.endswith(".py"))
+        self.assertEqual(module_filename(b"${ view(db.all()) }"), first)
+        self.assertNotEqual(module_filename(b"${ view(db.search(host.vlan == 1)) }"), first)
+        open_mock.assert_called_with("templates/hosts.mako", "rb")
+
+        # Compiled templates are reused until template file changes
+        compiled = {}
+        Template_mock.reset_mock()
+        with mock.patch('gandalf.os.stat') as stat_mock:
+            stat_mock.return_value.st_mtime_ns = 1
+            stat_mock.return_value.st_size = 10
+            first = gandalf.compile_template("templates/hosts.mako", compiled=compiled)
+            self.assertIs(gandalf.compile_template("templates/hosts.mako", compiled=compiled), first)
+            Template_mock.assert_called_once_with(filename="templates/hosts.mako")
+            stat_mock.return_value.st_mtime_ns = 2
+            gandalf.compile_template("templates/hosts.mako", compiled=compiled)
+            self.assertEqual(Template_mock.call_count, 2)
+
+
+    @mock.patch('gandalf.logging')
+    @mock.patch('gandalf.render_all')
+    @mock.patch('gandalf.file_digest')
+    @mock.patch('gandalf.load_var')
+    @mock.patch('gandalf.load_hosts')
+    @mock.patch('gandalf.watch_snapshot')
+    @mock.patch('gandalf.time.sleep')
+    def test_watch(self, sleep_mock, watch_snapshot_mock, load_hosts_mock, load_var_mock,
+                   file_digest_mock, render_all_mock, logging_mock):
+        '''
+            Test watch function.
+        '''
+        args = argparse.Namespace(csvfile=["hosts.csv"], var="var.yaml", compact=False, cache_dir=None,
+                                  templates="templates", watch_interval=0.5, jobs=1,
+                                  profile=None, sqlite=None)
+        incremental = gandalf.IncrementalState({}, "old")
+        compiled = {}
+        render_all_mock.return_value = [{"output": "out/hosts", "changed": True}]
+        file_digest_mock.return_value = "new"
+        load_var_mock.side_effect = [yaml.error.YAMLError(), {"a": 2}]
+        sleep_mock.side_effect = [None, None, None, None, None, KeyboardInterrupt()]
+        watch_snapshot_mock.side_effect = [
+            {"hosts.csv": (1, 1), "var.yaml": (1, 1), "templates/a.mako": (1, 1)},
+            # nothing changed
+            {"hosts.csv": (1, 1), "var.yaml": (1, 1), "templates/a.mako": (1, 1)},
+            # CSV file changed
+            {"hosts.csv": (2, 1), "var.yaml": (1, 1), "templates/a.mako": (1, 1)},
+            # variables file is broken, the old variables are kept
+            {"hosts.csv": (2, 1), "var.yaml": (2, 1), "templates/a.mako": (1, 1)},
+            # variables file is fixed
+            {"hosts.csv": (2, 1), "var.yaml": (3, 1), "templates/a.mako": (1, 1)},
+            # template is removed
+            {"hosts.csv": (2, 1), "var.yaml": (3, 1)},
+        ]
+
+        gandalf.watch(args, "db", {"a": 1}, incremental, None, compiled)
+        sleep_mock.assert_called_with(0.5)
+        load_hosts_mock.assert_called_once_with(["hosts.csv"], False, None, 1, sqlite=None, derived={})
+        self.assertEqual(load_var_mock.call_count, 2)
+        self.assertTrue(logging_mock.error.called)
+        new_db = load_hosts_mock.return_value
+        self.assertEqual(render_all_mock.call_args_list, [
+            mock.call(args, new_db, {"a": 1}, incremental, None, compiled, None),
+            mock.call(args, new_db, {"a": 1}, incremental, None, compiled, None),
+            mock.call(args, new_db, {"a": 2}, incremental, None, compiled, None),
+            mock.call(args, new_db, {"a": 2}, incremental, None, compiled, None),
+        ])
+        self.assertEqual(incremental.var_digest, "new")
+
+        # Errors in CSV file keep the old hosts
+        for Exc in [IOError, csv.Error, gandalf.CsvIntegrityError]:
+            load_hosts_mock.side_effect = Exc()
+            render_all_mock.reset_mock()
+            logging_mock.reset_mock()
+            sleep_mock.side_effect = [None, KeyboardInterrupt()]
+            watch_snapshot_mock.side_effect = [{"hosts.csv": (1, 1)}, {"hosts.csv": (2, 1)}]
+            gandalf.watch(args, "db", {}, incremental, None, compiled)
+            self.assertTrue(logging_mock.error.called)
+            render_all_mock.assert_called_once_with(args, "db", {}, incremental, None, compiled, None)
+
+        # Hosts are loaded again when other columns are to be derived
+        load_hosts_mock.side_effect = None
+        load_hosts_mock.reset_mock()
+        load_var_mock.side_effect = [{"gandalf_derived_columns": ["fqdn"]}]
+        sleep_mock.side_effect = [None, KeyboardInterrupt()]
+        watch_snapshot_mock.side_effect = [{"var.yaml": (1, 1)}, {"var.yaml": (2, 1)}]
+        gandalf.watch(args, "db", {}, incremental, None, compiled)
+        load_hosts_mock.assert_called_once_with(["hosts.csv"], False, None, 1, sqlite=None,
+                derived={"fqdn": gandalf.BUILTIN_DERIVED_COLUMNS["fqdn"]})
+
+
+    def test_watch_snapshot(self):
+        '''
+            Test watch_snapshot function.
+        '''
+        args = argparse.Namespace(csvfile=["hosts.csv"], var=None, templates="templates")
+        stat_result = mock.MagicMock(st_mtime_ns=5, st_size=7)
+        with mock.patch('gandalf.os.path.isdir', side_effect=lambda path: path == "templates"), \
+             mock.patch('gandalf.os.walk', return_value=[("templates", [], ["a.mako"])]), \
+             mock.patch('gandalf.os.stat') as stat_mock:
+            stat_mock.side_effect = [OSError(), stat_result]
+            self.assertEqual(gandalf.watch_snapshot(args), {"templates/a.mako": (5, 7)})
+        args.var = "var.yaml"
+        args.templates = "hosts.mako"
+        with mock.patch('gandalf.os.path.isdir', return_value=False), \
+             mock.patch('gandalf.os.stat', return_value=stat_result):
+            self.assertEqual(gandalf.watch_snapshot(args), {
+                "hosts.csv": (5, 7), "var.yaml": (5, 7), "hosts.mako": (5, 7)})
+
+
+    def test_background_io(self):
+        '''
+            Test BackgroundIO class.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(tmpdir + "/old.zone", "w") as f:
+                f.write("old zone")
+            with gandalf.BackgroundIO(2, max_pending=1) as io:
+                io.prefetch(tmpdir + "/old.zone")
+                io.prefetch(tmpdir + "/old.zone")
+                io.prefetch(tmpdir + "/missing.zone")
+                self.assertEqual(io.read(tmpdir + "/old.zone"), "old zone")
+                self.assertEqual(io.read(tmpdir + "/old.zone"), "old zone") # not prefetched
+                self.assertRaises(IOError, io.read, tmpdir + "/missing.zone")
+                self.assertRaises(ValueError, io.read, "\000")
+                self.assertEqual(io.read_paths, {tmpdir + "/old.zone", tmpdir + "/missing.zone", "\000"})
+                io.prefetch(tmpdir + "/old.zone")
+                io.discard(tmpdir + "/old.zone")
+                io.discard(tmpdir + "/missing.zone")
+                futures = [io.submit(gandalf.write_output, "{}/out{}".format(tmpdir, n), str(n))
+                           for n in range(5)]
+            self.assertEqual([future.result() for future in futures], [True] * 5)
+            with open(tmpdir + "/out4") as f:
+                self.assertEqual(f.read(), "4")
+
+            # Template is rendered in this thread and written in background
+            with open(tmpdir + "/zone.mako", "w") as f:
+                f.write("${ get_dns_version() }\n${ len(db) }")
+            with open(tmpdir + "/old.zone", "w") as f:
+                f.write(gandalf.apply_dns_version_hack(
+                    gandalf.DNS_HACK_ANCHOR + gandalf.DNS_HACK_COMMENT + "\n0", "\000"))
+            with gandalf.BackgroundIO(1) as io:
+                io.prefetch(tmpdir + "/old.zone")
+                future = gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/out/zone",
+                                                 tmpdir + "/old.zone", gandalf.HostDB([]), {}, io=io)
+            self.assertEqual(future.result(), {"output": tmpdir + "/out/zone",
+                                               "template": tmpdir + "/zone.mako", "changed": True})
+            with open(tmpdir + "/out/zone") as f, open(tmpdir + "/old.zone") as g:
+                self.assertEqual(f.read(), g.read())
+
+
+    @mock.patch('gandalf.logging')
+    def test_stream_template(self, logging_mock):
+        '''
+            Test that streamed templates give the same outputs.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hosts = list(benchmark.generate_hosts(300))
+            db = gandalf.HostDB(hosts)
+            with open(tmpdir + "/zone.mako", "w") as f:
+                f.write("@ IN SOA ns. admin. (\n ${ get_dns_version() }\n 3600 )\n"
+                        "% for line in view.iter_dns(db.search(host.vlan == 1010)):\n"
+                        "${ line }\n"
+                        "% endfor\n"
+                        "${ view.hosts(var['hosts'][:50]) }\n")
+
+            # Anchor may be split between chunks
+            for chunk_size in (1, 100, 1 << 16):
+                with mock.patch.object(gandalf.OutputStream, "CHUNK_SIZE", chunk_size):
+                    entry = gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/out/streamed",
+                                                    "\000", db, {"hosts": hosts}, stream=True)
+                gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/out/zone",
+                                        "\000", db, {"hosts": hosts})
+                with open(tmpdir + "/out/streamed") as f, open(tmpdir + "/out/zone") as g:
+                    self.assertEqual(f.read(), g.read())
+                self.assertEqual(entry, {"output": tmpdir + "/out/streamed",
+                                         "template": tmpdir + "/zone.mako", "changed": True})
+                os.unlink(tmpdir + "/out/streamed")
+
+            # Version is kept if the old DNS file is the same
+            with open(tmpdir + "/out/zone", "r") as f:
+                old_zone = f.read()
+            old_zone = old_zone.replace(str(gandalf.parse_dns_version(old_zone)), "2001010100")
+            with open(tmpdir + "/old.zone", "w") as f:
+                f.write(old_zone.replace(gandalf.DNS_HACK_COMMENT, gandalf.DNS_HACK_COMMENT + " "))
+            entry = gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/out/streamed",
+                                            tmpdir + "/old.zone", db, {"hosts": hosts}, stream=True)
+            with open(tmpdir + "/out/streamed") as f:
+                self.assertEqual(f.read(), old_zone)
+            dns_state = gandalf.DnsState()
+            entry = gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/out/streamed",
+                                            tmpdir + "/old.zone", db, {"hosts": hosts},
+                                            dns_state=dns_state, stream=True, profiling=True)
+            self.assertFalse(entry["changed"])
+            self.assertEqual(entry["dns"]["serial"], 2001010100)
+            self.assertIn("dns", entry["profile"]["stages"])
+            dns_state.zones[tmpdir + "/out/streamed"] = entry["dns"]
+            hosts[0]["hostname"] = "changed" # the zone changes
+            entry = gandalf.render_template(tmpdir + "/zone.mako", tmpdir + "/out/streamed",
+                                            "\000", gandalf.HostDB(hosts), {"hosts": hosts},
+                                            dns_state=dns_state, stream=True)
+            self.assertTrue(entry["changed"])
+            self.assertGreater(entry["dns"]["serial"], 2001010100)
+
+            # Failed template leaves output untouched
+            with open(tmpdir + "/bad.mako", "w") as f:
+                f.write("${ 'x' * 100000 }\n${ 1 / 0 }\n")
+            self.assertIsNone(gandalf.render_template(tmpdir + "/bad.mako", tmpdir + "/out/streamed",
+                                                      "\000", db, {}, stream=True))
+            self.assertTrue(logging_mock.error.called)
+            self.assertEqual(sorted(os.listdir(tmpdir + "/out")), ["streamed", "zone"])
+
+            # Output file can not be written
+            logging_mock.reset_mock()
+            self.assertIsNone(gandalf.render_template(tmpdir + "/bad.mako", tmpdir + "/zone.mako/out",
+                                                      "\000", db, {}, stream=True))
+            self.assertTrue(logging_mock.error.called)
+
+
+    @mock.patch('gandalf.logging')
+    def test_write_rendered(self, logging_mock):
+        '''
+            Test write_rendered function.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            entry = gandalf.write_rendered(tmpdir + "/dns/zone", "zone", {"output": "zone"})
+            self.assertEqual(entry, {"output": "zone", "changed": True})
+            profile = gandalf.Profile()
+            entry = gandalf.write_rendered(tmpdir + "/dns/zone", "zone", {}, profile)
+            self.assertFalse(entry["changed"])
+            self.assertIn("write", entry["profile"]["stages"])
+            self.assertIsNone(gandalf.write_rendered(tmpdir + "/dns/zone/file", "zone", {}))
+            self.assertTrue(logging_mock.error.called)
+            logging_mock.reset_mock()
+            self.assertIsNone(gandalf.write_rendered(tmpdir + "/dns", "zone", {}))
+            self.assertTrue(logging_mock.error.called)
+
+
+    @mock.patch('gandalf.logging')
+    @mock.patch('gandalf.BackgroundIO')
+    @mock.patch('gandalf.render_template')
+    def test_render_serial(self, render_template_mock, BackgroundIO_mock, logging_mock):
+        '''
+            Test render_serial function.
+        '''
+        templates = [("t/a.mako", "o/a.zone.mako", "d/a.zone.mako"),
+                     ("t/b.mako", "o/b", "d/b"), ("t/c.mako", "o/c", "d/c"),
+                     ("t/c.mako", "o/d", "d/d"), ("t/e.mako", "o/e", "d/e")]
+        written, failed = concurrent.futures.Future(), concurrent.futures.Future()
+        written.set_result({"output": "o/a.zone"})
+        failed.set_exception(RuntimeError("oops"))
+        io_mock = BackgroundIO_mock().__enter__()
+        io_mock.read_paths = set()
+        def render(infile, outfile, dnsfile, *args, **kw):
+            if outfile == "o/c":
+                io_mock.read_paths.add("d/c") # template t/c.mako makes zones
+            return results.pop(0)
+        results = [written, failed, None, {"output": "o/d"}, None]
+        render_template_mock.side_effect = render
+        dns_state = gandalf.DnsState({"o/a.zone": {"serial": 1},
+                                      "o/b": {"serial": 1, "digest": "abc"}})
+
+        # Output files are written in background and old DNS files of zones
+        # prefetched, unless they are compared by digests
+        self.assertEqual(gandalf.render_serial(templates, "db", {}, 2, dns_state=dns_state),
+                         [{"output": "o/a.zone"}, {"output": "o/d"}])
+        BackgroundIO_mock.assert_called_with(2)
+        render_template_mock.assert_called_with("t/e.mako", "o/e", "d/e", "db", {},
+                                                io=io_mock, dns_state=dns_state)
+        self.assertEqual({c[0][0] for c in io_mock.prefetch.call_args_list}, {"d/a.zone", "d/d"})
+        self.assertEqual([c[0][0] for c in io_mock.discard.call_args_list],
+                         ["d/a.zone", "d/b", "d/c", "d/d", "d/e"])
+        self.assertTrue(logging_mock.error.called)
+
+        # Zones of the previous run are known from its manifest
+        io_mock.reset_mock()
+        io_mock.read_paths = set()
+        render_template_mock.side_effect = None
+        render_template_mock.return_value = None
+        incremental = gandalf.IncrementalState({"o/b": {"output": "o/b", "dns": {}},
+                                                "o/c": {"output": "o/c"}})
+        self.assertEqual(gandalf.render_serial(templates, "db", {}, 2, incremental=incremental), [])
+        self.assertEqual({c[0][0] for c in io_mock.prefetch.call_args_list}, {"d/b"})
+
+        # Old DNS files are not prefetched if there are none
+        io_mock.reset_mock()
+        self.assertEqual(gandalf.render_serial(templates, "db", {}, 2, False, dns_state=dns_state), [])
+        self.assertFalse(io_mock.prefetch.called)
+
+        # Without I/O threads everything is done in this thread
+        BackgroundIO_mock.reset_mock()
+        render_template_mock.return_value = {"output": "o/d"}
+        self.assertEqual(len(gandalf.render_serial(templates, "db", {}, 0, cache_dir="/cache")), 5)
+        render_template_mock.assert_called_with("t/e.mako", "o/e", "d/e", "db", {}, cache_dir="/cache")
+        self.assertFalse(BackgroundIO_mock.called)
+
+
+    @mock.patch('gandalf.render_template')
+    @mock.patch('gandalf.logging')
+    @mock.patch('gandalf.concurrent.futures.ProcessPoolExecutor')
+    def test_render_parallel(self, ProcessPoolExecutor_mock, logging_mock,
+                             render_template_mock):
+        '''
+            Test render_parallel function.
+        '''
+        # Run "workers" as threads of this process, but still make
+        # them go through the initializer just like real ones do
+        def executor(max_workers, initializer, initargs):
+            initializer(*initargs)
+            return concurrent.futures.ThreadPoolExecutor(max_workers)
+        ProcessPoolExecutor_mock.side_effect = executor
+
+        # One of the templates is failing, the others must still be rendered
+        def render(infile, outfile, dnsfile, db, var, cache_dir):
+            if infile == "bad":
+                raise RuntimeError("boom")
+            return {"output": outfile} if infile != "skipped" else None
+        render_template_mock.side_effect = render
+        templates = [("good", "out/good", "dns/good"), ("bad", "out/bad", "dns/bad"),
+                     ("skipped", "out/skipped", "dns/skipped")]
+
+        self.assertEqual(gandalf.render_parallel(iter(templates), "db", {"a": 1}, 3,
+                                                 cache_dir="cache"), [{"output": "out/good"}])
+        self.assertEqual(ProcessPoolExecutor_mock.call_args[1]["max_workers"], 3)
+        render_template_mock.assert_any_call("good", "out/good", "dns/good", "db", {"a": 1},
+                                             cache_dir="cache")
+        self.assertEqual(render_template_mock.call_count, 3)
+        self.assertEqual(logging_mock.error.call_count, 1)
+
+
+    @mock.patch('gandalf.os.unlink')
+    @mock.patch('gandalf.os.replace')
+    @mock.patch('gandalf.os.chmod')
+    @mock.patch('gandalf.os.stat')
+    @mock.patch('gandalf.open')
+    def test_write_file_atomic(self, open_mock, stat_mock, chmod_mock, replace_mock, unlink_mock):
+        '''
+            Test write_file_atomic function.
+        '''
+        write_mock = open_mock().__enter__().write
+        open_mock.reset_mock()
+
+        # New file is written into temporary file, which is renamed then
+        stat_mock.side_effect = FileNotFoundError()
+        gandalf.write_file_atomic("out/file", b"data")
+        open_mock.assert_called_once_with("out/.file.{}.tmp".format(gandalf.os.getpid()), "wb")
+        write_mock.assert_called_once_with(b"data")
+        self.assertFalse(chmod_mock.called)
+        replace_mock.assert_called_once_with("out/.file.{}.tmp".format(gandalf.os.getpid()), "out/file")
+
+        # Permissions of existing file are kept
+        stat_mock.side_effect = None
+        stat_mock.return_value.st_mode = 0o100640
+        gandalf.write_file_atomic("out/file", b"data")
+        chmod_mock.assert_called_once_with("out/.file.{}.tmp".format(gandalf.os.getpid()), 0o640)
+        self.assertFalse(unlink_mock.called)
+
+        # Temporary file is removed on error
+        write_mock.side_effect = IOError()
+        unlink_mock.side_effect = IOError()
+        self.assertRaises(IOError, gandalf.write_file_atomic, "out/file", b"data")
+        unlink_mock.assert_called_once_with("out/.file.{}.tmp".format(gandalf.os.getpid()))
+
+
+    @mock.patch('gandalf.write_file_atomic')
+    @mock.patch('gandalf.file_digest')
+    @mock.patch('gandalf.os.path.getsize')
+    def test_write_output(self, getsize_mock, file_digest_mock, write_file_atomic_mock):
+        '''
+            Test write_output function.
+        '''
+        text = "r\u00e9ndered"
+        data = text.encode("utf8")
+
+        # The same file is left untouched
+        getsize_mock.return_value = len(data)
+        file_digest_mock.return_value = gandalf.hashlib.sha256(data).hexdigest()
+        self.assertFalse(gandalf.write_output("out/file", text))
+        self.assertFalse(write_file_atomic_mock.called)
+
+        # Changed file is written
+        file_digest_mock.return_value = "0" * 64
+        self.assertTrue(gandalf.write_output("out/file", text))
+        write_file_atomic_mock.assert_called_once_with("out/file", data)
+
+        # File of different size is not even read
+        write_file_atomic_mock.reset_mock()
+        file_digest_mock.reset_mock()
+        getsize_mock.return_value = 1
+        self.assertTrue(gandalf.write_output("out/file", text))
+        self.assertFalse(file_digest_mock.called)
+        self.assertTrue(write_file_atomic_mock.called)
+
+        # Missing file is written
+        getsize_mock.side_effect = FileNotFoundError()
+        self.assertTrue(gandalf.write_output("out/file", text))
+
+
+    @mock.patch('gandalf.write_file_atomic')
+    def test_write_changes(self, write_file_atomic_mock):
+        '''
+            Test write_changes function.
+        '''
+        entries = [{"output": "out/a", "changed": True}, {"output": "out/b", "changed": False}]
+        outputs = ["out/a", "out/b", "out/c"]
+        previous = '{"changed": ["out/a", "out/old"], "unchanged": ["out/b"], ' \
+                   '"failed": [], "removed": ["out/older"]}'
+        with mock.patch('gandalf.open', mock.mock_open(read_data=previous)):
+            gandalf.write_changes("changes.json", entries, outputs)
+        path, data = write_file_atomic_mock.call_args[0]
+        self.assertEqual(path, "changes.json")
+        self.assertEqual(gandalf.json.loads(data.decode("utf8")), {
+            "changed": ["out/a"], "unchanged": ["out/b"], "failed": ["out/c"], "removed": ["out/old"]})
+
+        # Without previous manifest nothing is removed
+        with mock.patch('gandalf.open', side_effect=FileNotFoundError()):
+            gandalf.write_changes("changes.json", entries, outputs)
+        self.assertEqual(gandalf.json.loads(write_file_atomic_mock.call_args[0][1])["removed"], [])
+
+        # Outputs of other shards are not removed
+        with mock.patch('gandalf.open', mock.mock_open(read_data=previous)):
+            gandalf.write_changes("changes.json", entries, outputs, outputs + ["out/old"])
+        self.assertEqual(gandalf.json.loads(write_file_atomic_mock.call_args[0][1])["removed"],
+                         [])
 
 
     @mock.patch('gandalf.main')